@@ -0,0 +1,94 @@
+import json
+import os
+import sqlite3
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from langchain.schema import BaseStore, Document
+
+
+# Persistent docstore for the parent documents of ParentDocumentRetriever, instead of InMemoryStore
+# - the documents live in a SQLite file, one row per id, as zlib compressed JSON (page_content + metadata)
+# - they are only read when retrieved, by id, so nothing has to be loaded at startup
+# - an LRU of the cache_size most recently used documents sits in front of SQLite
+class SQLiteDocStore(BaseStore[str, Document]):
+
+    def __init__(self, path: str, cache_size: int = 1024, compression_level: int = 6):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.cache_size = cache_size
+        self.compression_level = compression_level
+        self._cache: "OrderedDict[str, Document]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS documents (id TEXT PRIMARY KEY, data BLOB NOT NULL)")
+        self._conn.commit()
+
+    def _encode(self, doc: Document) -> bytes:
+        data = json.dumps({"page_content": doc.page_content, "metadata": doc.metadata})
+        return zlib.compress(data.encode("utf-8"), self.compression_level)
+
+    def _decode(self, data: bytes) -> Document:
+        return Document(**json.loads(zlib.decompress(data).decode("utf-8")))
+
+    def _remember(self, key: str, doc: Document):
+        self._cache[key] = doc
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def mget(self, keys: Sequence[str]) -> List[Optional[Document]]:
+        with self._lock:
+            found = {}
+            missing = []
+            for key in keys:
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    found[key] = self._cache[key]
+                else:
+                    missing.append(key)
+            # The documents that are not in the LRU are read a batch at a time (SQLite limits the number of parameters)
+            for start in range(0, len(missing), 500):
+                batch = missing[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(f"SELECT id, data FROM documents WHERE id IN ({placeholders})", batch).fetchall()
+                for key, data in rows:
+                    found[key] = self._decode(data)
+                    self._remember(key, found[key])
+            return [found.get(key) for key in keys]
+
+    def mset(self, key_value_pairs: Sequence[Tuple[str, Document]]) -> None:
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO documents (id, data) VALUES (?, ?)",
+                [(key, self._encode(doc)) for key, doc in key_value_pairs],
+            )
+            self._conn.commit()
+            for key, doc in key_value_pairs:
+                self._remember(key, doc)
+
+    def mdelete(self, keys: Sequence[str]) -> None:
+        with self._lock:
+            self._conn.executemany("DELETE FROM documents WHERE id = ?", [(key,) for key in keys])
+            self._conn.commit()
+            for key in keys:
+                self._cache.pop(key, None)
+
+    def yield_keys(self, prefix: Optional[str] = None) -> Iterator[str]:
+        with self._lock:
+            if prefix is None:
+                rows = self._conn.execute("SELECT id FROM documents").fetchall()
+            else:
+                rows = self._conn.execute("SELECT id FROM documents WHERE substr(id, 1, ?) = ?", (len(prefix), prefix)).fetchall()
+        for (key,) in rows:
+            yield key
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+    def close(self):
+        self._conn.close()
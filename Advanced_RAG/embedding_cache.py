@@ -0,0 +1,172 @@
+import hashlib
+import os
+import re
+from contextlib import contextmanager
+from typing import List
+
+import numpy as np
+from langchain.embeddings.base import Embeddings
+
+if os.name == "nt":
+    import msvcrt
+else:
+    import fcntl
+
+
+# Content addressed cache for document embeddings
+# - every chunk is keyed by sha256(text), in a subdirectory per (model name, normalize flag), so the same text
+#   is only embedded once per model, whichever collection / retriever / run asks for it
+# - the vectors are appended to a float32 file that is read back through a memory map (vectors.f32)
+# - the row of every key is appended to a text index (index.tsv) only after its vector is on disk,
+#   so a crash at worst loses the last batch, never maps a key to a missing row
+# - appends hold an exclusive lock on the directory and take their rows from the size of vectors.f32, so several
+#   processes can share the cache; each one picks up the rows the others appended before embedding anything
+
+
+@contextmanager
+def _exclusive_lock(path: str):
+    # Cross-process lock on a file, held for the duration of the block
+    with open(path, "a+b") as f:
+        if os.name == "nt":
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    # LK_LOCK gives up after 10 seconds, keep waiting
+                    continue
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+class CachedEmbeddings(Embeddings):
+
+    def __init__(self, embeddings: Embeddings, cache_dir: str, model_name: str, normalize: bool):
+        self.embeddings = embeddings
+        # One directory (and vector size) per model and normalization
+        self.cache_dir = os.path.join(cache_dir, f"{re.sub(r'[^A-Za-z0-9._-]+', '_', model_name)}-{'norm' if normalize else 'raw'}")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.vectors_path = os.path.join(self.cache_dir, "vectors.f32")
+        self.index_path = os.path.join(self.cache_dir, "index.tsv")
+        self.lock_path = os.path.join(self.cache_dir, "lock")
+
+        # key -> row in vectors.f32
+        self.index = {}
+        self.dim = None
+        # Bytes of index.tsv already read
+        self._index_offset = 0
+        self._memmap = None
+        self._refresh()
+
+        # Hit / miss counters of this process
+        self.hits = 0
+        self.misses = 0
+
+    def _key(self, text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _row_bytes(self) -> int:
+        return 4 * self.dim
+
+    def _num_rows(self) -> int:
+        # Complete rows on disk, a partially written last row is not one
+        if self.dim is None or not os.path.exists(self.vectors_path):
+            return 0
+        return os.path.getsize(self.vectors_path) // self._row_bytes()
+
+    def _refresh(self):
+        # Reads the index lines appended since the last call, by this process or by others
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_offset)
+            data = f.read()
+        # Only complete lines, the last one may still be being written
+        end = data.rfind(b"\n") + 1
+        self._index_offset += end
+        num_rows = None
+        for line in data[:end].decode("utf-8").splitlines():
+            key, sep, row = line.strip().partition("\t")
+            if not sep:
+                # Header: the size of the vectors
+                if key.isdigit():
+                    self.dim = int(key)
+                continue
+            if not row.isdigit():
+                # Left over by a crash in the middle of a line
+                continue
+            if num_rows is None:
+                num_rows = self._num_rows()
+            if int(row) < num_rows:
+                self.index[key] = int(row)
+
+    def _vectors(self) -> np.ndarray:
+        # Memory map of all the complete rows on disk, reopened when rows were appended
+        num_rows = self._num_rows()
+        if self._memmap is None or self._memmap.shape[0] != num_rows:
+            self._memmap = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(num_rows, self.dim))
+        return self._memmap
+
+    def _append(self, keys: List[str], vectors: np.ndarray):
+        # Called with the lock held
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+            with open(self.index_path, "ab") as f:
+                f.write(f"{self.dim}\n".encode("utf-8"))
+        assert vectors.shape[1] == self.dim, f"embedding size {vectors.shape[1]} does not match the cache ({self.dim})"
+        # The rows come from the file itself, after dropping a partial row left by a crash
+        first_row = self._num_rows()
+        if os.path.exists(self.vectors_path) and os.path.getsize(self.vectors_path) != first_row * self._row_bytes():
+            self._memmap = None
+            os.truncate(self.vectors_path, first_row * self._row_bytes())
+        with open(self.vectors_path, "ab") as f:
+            f.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(self.index_path, "ab") as f:
+            # A line cut by a crash must not swallow the first new one
+            if f.tell() > 0:
+                with open(self.index_path, "rb") as check:
+                    check.seek(-1, os.SEEK_END)
+                    if check.read(1) != b"\n":
+                        f.write(b"\n")
+            f.write("".join(f"{key}\t{first_row + i}\n" for i, key in enumerate(keys)).encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        keys = [self._key(text) for text in texts]
+        self._refresh()
+        # Embed only the texts that are not cached yet, each distinct text once
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in self.index and key not in missing:
+                missing[key] = text
+        self.misses += len(missing)
+        self.hits += len(texts) - len(missing)
+        if missing:
+            # The embedding runs without the lock, only the append holds it
+            new_vectors = np.asarray(self.embeddings.embed_documents(list(missing.values())), dtype=np.float32)
+            with _exclusive_lock(self.lock_path):
+                self._refresh()
+                self._append(list(missing.keys()), new_vectors)
+                self._refresh()
+        vectors = self._vectors()
+        rows = np.array([self.index[key] for key in keys], dtype=np.int64)
+        return vectors[rows].tolist()
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries are one-off, they are not cached
+        return self.embeddings.embed_query(text)
@@ -0,0 +1,237 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+from typing import Dict, List, Tuple
+
+from langchain.embeddings import HuggingFaceBgeEmbeddings
+from langchain.schema import Document
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain.vectorstores import Chroma
+
+from embedding_cache import CachedEmbeddings
+from pdf_parsing import iter_pdf_files
+
+
+# Incremental ingestion of a folder of PDFs into persisted stores
+# The manifest records, for every ingested file, its size, mtime, content hash and the ids of everything stored
+# for it. On every run:
+# - files whose size and mtime did not change are skipped without being read
+# - files whose content hash changed (and new files) are parsed, split and embedded again,
+#   after what was stored for their previous version was deleted
+# - what was stored for files that were removed from the folder is deleted
+# The manifest is rewritten after every file, marking it "in_progress" with the ids it is about to store, so a run
+# that crashes resumes where it stopped and first deletes whatever the interrupted file had already stored.
+# The ids are derived from the path and the content of the file, so a retry overwrites instead of duplicating,
+# and two files with the same content never share ids
+#
+# What is stored for a file is up to a sink, with the methods:
+# - plan(file_id, pages) -> (ids, items): the ids that will be stored and what add() needs to store them
+# - add(items), delete(ids), and persist() which makes the changes durable before the manifest records them
+
+
+class ChunkSink:
+    # Splits the pages into chunks stored in a vector store (Chroma, FAISS, ...)
+
+    def __init__(self, vectorstore, splitter):
+        self.vectorstore = vectorstore
+        self.splitter = splitter
+
+    def plan(self, file_id: str, pages: List[Document]) -> Tuple[List[str], Tuple[List[Document], List[str]]]:
+        chunks = self.splitter.split_documents(pages)
+        ids = [f"{file_id}:{i}" for i in range(len(chunks))]
+        return ids, (chunks, ids)
+
+    def add(self, items: Tuple[List[Document], List[str]]):
+        chunks, ids = items
+        if chunks:
+            self.vectorstore.add_documents(chunks, ids=ids)
+
+    def delete(self, ids: List[str]):
+        if hasattr(self.vectorstore, "index_to_docstore_id"):
+            # FAISS refuses to delete ids it does not have, e.g. the ones of a file interrupted before add()
+            existing = set(self.vectorstore.index_to_docstore_id.values())
+            ids = [i for i in ids if i in existing]
+        if ids:
+            self.vectorstore.delete(ids=ids)
+
+    def persist(self):
+        if hasattr(self.vectorstore, "persist"):
+            self.vectorstore.persist()
+
+
+class ParentSink:
+    # Stores the pages like ParentDocumentRetriever.add_documents(): the parents (the pages, or their parent_splitter
+    # chunks) in its docstore, their child_splitter chunks in its vector store. The ids are derived from the file
+    # instead of random uuids, and prefixed with name so that several sinks can share a manifest:
+    # parents are "<name>/<file_id>:<i>", the children of parent i are "<name>/<file_id>:<i>:<j>"
+
+    def __init__(self, retriever, name: str):
+        self.retriever = retriever
+        self.prefix = f"{name}/"
+
+    def plan(self, file_id: str, pages: List[Document]) -> Tuple[List[str], tuple]:
+        retriever = self.retriever
+        parents = retriever.parent_splitter.split_documents(pages) if retriever.parent_splitter is not None else pages
+        parent_ids, children, child_ids = [], [], []
+        for i, parent in enumerate(parents):
+            parent_id = f"{self.prefix}{file_id}:{i}"
+            parent_ids.append(parent_id)
+            for j, child in enumerate(retriever.child_splitter.split_documents([parent])):
+                child.metadata[retriever.id_key] = parent_id
+                children.append(child)
+                child_ids.append(f"{parent_id}:{j}")
+        return parent_ids + child_ids, (list(zip(parent_ids, parents)), children, child_ids)
+
+    def add(self, items: tuple):
+        parents, children, child_ids = items
+        # Parents first: a child is never retrievable before its parent is stored
+        if parents:
+            self.retriever.docstore.mset(parents)
+        if children:
+            self.retriever.vectorstore.add_documents(children, ids=child_ids)
+
+    def delete(self, ids: List[str]):
+        own = [i[len(self.prefix):] for i in ids if i.startswith(self.prefix)]
+        child_ids = [self.prefix + i for i in own if i.count(":") == 2]
+        parent_ids = [self.prefix + i for i in own if i.count(":") == 1]
+        if child_ids:
+            self.retriever.vectorstore.delete(ids=child_ids)
+        if parent_ids:
+            self.retriever.docstore.mdelete(parent_ids)
+
+    def persist(self):
+        if hasattr(self.retriever.vectorstore, "persist"):
+            self.retriever.vectorstore.persist()
+
+
+class MultiSink:
+    # Stores every file in several sinks, from a single parse. The ids of the sinks must not overlap
+
+    def __init__(self, *sinks):
+        self.sinks = sinks
+
+    def plan(self, file_id: str, pages: List[Document]) -> Tuple[List[str], list]:
+        plans = [sink.plan(file_id, pages) for sink in self.sinks]
+        return [i for ids, _ in plans for i in ids], [items for _, items in plans]
+
+    def add(self, items: list):
+        for sink, sink_items in zip(self.sinks, items):
+            sink.add(sink_items)
+
+    def delete(self, ids: List[str]):
+        for sink in self.sinks:
+            sink.delete(ids)
+
+    def persist(self):
+        for sink in self.sinks:
+            sink.persist()
+
+
+def file_hash(path: str, block_size: int = 1 << 20) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def file_id(path: str, content_hash: str) -> str:
+    # Identifies a version of a file
+    return hashlib.sha256(f"{path}\0{content_hash}".encode("utf-8")).hexdigest()[:32]
+
+
+def load_manifest(manifest_path: str) -> Dict[str, dict]:
+    if not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_manifest(manifest: Dict[str, dict], manifest_path: str):
+    # Write a temporary file and rename it, so the manifest on disk is always complete
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, manifest_path)
+
+
+def ingest(data_dir: str, sink, manifest_path: str, pattern: str = "*.pdf", num_workers=None) -> dict:
+    manifest = load_manifest(manifest_path)
+    paths = sorted(os.path.abspath(p) for p in glob.glob(os.path.join(data_dir, pattern)))
+    stats = {"added": 0, "updated": 0, "removed": 0, "unchanged": 0, "ids": 0}
+
+    # Files that are gone
+    for path in [p for p in manifest if p not in paths]:
+        sink.delete(manifest[path]["ids"])
+        sink.persist()
+        del manifest[path]
+        save_manifest(manifest, manifest_path)
+        stats["removed"] += 1
+        print(f"Removed {path}")
+
+    # (path, stat, content hash, previous manifest entry) of the files to parse
+    changed = []
+    for path in paths:
+        stat = os.stat(path)
+        entry = manifest.get(path)
+        if entry is not None and entry["status"] == "done" and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+            stats["unchanged"] += 1
+            continue
+        content_hash = file_hash(path)
+        if entry is not None and entry["status"] == "done" and entry["hash"] == content_hash:
+            # Touched but not modified: only the stat changed
+            entry.update(size=stat.st_size, mtime=stat.st_mtime)
+            save_manifest(manifest, manifest_path)
+            stats["unchanged"] += 1
+            continue
+        changed.append((path, stat, content_hash, entry))
+
+    # The pages are parsed in a process pool, each file is stored as soon as its pages are ready
+    # while the next ones are being parsed
+    parsed = iter_pdf_files([path for path, _, _, _ in changed], num_workers=num_workers)
+    for (path, stat, content_hash, entry), (_, pages) in zip(changed, parsed):
+        print(f"Ingesting {path}...")
+        if entry is not None:
+            # Previous version of the file, or what an interrupted run had already stored
+            sink.delete(entry["ids"])
+        ids, items = sink.plan(file_id(path, content_hash), pages)
+        manifest[path] = {"size": stat.st_size, "mtime": stat.st_mtime, "hash": content_hash, "ids": ids, "status": "in_progress"}
+        save_manifest(manifest, manifest_path)
+        sink.add(items)
+        sink.persist()
+        manifest[path]["status"] = "done"
+        save_manifest(manifest, manifest_path)
+        stats["updated" if entry is not None else "added"] += 1
+        stats["ids"] += len(ids)
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Ingest the new and changed PDFs of a folder into a persisted Chroma collection")
+    parser.add_argument("--data-dir", default="D://LangChain//data")
+    parser.add_argument("--persist-dir", default="D://LangChain//chroma")
+    parser.add_argument("--collection", default="data_chunks")
+    parser.add_argument("--cache-dir", default="D://LangChain//embedding_cache")
+    parser.add_argument("--chunk-size", type=int, default=400)
+    parser.add_argument("--workers", type=int, default=None, help="PDF parsing processes, all the cores by default")
+    args = parser.parse_args()
+
+    model_name = "BAAI/bge-small-en-v1.5"
+    encode_kwargs = {'normalize_embeddings': True}
+    bge_embeddings = CachedEmbeddings(
+        HuggingFaceBgeEmbeddings(model_name=model_name, encode_kwargs=encode_kwargs),
+        cache_dir=args.cache_dir,
+        model_name=model_name,
+        normalize=encode_kwargs['normalize_embeddings']
+    )
+    vectorstore = Chroma(collection_name=args.collection, embedding_function=bge_embeddings, persist_directory=args.persist_dir)
+    sink = ChunkSink(vectorstore, RecursiveCharacterTextSplitter(chunk_size=args.chunk_size))
+
+    stats = ingest(args.data_dir, sink, os.path.join(args.persist_dir, f"{args.collection}_manifest.json"), num_workers=args.workers)
+    print(f"Ingestion done: {stats}")
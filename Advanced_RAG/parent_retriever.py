@@ -8,30 +8,23 @@ from langchain.retrievers import ParentDocumentRetriever
 from PyPDF2 import PdfReader
 ## Text Splitting & Docloader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain.storage import InMemoryStore
 from langchain.document_loaders import TextLoader
 from langchain.embeddings import HuggingFaceBgeEmbeddings
 # from langchain.embeddings.openai import OpenAIEmbeddings
 # embeddings = OpenAIEmbeddings()
-import glob
-from langchain.document_loaders import PyPDFLoader
 from langchain.chains import RetrievalQA
 from langchain.llms import OpenAI
+from embedding_cache import CachedEmbeddings
+from ingestion import MultiSink, ParentSink, ingest
+from docstore import SQLiteDocStore
 
 
-_ = load_dotenv(find_dotenv())
-
-openai.api_key = os.environ["OPENAI_API_KEY"]
+# The PDF pages are extracted by a pool of spawned processes, which re-import this script:
+# everything that runs lives in main(), under if __name__ == '__main__' at the bottom
 
 model_name = "BAAI/bge-small-en-v1.5"
 encode_kwargs = {'normalize_embeddings': True} # set True to compute cosine similarity
 
-bge_embeddings = HuggingFaceBgeEmbeddings(
-    model_name=model_name,
-    # model_kwargs={'device': 'cuda'},
-    encode_kwargs=encode_kwargs
-)
-
 # directory = "D://LangChain//data"
 
 # # Iterate through each file in the directory
@@ -49,19 +42,27 @@ bge_embeddings = HuggingFaceBgeEmbeddings(
 
 
 
-# Get all PDF files and its contents
-all_pdf = glob.glob("D://LangChain//data//*.pdf")
+# The Chroma collections and the parent documents are persisted here, so a restart does not ingest again
+persist_directory = "D://LangChain//parent_retriever"
 
-docs = []
-for pdf_file in all_pdf:
-    loader = PyPDFLoader(pdf_file)
-    pages = loader.load_and_split()
-    docs.extend(pages)
-    
+# All the PDF files of this folder are ingested
+data_directory = "D://LangChain//data"
 
-print("LENGTH OF THE DOCS", len(docs))
 
+def load_embeddings():
+    bge_embeddings = HuggingFaceBgeEmbeddings(
+        model_name=model_name,
+        # model_kwargs={'device': 'cuda'},
+        encode_kwargs=encode_kwargs
+    )
 
+    # Chunks already embedded by a previous run (or by the other collection below) are read back from disk
+    return CachedEmbeddings(
+        bge_embeddings,
+        cache_dir="D://LangChain//embedding_cache",
+        model_name=model_name,
+        normalize=encode_kwargs['normalize_embeddings']
+    )
 
 
 # Retrieving full documents rather than chunks
@@ -69,44 +70,25 @@ print("LENGTH OF THE DOCS", len(docs))
 
 # This is good to use if you initial full docs 
 # aren't too big themselves and you aren't going to return many of them
+def build_full_doc_retriever(bge_embeddings):
+    # This text splitter is used to create the child documents
+    child_splitter = RecursiveCharacterTextSplitter(chunk_size=400)
 
-# This text splitter is used to create the child documents
-child_splitter = RecursiveCharacterTextSplitter(chunk_size=400)
-
-
-# The vectorstore to use to index the child chunks
-vectorstore = Chroma(
-    collection_name="full_documents",
-    embedding_function=bge_embeddings  #OpenAIEmbeddings()
-)
-
-# The storage layer for the parent documents
-store = InMemoryStore()
-
-full_doc_retriever = ParentDocumentRetriever(
-    vectorstore=vectorstore,
-    docstore=store,
-    child_splitter=child_splitter,
-)
-
-full_doc_retriever.add_documents(docs, ids=None)
-
-# our
-list(store.yield_keys())
+    # The vectorstore to use to index the child chunks
+    vectorstore = Chroma(
+        collection_name="full_documents",
+        embedding_function=bge_embeddings,  #OpenAIEmbeddings()
+        persist_directory=persist_directory
+    )
 
-sub_docs = vectorstore.similarity_search("what is Deep Learning", k=2)
-
-print("Length of the Sub Docs",len(sub_docs))
-
-
-print(sub_docs[0].page_content)
-
-retrieved_docs = full_doc_retriever.get_relevant_documents("what is Deep Learning")
-
-print("Length of the Retrieved DOCS",len(retrieved_docs[0].page_content))
-
-retrieved_docs[0].page_content
+    # The storage layer for the parent documents, read lazily by id
+    store = SQLiteDocStore(os.path.join(persist_directory, "full_documents.sqlite"))
 
+    return ParentDocumentRetriever(
+        vectorstore=vectorstore,
+        docstore=store,
+        child_splitter=child_splitter,
+    )
 
 
 # Retrieving larger chunks
@@ -115,62 +97,91 @@ retrieved_docs[0].page_content
 # into larger chunks, and then split it into smaller chunks.
 # We then index the smaller chunks, but on retrieval we retrieve the larger 
 # chunks (but still not the full documents).
+def build_big_chunks_retriever(bge_embeddings):
+    # This text splitter is used to create the parent documents - The big chunks
+    parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000)
 
+    # This text splitter is used to create the child documents - The small chunks
+    # It should create documents smaller than the parent
+    child_splitter = RecursiveCharacterTextSplitter(chunk_size=400)
 
-# This text splitter is used to create the parent documents - The big chunks
-parent_splitter = RecursiveCharacterTextSplitter(chunk_size=2000)
-
-# This text splitter is used to create the child documents - The small chunks
-# It should create documents smaller than the parent
-child_splitter = RecursiveCharacterTextSplitter(chunk_size=400)
+    # The vectorstore to use to index the child chunks
+    vectorstore = Chroma(collection_name="split_parents", embedding_function=bge_embeddings, persist_directory=persist_directory) #OpenAIEmbeddings()
 
-# The vectorstore to use to index the child chunks
-vectorstore = Chroma(collection_name="split_parents", embedding_function=bge_embeddings) #OpenAIEmbeddings()
+    # The storage layer for the parent documents, read lazily by id
+    store = SQLiteDocStore(os.path.join(persist_directory, "split_parents.sqlite"))
 
-# The storage layer for the parent documents
-store = InMemoryStore()
+    return ParentDocumentRetriever(
+        vectorstore=vectorstore,
+        docstore=store,
+        child_splitter=child_splitter,
+        parent_splitter=parent_splitter,
+    )
 
 
+def main():
+    _ = load_dotenv(find_dotenv())
 
-big_chunks_retriever = ParentDocumentRetriever(
-    vectorstore=vectorstore,
-    docstore=store,
-    child_splitter=child_splitter,
-    parent_splitter=parent_splitter,
-)
+    openai.api_key = os.environ["OPENAI_API_KEY"]
 
-big_chunks_retriever.add_documents(docs)
+    bge_embeddings = load_embeddings()
+    full_doc_retriever = build_full_doc_retriever(bge_embeddings)
+    big_chunks_retriever = build_big_chunks_retriever(bge_embeddings)
 
-len(list(store.yield_keys()))
+    # Both collections follow the files of the data folder: new and modified files are added, the ones of removed
+    # and modified files deleted. The pages are extracted in parallel and every file goes to the splitters / embedder
+    # as soon as its pages are ready, while the next ones are still being parsed
+    manifest_path = os.path.join(persist_directory, "manifest.json")
+    if not os.path.exists(manifest_path):
+        # Stores filled before the manifest existed have random ids that nothing tracks: start over
+        for retriever in (full_doc_retriever, big_chunks_retriever):
+            retriever.docstore.mdelete(list(retriever.docstore.yield_keys()))
+            child_ids = retriever.vectorstore.get()["ids"]
+            if child_ids:
+                retriever.vectorstore.delete(ids=child_ids)
+    sink = MultiSink(ParentSink(full_doc_retriever, "full_documents"), ParentSink(big_chunks_retriever, "split_parents"))
+    stats = ingest(data_directory, sink, manifest_path)
+    print(f"Ingestion done: {stats}")
 
+    # our
+    list(full_doc_retriever.docstore.yield_keys())
 
-sub_docs = vectorstore.similarity_search("what is Deep Learning")
+    sub_docs = full_doc_retriever.vectorstore.similarity_search("what is Deep Learning", k=2)
 
-print(sub_docs[0].page_content)
+    print("Length of the Sub Docs",len(sub_docs))
 
+    print(sub_docs[0].page_content)
 
-retrieved_docs = big_chunks_retriever.get_relevant_documents("what is Deep Learning")
+    retrieved_docs = full_doc_retriever.get_relevant_documents("what is Deep Learning")
 
+    print("Length of the Retrieved DOCS",len(retrieved_docs[0].page_content))
 
-print(len(retrieved_docs))
+    len(list(big_chunks_retriever.docstore.yield_keys()))
 
-print(len(retrieved_docs[0].page_content))
+    sub_docs = big_chunks_retriever.vectorstore.similarity_search("what is Deep Learning")
 
+    print(sub_docs[0].page_content)
 
-print(retrieved_docs[0].page_content)
+    retrieved_docs = big_chunks_retriever.get_relevant_documents("what is Deep Learning")
 
+    print(len(retrieved_docs))
 
-print(retrieved_docs[1].page_content)
+    print(len(retrieved_docs[0].page_content))
 
+    print(retrieved_docs[0].page_content)
 
+    print(retrieved_docs[1].page_content)
 
+    qa = RetrievalQA.from_chain_type(llm=OpenAI(),
+                                     chain_type="stuff",
+                                     retriever=big_chunks_retriever)
 
-qa = RetrievalQA.from_chain_type(llm=OpenAI(),
-                                 chain_type="stuff",
-                                 retriever=big_chunks_retriever)
+    query = input("Enter Your Query:\n")
+    res = qa.run(query)
+    print(res)
 
+    print(f"Embedding cache: {bge_embeddings.hits} hits, {bge_embeddings.misses} misses")
 
 
-query = input("Enter Your Query:\n")
-res = qa.run(query)
-print(res)
+if __name__ == '__main__':
+    main()
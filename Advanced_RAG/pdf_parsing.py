@@ -0,0 +1,105 @@
+import multiprocessing
+import os
+from collections import deque
+from typing import Iterator, List, Optional, Sequence, Tuple
+
+from PyPDF2 import PdfReader
+from langchain.schema import Document
+
+
+# Parallel PDF text extraction
+# PdfReader is pure Python and CPU bound, so the pages are spread over a pool of processes:
+# - every task extracts a range of pages_per_task pages of one file
+# - at most max_in_flight tasks are submitted at a time and their results are yielded in order as they finish,
+#   so the parent never holds more than that window of pages while the splitter / embedder consumes them
+# - every worker keeps only the reader of the file it is working on and is replaced after max_tasks_per_child
+#   tasks, so the memory of a worker does not grow with the corpus
+# The Documents are the same as the ones of PyPDFLoader.load(): one per page, metadata {"source", "page"}
+#
+# The workers are always spawned, never forked: forking a process that runs other threads (Streamlit, Chroma,
+# tokenizers) can deadlock the child. A spawned worker re-imports the __main__ module of the parent, so a script
+# that parses with num_workers != 1 must keep its top level code under if __name__ == '__main__'.
+# Callers that cannot (a Streamlit app is executed as __main__) pass num_workers=1 to extract in process
+
+# Reader of the file the worker process is working on: (path, PdfReader)
+_reader: Optional[Tuple[str, PdfReader]] = None
+
+
+def _get_reader(path: str) -> PdfReader:
+    global _reader
+    if _reader is None or _reader[0] != path:
+        _reader = (path, PdfReader(path))
+    return _reader[1]
+
+
+def _extract_pages(path: str, start: int, end: int) -> List[str]:
+    reader = _get_reader(path)
+    return [reader.pages[i].extract_text() or "" for i in range(start, end)]
+
+
+def count_pages(path: str) -> int:
+    return len(PdfReader(path).pages)
+
+
+def _parse(
+    paths: Sequence[str],
+    num_workers: Optional[int],
+    pages_per_task: int,
+    max_in_flight: Optional[int],
+    max_tasks_per_child: int,
+) -> Iterator[Tuple[tuple, List[str]]]:
+    # Yields every task (file index, path, first page, end page) with the texts of its pages, in order
+    num_workers = num_workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or 2 * num_workers
+    page_counts = [count_pages(path) for path in paths]
+    tasks = [
+        (k, path, start, min(start + pages_per_task, num_pages))
+        for k, (path, num_pages) in enumerate(zip(paths, page_counts))
+        for start in range(0, num_pages, pages_per_task)
+    ]
+
+    # Not worth starting processes for a few pages
+    if num_workers == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield task, _extract_pages(*task[1:])
+        return
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(num_workers, maxtasksperchild=max_tasks_per_child) as pool:
+        yield from _ordered_results(pool, tasks, max_in_flight)
+
+
+def _ordered_results(pool, tasks: list, max_in_flight: int) -> Iterator[Tuple[tuple, List[str]]]:
+    # Keeps max_in_flight tasks running and yields their results in submission order
+    in_flight = deque()
+    for task in tasks:
+        in_flight.append((task, pool.apply_async(_extract_pages, task[1:])))
+        if len(in_flight) >= max_in_flight:
+            # The window is full: wait for the oldest task before submitting another one
+            oldest, result = in_flight.popleft()
+            yield oldest, result.get()
+    while in_flight:
+        oldest, result = in_flight.popleft()
+        yield oldest, result.get()
+
+
+def iter_pdf_files(
+    paths: Sequence[str],
+    num_workers: Optional[int] = None,
+    pages_per_task: int = 8,
+    max_in_flight: Optional[int] = None,
+    max_tasks_per_child: int = 64,
+) -> Iterator[Tuple[str, List[Document]]]:
+    # Yields (path, pages) for every file, in the order of paths (files without pages included)
+    pages: List[Document] = []
+    next_file = 0
+    for (k, path, start, _), texts in _parse(paths, num_workers, pages_per_task, max_in_flight, max_tasks_per_child):
+        # The files before k are complete (or had no pages)
+        while next_file < k:
+            yield paths[next_file], pages
+            pages = []
+            next_file += 1
+        pages += [Document(page_content=text, metadata={"source": path, "page": start + i}) for i, text in enumerate(texts)]
+    while next_file < len(paths):
+        yield paths[next_file], pages
+        pages = []
+        next_file += 1
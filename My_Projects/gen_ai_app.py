@@ -4,7 +4,9 @@ from bs4 import BeautifulSoup
 from PIL import Image
 import io
 import os
+import sys
 import glob
+import hashlib
 from dotenv import load_dotenv, find_dotenv
 import openai
 from langchain.embeddings.openai import OpenAIEmbeddings
@@ -15,6 +17,10 @@ from langchain.chains import RetrievalQAWithSourcesChain
 import PyPDF2
 from langchain import OpenAI, VectorDBQA
 
+# The PDF parsing lives with the other ingestion code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Advanced_RAG"))
+from ingestion import ChunkSink, ingest
+
 
 # Load environment variables
 _ = load_dotenv(find_dotenv())  # read local .env file
@@ -32,13 +38,14 @@ def extract_info_from_link(url):
 
 # Function to read PDF file
 def read_pdf(file):
+    # One reader for both the text and the images, in this process: a single upload is not worth a pool
     text = ""
     images = []
     pdf = PyPDF2.PdfReader(file)
     num_pages = len(pdf.pages)
     for page_num in range(num_pages):
         page = pdf.pages[page_num]
-        text += page.extract_text()
+        text += page.extract_text() or ""
         if '/XObject' in page['/Resources']:
             xObject = page['/Resources']['/XObject'].get_object()
             for obj in xObject:
@@ -55,41 +62,69 @@ def read_pdf(file):
                         st.warning(f"Unable to process image on page {page_num + 1}.")
     return text, images
 
-def create_vector_store_from_pdfs(uploaded_file, question):
-    data_folder = "D://LangChain//data"  # Assuming "data" is the folder containing your PDF files
-    all_pdf = glob.glob(os.path.join(data_folder, "*.pdf"))
-    all_pages = []
-    
-    for pdf_file in all_pdf:
-        loader = PyPDFLoader(pdf_file)
-        pages = loader.load_and_split()
-        all_pages.extend(pages)
-    
-    if not all_pages:
-        st.error("No documents found in the data folder. Please check.")
-        return None
-    
+data_folder = "D://LangChain//data"  # Assuming "data" is the folder containing your PDF files
+index_folder = "D://LangChain//faiss_index"  # The saved FAISS index of the data folder and its manifest
+
+# Function to identify the current content of the data folder
+def corpus_version(folder):
+    # Changes whenever a PDF is added, removed or modified, without reading the files
+    sha = hashlib.sha256()
+    for pdf_file in sorted(glob.glob(os.path.join(folder, "*.pdf"))):
+        stat = os.stat(pdf_file)
+        sha.update(f"{os.path.basename(pdf_file)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode("utf-8"))
+    return sha.hexdigest()[:16]
+
+# FAISS has no empty index: it is created by the first file that has chunks, and saved after every file
+class FAISSSink(ChunkSink):
+    def __init__(self, db, embeddings, splitter, index_path):
+        super().__init__(db, splitter)
+        self.embeddings = embeddings
+        self.index_path = index_path
+
+    def add(self, items):
+        chunks, ids = items
+        if chunks and self.vectorstore is None:
+            self.vectorstore = FAISS.from_documents(chunks, self.embeddings, ids=ids)
+        else:
+            super().add(items)
+
+    def delete(self, ids):
+        if self.vectorstore is not None:
+            super().delete(ids)
+
+    def persist(self):
+        if self.vectorstore is not None:
+            self.vectorstore.save_local(self.index_path)
+
+# Function to bring the FAISS index up to date with the data folder, once per version and kept across reruns
+# Only the chunks of the new and modified files are embedded, the ones of the removed files are deleted
+@st.cache_resource(show_spinner="Loading the document index...", max_entries=1)
+def load_vector_store(folder, version):
+    embeddings = OpenAIEmbeddings()
+    index_path = os.path.join(index_folder, "index")
+    manifest_path = os.path.join(index_folder, "manifest.json")
+    db = None
+    if os.path.exists(os.path.join(index_path, "index.faiss")):
+        db = FAISS.load_local(index_path, embeddings)
+    elif os.path.exists(manifest_path):
+        # The index is gone, the manifest does not describe anything anymore
+        os.remove(manifest_path)
+
     # Split the documents into chunks
     text_splitter = CharacterTextSplitter(chunk_size=1000, chunk_overlap=0)
-    docs = text_splitter.split_documents(all_pages)
-    
-    if not docs:
-        st.error("No documents found after splitting. Please check the PDF files.")
-        return None
-    
-    # Create embeddings
-    embeddings = OpenAIEmbeddings()
-    doc_texts = [doc.page_content for doc in docs]
-    doc_embeddings = embeddings.embed_documents(doc_texts)
-    
-    if not doc_embeddings:
-        st.error("Failed to generate embeddings. Please check the OpenAI API key and usage.")
+    sink = FAISSSink(db, embeddings, text_splitter, index_path)
+    # Streamlit executes this script as __main__ and spawned workers would run it again: the pages are extracted
+    # in this process
+    ingest(folder, sink, manifest_path, num_workers=1)
+    return sink.vectorstore
+
+def create_vector_store_from_pdfs(uploaded_file, question):
+    db = load_vector_store(data_folder, corpus_version(data_folder))
+    if db is None:
+        st.error("No documents found in the data folder. Please check the PDF files.")
         return None
     
-    # Initiate the FAISS Database
-    db = FAISS.from_documents(docs, embeddings)
-    
-    # Perform similarity search
+    # Perform similarity search, only the question is embedded
     query = question
     matched_docs = db.similarity_search(query)
     
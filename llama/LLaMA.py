@@ -1,5 +1,9 @@
-from typing import Optional
+from typing import AsyncIterator, Iterator, Optional, Union
+import asyncio
+import atexit
+import math
 import torch
+import torch.distributed as dist
 import time
 from pathlib import Path
 import json
@@ -7,6 +11,13 @@ from sentencepiece import SentencePieceProcessor
 from tqdm import tqdm
 
 from model import ModelArgs, Transformer
+from checkpoint import load_state_dict
+from quantize import load_quantization_config, quantize_model
+from prefix_cache import PrefixCache
+from speculative import SpeculativeStats, speculative_generate
+from tensor_parallel import TensorParallelTransformer, launch_workers, shard_state_dict
+from streaming import CompletionStream, trim_to_text
+from sampling import Sampler, SamplingParams
 
 class LLaMA:
 
@@ -14,24 +25,25 @@ class LLaMA:
         self.model = model
         self.tokenizer = tokenizer
         self.args = model_args
+        # Set to a PrefixCache to reuse the keys and values of prompt prefixes across calls
+        self.prefix_cache: Optional[PrefixCache] = None
+        # Acceptance metrics of the last speculative text_completion
+        self.speculative_stats: Optional[SpeculativeStats] = None
+        self.sampler = Sampler()
 
     @staticmethod
-    def build(checkpoints_dir: str, tokenizer_path: str, load_model: bool, max_seq_len: int, max_batch_size: int, device: str):
+    def build(checkpoints_dir: str, tokenizer_path: str, load_model: bool, max_seq_len: int, max_batch_size: int, device: str, kv_cache_block_size: Optional[int] = None, kv_cache_window: Optional[int] = None, kv_cache_sink_tokens: int = 4, model_parallel_size: int = 1):
         prev_time = time.time()
-        if load_model:
-            checkpoints = sorted(Path(checkpoints_dir).glob("*.pth"))
-            assert len(checkpoints) > 0, f"no checkpoint files found in {checkpoints_dir}"
-            ckpt_path = checkpoints[0]
-            print(f'Loading checkpoint "{ckpt_path}"')
-            checkpoint = torch.load(ckpt_path, map_location="cpu")
-            print(f"Loaded checkpoint in {time.time() - prev_time:.2f}s")
-            prev_time = time.time()
         with open(Path(checkpoints_dir)/"params.json", "r") as f:
             params = json.loads(f.read())
 
         model_args: ModelArgs = ModelArgs(
             max_seq_len=max_seq_len,
             max_batch_size=max_batch_size,
+            kv_cache_block_size=kv_cache_block_size,
+            kv_cache_window=kv_cache_window,
+            kv_cache_sink_tokens=kv_cache_sink_tokens,
+            model_parallel_size=model_parallel_size,
             device=device,
             **params
         )
@@ -39,34 +51,152 @@ class LLaMA:
         tokenizer = SentencePieceProcessor()
         tokenizer.load(tokenizer_path)
         model_args.vocab_size = tokenizer.vocab_size()
+        print(f"Loaded tokenizer in {time.time() - prev_time:.2f}s")
         
         if device == "cuda":
             torch.set_default_tensor_type(torch.cuda.HalfTensor)
         else:
             torch.set_default_tensor_type(torch.BFloat16Tensor)
-        
-        model = Transformer(model_args).to(device)
 
         if load_model:
-            # The only unmatched key in the checkpoint is rope.freqs. Remove it
-            del checkpoint['rope.freqs']
-            model.load_state_dict(checkpoint, strict=True)
-            print(f"Loaded state dict in {time.time() - prev_time:.2f}s")
+            workers = []
+            if model_args.model_parallel_size > 1:
+                # The other ranks load their own shard of the checkpoint in parallel
+                workers = launch_workers(checkpoints_dir, model_args)
+            model = LLaMA.load_model(checkpoints_dir, model_args)
+            if model_args.model_parallel_size > 1:
+                model.workers = workers
+                atexit.register(model.shutdown)
+        else:
+            assert model_parallel_size == 1, "tensor parallelism needs a checkpoint"
+            model = Transformer(model_args).to(device)
         
         return LLaMA(model, tokenizer, model_args)
 
-    def text_completion(self, prompts: list[str], temperature: float = 0.6, top_p: float = 0.9, max_gen_len: Optional[int] = None):
+    @staticmethod
+    def load_model(checkpoints_dir: str, model_args: ModelArgs) -> Transformer:
+        # With tensor parallelism, every process (see tensor_parallel.py) loads its own shard
+        state_dict = load_state_dict(checkpoints_dir)
+        prev_time = time.time()
+        model_class = Transformer
+        if model_args.model_parallel_size > 1:
+            model_class = TensorParallelTransformer
+            state_dict = shard_state_dict(state_dict, model_args, dist.get_rank())
+        # The weights come from the checkpoint: create the modules on the meta device, so that nothing is allocated or randomly initialized
+        with torch.device("meta"):
+            model = model_class(model_args)
+            quantization = load_quantization_config(checkpoints_dir)
+            if quantization is not None:
+                # Checkpoint written by quantize.py: swap the linear layers for quantized ones before binding
+                quantize_model(model, quantization["bits"], quantization["group_size"], from_weights=False)
+        print(f"Built model in {time.time() - prev_time:.2f}s")
+        prev_time = time.time()
+        # Bind the (memory-mapped) checkpoint tensors as the parameters instead of copying them into new ones
+        model.load_state_dict(state_dict, strict=True, assign=True)
+        model.init_cache()
+        # Only copies if the checkpoint is not already in the requested dtype and device
+        model = model.to(device=model_args.device, dtype=torch.get_default_dtype())
+        print(f"Loaded state dict in {time.time() - prev_time:.2f}s")
+        return model
+
+    def text_completion(self, prompts: list[str], temperature: float = 0.6, top_p: float = 0.9, max_gen_len: Optional[int] = None, prefill_chunk_size: int = 512, draft_model: Optional[Transformer] = None, num_draft_tokens: int = 4, sampling_params: Union[SamplingParams, list[SamplingParams], None] = None):
+        # sampling_params, when given, replaces temperature and top_p: either the same for every prompt or one per prompt,
+        # each with its own max_tokens (max_gen_len by default), stop strings and stop tokens
+        sampling_params = self._sampling_params(prompts, temperature, top_p, sampling_params)
+        if max_gen_len is None:
+            max_gen_len = self.args.max_seq_len - 1
+        prompt_tokens = self._encode_prompts(prompts)
+
+        if draft_model is not None:
+            # Speculative decoding: the draft model proposes num_draft_tokens tokens, this model verifies them in one pass.
+            # It needs the full distributions to accept the proposals, so only the temperature and top p apply
+            assert all(params == sampling_params[0] for params in sampling_params), "speculative decoding needs the same sampling parameters for every prompt"
+            defaults = SamplingParams()
+            assert (sampling_params[0].top_k, sampling_params[0].min_p, sampling_params[0].repetition_penalty, sampling_params[0].frequency_penalty) == \
+                (defaults.top_k, defaults.min_p, defaults.repetition_penalty, defaults.frequency_penalty), "speculative decoding only supports temperature and top_p"
+            assert not sampling_params[0].stop and not sampling_params[0].stop_token_ids, "speculative decoding does not support stop strings or stop tokens"
+            out_tokens, self.speculative_stats = speculative_generate(
+                self.model, draft_model, prompt_tokens, self.tokenizer.eos_id(), sampling_params[0].temperature, sampling_params[0].top_p,
+                max_gen_len if sampling_params[0].max_tokens is None else sampling_params[0].max_tokens, num_draft_tokens, prefill_chunk_size
+            )
+            print(f"Draft acceptance rate {self.speculative_stats.acceptance_rate:.2%}, "
+                  f"{self.speculative_stats.tokens_per_target_forward:.2f} tokens per forward pass")
+            return (out_tokens, [self.tokenizer.decode(t) for t in out_tokens])
+
+        eos_id = self.tokenizer.eos_id()
+        out_tokens = [list(t) for t in prompt_tokens]
+        completions = [""] * len(prompts)
+        for _, outputs in self._generate(prompt_tokens, sampling_params, max_gen_len, prefill_chunk_size):
+            for prompt_index, output in enumerate(outputs):
+                if output is None:
+                    continue
+                token, text, _ = output
+                # Cut to the EOS (or stop) token, if present
+                if token != eos_id and token not in sampling_params[prompt_index].stop_token_ids:
+                    out_tokens[prompt_index].append(token)
+                completions[prompt_index] += text
+        for k, prompt in enumerate(prompt_tokens):
+            if len(sampling_params[k].stop) > 0:
+                # A stop string cuts the text, the tokens are cut to match
+                out_tokens[k] = prompt + trim_to_text(self.tokenizer, prompt, out_tokens[k][len(prompt):], completions[k])
+        out_text = [self.tokenizer.decode(t) + completion for t, completion in zip(prompt_tokens, completions)]
+        return (out_tokens, out_text)
+
+    def stream_completion(self, prompts: list[str], temperature: float = 0.6, top_p: float = 0.9, max_gen_len: Optional[int] = None, prefill_chunk_size: int = 512, sampling_params: Union[SamplingParams, list[SamplingParams], None] = None) -> Iterator[tuple[int, str]]:
+        # Yields (prompt index, new text) as soon as a sequence produces printable text, the prompts are not repeated
+        sampling_params = self._sampling_params(prompts, temperature, top_p, sampling_params)
         if max_gen_len is None:
             max_gen_len = self.args.max_seq_len - 1
+        prompt_tokens = self._encode_prompts(prompts)
+        for _, outputs in self._generate(prompt_tokens, sampling_params, max_gen_len, prefill_chunk_size):
+            for prompt_index, output in enumerate(outputs):
+                if output is not None and len(output[1]) > 0:
+                    yield prompt_index, output[1]
+
+    async def astream_completion(self, prompts: list[str], **kwargs) -> AsyncIterator[tuple[int, str]]:
+        # Same as stream_completion, with the forward passes running in a worker thread so the event loop stays responsive
+        loop = asyncio.get_running_loop()
+        stream = self.stream_completion(prompts, **kwargs)
+        end = object()
+        while True:
+            item = await loop.run_in_executor(None, next, stream, end)
+            if item is end:
+                break
+            yield item
+
+    def _encode_prompts(self, prompts: list[str]) -> list[list[int]]:
         # Convert each prompt into tokens
         prompt_tokens = [self.tokenizer.encode(prompt, out_type=int, add_bos=True, add_eos=False) for prompt in prompts]
         # Make sure the batch size is not too large
-        batch_size = len(prompt_tokens)
-        assert batch_size <= self.args.max_batch_size, f"batch size must be less than or equal to {self.args.max_batch_size}"
-        max_prompt_len = max(len(prompt) for prompt in prompt_tokens)
+        assert len(prompt_tokens) <= self.args.max_batch_size, f"batch size must be less than or equal to {self.args.max_batch_size}"
         # Make sure the prompt length is not larger than the maximum sequence length
-        assert max_prompt_len <= self.args.max_seq_len, f"prompt length must be less than or equal to {self.args.max_seq_len}"
-        total_len = min(self.args.max_seq_len, max_gen_len + max_prompt_len)
+        max_prompt_len = max(len(prompt) for prompt in prompt_tokens)
+        assert max_prompt_len <= self._max_total_len(), f"prompt length must be less than or equal to {self.args.max_seq_len}"
+        return prompt_tokens
+
+    def _max_total_len(self) -> Union[int, float]:
+        # With a rolling KV cache the sequences are not limited by max_seq_len, the oldest tokens leave the cache instead
+        return self.args.max_seq_len if self.args.kv_cache_window is None else math.inf
+
+    def _sampling_params(self, prompts: list[str], temperature: float, top_p: float, sampling_params: Union[SamplingParams, list[SamplingParams], None]) -> list[SamplingParams]:
+        # One SamplingParams per prompt
+        if sampling_params is None:
+            sampling_params = SamplingParams(temperature=temperature, top_p=top_p)
+        if isinstance(sampling_params, SamplingParams):
+            return [sampling_params] * len(prompts)
+        assert len(sampling_params) == len(prompts), "sampling_params must have one entry per prompt"
+        return list(sampling_params)
+
+    def _generate(self, prompt_tokens: list[list[int]], sampling_params: list[SamplingParams], max_gen_len: int, prefill_chunk_size: int) -> Iterator[tuple[int, list[Optional[tuple[int, str, bool]]]]]:
+        # Yields after every forward pass the position that was just filled and, for every row, either None if the position
+        # is still part of the prompt or the row is finished, or the token generated at that position (EOS included),
+        # the text it adds to the completion and whether the row just finished
+        device = self.args.device
+        batch_size = len(prompt_tokens)
+        # Every row stops after its own number of tokens
+        max_tokens = [max_gen_len if params.max_tokens is None else params.max_tokens for params in sampling_params]
+        min_prompt_len = min(len(prompt) for prompt in prompt_tokens)
+        total_len = min(self._max_total_len(), max(len(prompt) + n for prompt, n in zip(prompt_tokens, max_tokens)))
 
         # Create the list that will contain the generated tokens, along with the initial prompt tokens
         pad_id = self.tokenizer.pad_id()
@@ -75,58 +205,71 @@ class LLaMA:
             # Populate the initial tokens with the prompt tokens
             tokens[k, : len(t)] = torch.tensor(t, dtype=torch.long, device=device)
         
-        eos_reached = torch.tensor([False] * batch_size, device=device)
+        finished = [False] * batch_size
         prompt_tokens_mask = tokens != pad_id # True if the token is a prompt token, False otherwise
-        cur_iterator = tqdm(range(1, total_len), desc="Generating tokens")
-        for cur_pos in cur_iterator:
-            with torch.no_grad():
-                logits = self.model.forward(tokens[:, cur_pos-1:cur_pos], cur_pos)
-            if temperature > 0:
-                # The temperature is applied before the softmax
-                probs = torch.softmax(logits[:, -1] / temperature, dim=-1)
-                next_token = self._sample_top_p(probs, top_p)
-            else:
-                # Greedily select the token with the max probability
-                next_token = torch.argmax(logits[:, -1], dim=-1)
-
-            next_token = next_token.reshape(-1)
-            # Only replace token if it is a padding token
-            next_token = torch.where(prompt_tokens_mask[:, cur_pos], tokens[:, cur_pos], next_token)
-            tokens[:, cur_pos] = next_token
-            # EOS is reached only if we found an EOS token for a padding position
-            eos_reached |= (~prompt_tokens_mask[:, cur_pos]) & (next_token == self.tokenizer.eos_id)
-            if all(eos_reached):
-                break
+        # The tokens generated so far by each row, for the repetition and frequency penalties
+        output_tokens = [[] for _ in range(batch_size)]
+        # Incremental detokenization and stop conditions of each row
+        streams = [
+            CompletionStream(self.tokenizer, t, params.stop, params.stop_token_ids)
+            for t, params in zip(prompt_tokens, sampling_params)
+        ]
+        # The first step prefills the prompt tokens shared by the whole batch in a single pass,
+        # every following step feeds the single token produced (or forced from a longer prompt) by the previous one
+        prev_pos = 0
+        if self.prefix_cache is not None:
+            # Copy the cached prompt prefixes into the cache rows, the prefill starts after the shortest one
+            prev_pos = min(self.prefix_cache.load(k, t) for k, t in enumerate(prompt_tokens))
+        try:
+            cur_iterator = tqdm(range(min_prompt_len, total_len), desc="Generating tokens")
+            for cur_pos in cur_iterator:
+                with torch.no_grad():
+                    logits = self._forward_chunked(tokens[:, prev_pos:cur_pos], prev_pos, prefill_chunk_size)
+                # The rows still in their prompt sample a token too, it is replaced by the prompt token below
+                next_token = self.sampler(logits[:, -1], sampling_params, prompt_tokens, output_tokens)
+                # Only replace token if it is a padding token
+                next_token = torch.where(prompt_tokens_mask[:, cur_pos], tokens[:, cur_pos], next_token)
+                tokens[:, cur_pos] = next_token
+                prev_pos = cur_pos
 
-        out_tokens = []
-        out_text = []
-        for prompt_index, current_prompt_tokens in enumerate(tokens.tolist()):
-            # Cut to the EOS token, if present
-            if self.tokenizer.eos_id in current_prompt_tokens:
-                eos_idx = current_prompt_tokens.index(self.tokenizer.eos_id)
-                current_prompt_tokens = current_prompt_tokens[:eos_idx]
-            out_tokens.append(current_prompt_tokens)
-            out_text.append(self.tokenizer.decode(current_prompt_tokens))
-        return (out_tokens, out_text)
-    
-    def _sample_top_p(self, probs, p):
-        # (B, vocab_size)
-        probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
-        # (B, vocab_size)
-        probs_sum = torch.cumsum(probs_sort, dim=-1)
-        # (B, vocab_size)
-        # (Substracting "probs_sort" shifts the cumulative sum by 1 position to the right before masking)
-        mask = probs_sum - probs_sort > p 
-        # Zero out all the probabilities of tokens that are not selected by the Top P
-        probs_sort[mask] = 0.0 
-        # Redistribute the probabilities so that they sum up to 1.
-        probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
-        # Sample a token (its index) from the top p distribution
-        next_token = torch.multinomial(probs_sort, num_samples=1)
-        # Get the token position in the vocabulary corresponding to the sampled index
-        next_token = torch.gather(probs_idx, -1, next_token) 
-        return next_token
+                outputs = []
+                for k, (token, in_prompt) in enumerate(zip(next_token.tolist(), prompt_tokens_mask[:, cur_pos].tolist())):
+                    if in_prompt or finished[k]:
+                        outputs.append(None)
+                        continue
+                    output_tokens[k].append(token)
+                    text = streams[k].step(token)
+                    # EOS, a stop token or a stop string, or no tokens left
+                    finished[k] = (
+                        streams[k].finished
+                        or len(output_tokens[k]) >= max_tokens[k]
+                        or len(prompt_tokens[k]) + len(output_tokens[k]) >= self._max_total_len()
+                    )
+                    if finished[k]:
+                        text += streams[k].finish()
+                    outputs.append((token, text, finished[k]))
+                yield cur_pos, outputs
+                if all(finished):
+                    break
+        finally:
+            # Also runs when the caller stops iterating early
+            if self.prefix_cache is not None:
+                # The positions [0, prev_pos) of every row are in the cache by now
+                for k, t in enumerate(prompt_tokens):
+                    self.prefix_cache.store(k, t[:prev_pos])
+            self.model.release(list(range(batch_size)))
 
+    def _forward_chunked(self, tokens: torch.Tensor, start_pos: int, chunk_size: int):
+        # (B, Seq_Len) -> (B, 1, vocab_size)
+        # Long prompts are prefilled in chunks, so the (Seq_Len, Seq_Len_KV) attention scores stay bounded in memory
+        seq_len = tokens.shape[1]
+        if self.args.kv_cache_window is not None:
+            # The prompt can be longer than max_seq_len, but a single forward pass can't
+            chunk_size = min(chunk_size, self.args.max_seq_len)
+        for chunk_start in range(0, seq_len, chunk_size):
+            logits = self.model.forward(tokens[:, chunk_start:chunk_start + chunk_size], start_pos + chunk_start)
+        # Only the prediction for the last position is needed to pick the next token
+        return logits[:, -1:]
 
 
 if __name__ == '__main__':
@@ -160,6 +303,8 @@ if __name__ == '__main__':
         max_batch_size=len(prompts),
         device=device
     )
+    # Few shot headers repeated across calls are only prefilled once
+    model.prefix_cache = PrefixCache(model.model)
 
     out_tokens, out_texts = (model.text_completion(prompts, max_gen_len=64))
     assert len(out_texts) == len(prompts)
@@ -0,0 +1,76 @@
+import argparse
+import time
+import torch
+
+from model import apply_rotary_embeddings, precompute_theta_pos_frequencies
+
+
+def apply_rotary_embeddings_complex(x: torch.Tensor, freqs_complex: torch.Tensor, device: str):
+    # The previous implementation, kept as the reference: float upcast, complex multiplication and copy back
+    x_complex = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
+    freqs_complex = freqs_complex.unsqueeze(-2)
+    x_rotated = x_complex * freqs_complex
+    x_out = torch.view_as_real(x_rotated)
+    x_out = x_out.reshape(*x.shape)
+    return x_out.type_as(x).to(device)
+
+
+def benchmark(fn, num_iters: int, device: str) -> float:
+    # Average time of a call in milliseconds
+    for _ in range(3):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    start_time = time.perf_counter()
+    for _ in range(num_iters):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start_time) / num_iters * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the rotary embeddings of one layer (Q and K)")
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--seq-len", type=int, default=1, help="1 for a decode step, the prompt length for a prefill")
+    parser.add_argument("--n-heads", type=int, default=32)
+    parser.add_argument("--n-kv-heads", type=int, default=32)
+    parser.add_argument("--head-dim", type=int, default=128)
+    parser.add_argument("--start-pos", type=int, default=512)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "bfloat16"])
+    parser.add_argument("--num-iters", type=int, default=1000)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    dtype = getattr(torch, args.dtype)
+    max_seq_len = args.start_pos + args.seq_len
+
+    # The tables the model precomputes now, and the complex ones it precomputed before
+    cos, sin = precompute_theta_pos_frequencies(args.head_dim, max_seq_len, device=device, dtype=dtype)
+    freqs_complex = torch.complex(*precompute_theta_pos_frequencies(args.head_dim, max_seq_len, device=device, dtype=torch.float32))
+    positions = slice(args.start_pos, args.start_pos + args.seq_len)
+
+    xq = torch.randn((args.batch_size, args.seq_len, args.n_heads, args.head_dim), dtype=dtype, device=device)
+    xk = torch.randn((args.batch_size, args.seq_len, args.n_kv_heads, args.head_dim), dtype=dtype, device=device)
+
+    # Both implementations must give the same result (up to the rounding of the tables in the model dtype)
+    expected = apply_rotary_embeddings_complex(xq, freqs_complex[positions], device)
+    actual = apply_rotary_embeddings(xq.clone(), cos[positions], sin[positions])
+    tolerance = 1e-5 if dtype == torch.float32 else 2e-2
+    max_error = (expected.float() - actual.float()).abs().max().item()
+    assert max_error < tolerance, f"max error {max_error} above {tolerance}"
+
+    def complex_layer():
+        apply_rotary_embeddings_complex(xq, freqs_complex[positions], device)
+        apply_rotary_embeddings_complex(xk, freqs_complex[positions], device)
+
+    def real_layer():
+        # Rotating the same activations again and again only changes their values, not the work done
+        apply_rotary_embeddings(xq, cos[positions], sin[positions])
+        apply_rotary_embeddings(xk, cos[positions], sin[positions])
+
+    complex_ms = benchmark(complex_layer, args.num_iters, device)
+    real_ms = benchmark(real_layer, args.num_iters, device)
+    print(f"{device} {args.dtype}, Q {tuple(xq.shape)}, K {tuple(xk.shape)}")
+    print(f"complex rotary: {complex_ms * 1000:.1f}us per layer")
+    print(f"real cos/sin rotary: {real_ms * 1000:.1f}us per layer ({complex_ms / real_ms:.2f}x)")
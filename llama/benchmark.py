@@ -0,0 +1,234 @@
+import argparse
+import itertools
+import json
+import platform
+import resource
+import sys
+import time
+import torch
+import torch.nn as nn
+
+from model import ModelArgs, RMSNorm, Transformer
+from quantize import QuantizedLinear, quantize_model
+from LLaMA import LLaMA
+from sampling import SamplingParams
+from static_decode import StaticDecoder
+
+
+class StubTokenizer:
+    # Stands in for the SentencePieceProcessor, so that no tokenizer.model is needed: every byte is a token.
+    # EOS is never sampled, so every sequence generates exactly the requested number of tokens
+
+    def __init__(self, vocab_size: int):
+        self._vocab_size = vocab_size
+
+    def encode(self, text: str, out_type=int, add_bos: bool = True, add_eos: bool = False) -> list[int]:
+        return ([self.bos_id()] if add_bos else []) + [3 + b for b in text.encode("utf-8")]
+
+    def decode(self, tokens: list[int]) -> str:
+        return "".join(chr(t % 128) for t in tokens)
+
+    def vocab_size(self) -> int:
+        return self._vocab_size
+
+    def bos_id(self) -> int:
+        return 1
+
+    def eos_id(self) -> int:
+        return -1
+
+    def pad_id(self) -> int:
+        return -1
+
+
+def peak_rss_mb() -> float:
+    # Peak resident memory of the whole process so far (kilobytes on Linux, bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == "darwin" else peak / (1 << 10)
+
+
+def percentile(values: list[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def build_model(model_args: ModelArgs, bits: int, group_size: int) -> Transformer:
+    if bits == 16:
+        return Transformer(model_args)
+    # Built and quantized on the meta device, so the full precision weights never take memory and the
+    # peak RSS is the one of the quantized model
+    with torch.device("meta"):
+        model = Transformer(model_args)
+        quantize_model(model, bits, group_size, from_weights=False)
+    model = model.to_empty(device="cpu")
+    with torch.no_grad():
+        for module in model.modules():
+            if isinstance(module, QuantizedLinear):
+                # Random weights of about the same magnitude as the nn.Linear initialization
+                if bits == 8:
+                    module.qweight.random_(-127, 128)
+                else:
+                    module.qweight.random_(0, 256)
+                module.scales.fill_(module.in_features ** -0.5 / (127 if bits == 8 else 7))
+            elif isinstance(module, nn.Embedding):
+                nn.init.normal_(module.weight)
+            elif isinstance(module, RMSNorm):
+                module.weight.fill_(1.0)
+    model.init_cache()
+    return model
+
+
+def run(model_args: ModelArgs, batch_size: int, prompt_len: int, gen_len: int, prefill_chunk_size: int, bits: int = 16, group_size: int = 128) -> dict:
+    torch.manual_seed(0)
+    model = build_model(model_args, bits, group_size)
+    llama = LLaMA(model, StubTokenizer(model_args.vocab_size), model_args)
+    prompt_tokens = torch.randint(3, model_args.vocab_size, (batch_size, prompt_len)).tolist()
+    sampling_params = SamplingParams(max_tokens=gen_len)
+    # Warm up the allocator and the kernels on a couple of tokens
+    for _ in llama._generate(prompt_tokens, [SamplingParams(max_tokens=2)] * batch_size, 2, prefill_chunk_size):
+        pass
+
+    # Time of every forward pass: the first one prefills the prompts and samples the first token, the others decode
+    step_times = []
+    start_time = time.perf_counter()
+    for _ in llama._generate(prompt_tokens, [sampling_params] * batch_size, gen_len, prefill_chunk_size):
+        now = time.perf_counter()
+        step_times.append(now - start_time)
+        start_time = now
+
+    return summarize(model, batch_size, prompt_len, step_times)
+
+
+def run_static(model_args: ModelArgs, batch_size: int, prompt_len: int, gen_len: int, prefill_chunk_size: int, compile: bool, bits: int = 16, group_size: int = 128) -> dict:
+    # Same measurements, with the decode steps going through the StaticDecoder (whole cache, masked, maybe compiled)
+    torch.manual_seed(0)
+    model = build_model(model_args, bits, group_size)
+    llama = LLaMA(model, StubTokenizer(model_args.vocab_size), model_args)
+    # Before any prefill: the warm-up writes dummy entries into the cache
+    decoder = StaticDecoder(model, compile)
+    prompt_tokens = torch.randint(3, model_args.vocab_size, (batch_size, prompt_len))
+    params = [SamplingParams()] * batch_size
+    slots = list(range(batch_size))
+
+    step_times = []
+    start_time = time.perf_counter()
+    for chunk_start in range(0, prompt_len, prefill_chunk_size):
+        logits = model.forward(prompt_tokens[:, chunk_start:chunk_start + prefill_chunk_size], chunk_start)
+    next_tokens = llama.sampler(logits[:, -1], params).tolist()
+    step_times.append(time.perf_counter() - start_time)
+    for pos in range(prompt_len, prompt_len + gen_len - 1):
+        start_time = time.perf_counter()
+        next_tokens = llama.sampler(decoder(next_tokens, [pos] * batch_size, slots), params).tolist()
+        step_times.append(time.perf_counter() - start_time)
+
+    metrics = summarize(model, batch_size, prompt_len, step_times)
+    metrics.update(compiled=decoder.compiled, compile_time_s=decoder.compile_time)
+    return metrics
+
+
+def weights_mb(model: Transformer) -> float:
+    tensors = [t for t in itertools.chain(model.parameters(), model.buffers()) if t.device.type != "meta"]
+    tensors += [m._int4pack["packed"] for m in model.modules() if isinstance(m, QuantizedLinear) and "packed" in m._int4pack]
+    return sum(t.numel() * t.element_size() for t in tensors) / (1 << 20)
+
+
+def summarize(model: Transformer, batch_size: int, prompt_len: int, step_times: list[float]) -> dict:
+    time_to_first_token = step_times[0]
+    decode_times = step_times[1:]
+    return {
+        "prefill_tokens_per_second": batch_size * prompt_len / time_to_first_token,
+        "decode_tokens_per_second": batch_size * len(decode_times) / sum(decode_times) if len(decode_times) > 0 else None,
+        "time_to_first_token_ms": time_to_first_token * 1000,
+        "token_latency_p50_ms": percentile(decode_times, 50) * 1000 if len(decode_times) > 0 else None,
+        "token_latency_p99_ms": percentile(decode_times, 99) * 1000 if len(decode_times) > 0 else None,
+        "num_parameters": sum(p.numel() for p in model.parameters()),
+        # Parameters and buffers (the quantized weights are buffers, replaced by their int4 kernel packing when it is used), the KV caches excluded
+        "weights_mb": weights_mb(model),
+        # Peak of the whole process: run one configuration per process to compare it across configurations
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark generation with random weights on the CPU, every combination of the given values is run")
+    parser.add_argument("--dim", type=int, nargs="+", default=[512])
+    parser.add_argument("--n-layers", type=int, nargs="+", default=[4])
+    parser.add_argument("--n-heads", type=int, nargs="+", default=[8])
+    parser.add_argument("--n-kv-heads", type=int, nargs="+", default=[8])
+    parser.add_argument("--batch-size", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--prompt-len", type=int, nargs="+", default=[128])
+    parser.add_argument("--gen-len", type=int, default=64)
+    parser.add_argument("--vocab-size", type=int, default=32000)
+    parser.add_argument("--kv-cache-block-size", type=int, default=None)
+    parser.add_argument("--kv-cache-window", type=int, default=None,
+                        help="rolling KV cache of this many recent positions (dynamic mode only), smaller than prompt + gen len to decode past it")
+    parser.add_argument("--kv-cache-sink-tokens", type=int, default=4)
+    parser.add_argument("--prefill-chunk-size", type=int, default=512)
+    parser.add_argument("--decode-mode", nargs="+", default=["dynamic"], choices=["dynamic", "static", "static-compiled"],
+                        help="dynamic: the regular decode, static: fixed-shape steps (dense cache only), static-compiled: the same with torch.compile")
+    parser.add_argument("--bits", type=int, nargs="+", default=[16], choices=[16, 8, 4], help="16 for the unquantized model, 8 / 4 for weight-only int8 / int4")
+    parser.add_argument("--group-size", type=int, default=128, help="inputs sharing a scale with --bits 4")
+    parser.add_argument("--dtype", default="float32", choices=["float32", "bfloat16"], help="dtype of the activations and unquantized weights (the int4 kernel needs bfloat16)")
+    parser.add_argument("--threads", type=int, default=None, help="torch.set_num_threads, all the cores by default")
+    parser.add_argument("--output", default=None, help="JSON file for the results, printed if not given")
+    args = parser.parse_args()
+    if args.kv_cache_window is not None and args.decode_mode != ["dynamic"]:
+        parser.error("--kv-cache-window only works with --decode-mode dynamic")
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    torch.set_default_dtype(getattr(torch, args.dtype))
+
+    results = []
+    for dim, n_layers, n_heads, n_kv_heads, batch_size, prompt_len, decode_mode, bits in itertools.product(
+        args.dim, args.n_layers, args.n_heads, args.n_kv_heads, args.batch_size, args.prompt_len, args.decode_mode, args.bits
+    ):
+        model_args = ModelArgs(
+            dim=dim,
+            n_layers=n_layers,
+            n_heads=n_heads,
+            n_kv_heads=n_kv_heads,
+            vocab_size=args.vocab_size,
+            max_batch_size=batch_size,
+            max_seq_len=prompt_len + args.gen_len,
+            kv_cache_block_size=args.kv_cache_block_size,
+            kv_cache_window=args.kv_cache_window,
+            kv_cache_sink_tokens=args.kv_cache_sink_tokens,
+            device="cpu",
+        )
+        config = {
+            "dim": dim,
+            "n_layers": n_layers,
+            "n_heads": n_heads,
+            "n_kv_heads": n_kv_heads,
+            "vocab_size": args.vocab_size,
+            "batch_size": batch_size,
+            "prompt_len": prompt_len,
+            "gen_len": args.gen_len,
+            "kv_cache_block_size": args.kv_cache_block_size,
+            "kv_cache_window": args.kv_cache_window,
+            "decode_mode": decode_mode,
+            "bits": bits,
+            "dtype": args.dtype,
+        }
+        with torch.no_grad():
+            if decode_mode == "dynamic":
+                metrics = run(model_args, batch_size, prompt_len, args.gen_len, args.prefill_chunk_size, bits, args.group_size)
+            else:
+                metrics = run_static(model_args, batch_size, prompt_len, args.gen_len, args.prefill_chunk_size, decode_mode == "static-compiled", bits, args.group_size)
+        print(f"{config} -> {metrics}", file=sys.stderr)
+        results.append({"config": config, "metrics": metrics})
+
+    report = {
+        "torch_version": torch.__version__,
+        "python_version": platform.python_version(),
+        "machine": platform.machine(),
+        "num_threads": torch.get_num_threads(),
+        "results": results,
+    }
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as f:
+            f.write(json.dumps(report, indent=2))
+        print(f'Saved results to "{args.output}"', file=sys.stderr)
@@ -0,0 +1,42 @@
+from pathlib import Path
+import argparse
+import time
+import torch
+
+
+def load_state_dict(checkpoints_dir: str) -> dict[str, torch.Tensor]:
+    # Opens the checkpoint without reading it all in memory: a safetensors file (see convert_to_safetensors) or
+    # the original .pth are memory-mapped, so their tensors are only paged in when they are used
+    prev_time = time.time()
+    safetensors_files = sorted(Path(checkpoints_dir).glob("*.safetensors"))
+    if len(safetensors_files) > 0:
+        from safetensors.torch import load_file
+        ckpt_path = safetensors_files[0]
+        state_dict = load_file(ckpt_path, device="cpu")
+    else:
+        checkpoints = sorted(Path(checkpoints_dir).glob("*.pth"))
+        assert len(checkpoints) > 0, f"no checkpoint files found in {checkpoints_dir}"
+        ckpt_path = checkpoints[0]
+        state_dict = torch.load(ckpt_path, map_location="cpu", mmap=True, weights_only=True)
+    # The only unmatched key in the checkpoint is rope.freqs. Remove it
+    state_dict.pop("rope.freqs", None)
+    print(f'Opened checkpoint "{ckpt_path}" in {time.time() - prev_time:.2f}s')
+    return state_dict
+
+
+def convert_to_safetensors(checkpoints_dir: str):
+    # One-off conversion of the original .pth next to it, LLaMA.build then picks the .safetensors file up
+    from safetensors.torch import save_file
+    checkpoints = sorted(Path(checkpoints_dir).glob("*.pth"))
+    assert len(checkpoints) > 0, f"no checkpoint files found in {checkpoints_dir}"
+    state_dict = torch.load(checkpoints[0], map_location="cpu", mmap=True, weights_only=True)
+    state_dict.pop("rope.freqs", None)
+    out_path = checkpoints[0].with_suffix(".safetensors")
+    save_file({name: tensor.contiguous() for name, tensor in state_dict.items()}, str(out_path))
+    print(f'Saved "{out_path}"')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a LLaMA .pth checkpoint to safetensors")
+    parser.add_argument("checkpoints_dir", help="directory with the .pth checkpoint and params.json")
+    convert_to_safetensors(parser.parse_args().checkpoints_dir)
@@ -0,0 +1,194 @@
+from typing import Optional, Union
+import math
+import torch
+
+
+class KVCache:
+    # Dense cache: every slot reserves room for max_seq_len positions up front.
+    # The keys are stored already rotated, with the heads first, so that reading them needs no transpose or copy
+    deferred_rotary = False
+
+    def __init__(self, max_batch_size: int, max_seq_len: int, n_kv_heads: int, head_dim: int):
+        # (Max_B, H_KV, Max_Seq_Len, Head_Dim)
+        self.cache_k = torch.zeros((max_batch_size, n_kv_heads, max_seq_len, head_dim))
+        self.cache_v = torch.zeros((max_batch_size, n_kv_heads, max_seq_len, head_dim))
+
+    def update(self, xk: torch.Tensor, xv: torch.Tensor, start_pos: Union[int, torch.Tensor], slots: Optional[torch.Tensor], kv_len: int):
+        # Writes the new (B, Seq_Len, H_KV, Head_Dim) entries and returns the (B, H_KV, Seq_Len_KV, Head_Dim) keys and values
+        batch_size, seq_len = xk.shape[:2]
+        if slots is None and isinstance(start_pos, int):
+            # Replace the entry in the cache
+            self.cache_k[:batch_size, :, start_pos : start_pos + seq_len] = xk.transpose(1, 2)
+            self.cache_v[:batch_size, :, start_pos : start_pos + seq_len] = xv.transpose(1, 2)
+            return self.cache_k[:batch_size, :, :kv_len], self.cache_v[:batch_size, :, :kv_len]
+
+        # Every row writes into its own cache slot at its own positions
+        # (B, Seq_Len)
+        positions = start_pos[:, None] + torch.arange(seq_len, device=xk.device)
+        # (B) Without slots (static-shape decode), row i of the batch is slot i
+        rows = torch.arange(batch_size, device=xk.device) if slots is None else slots
+        # The indexed dimensions come first: (B, Seq_Len, H_KV, Head_Dim), like xk
+        self.cache_k[rows[:, None], :, positions] = xk
+        self.cache_v[rows[:, None], :, positions] = xv
+        if slots is None:
+            # The rows are read in place, a view instead of a gather, always up to the same kv_len
+            return self.cache_k[:batch_size, :, :kv_len], self.cache_v[:batch_size, :, :kv_len]
+        # The rows are read up to the longest one, the mask hides what is past the end of the shorter ones
+        return self.cache_k[slots, :, :kv_len], self.cache_v[slots, :, :kv_len]
+
+    def read(self, slot: int, start: int, end: int):
+        # (Seq_Len, H_KV, Head_Dim) copies of the entries of a slot at the positions [start, end)
+        keys = self.cache_k[slot, :, start:end].transpose(0, 1).clone(memory_format=torch.contiguous_format)
+        values = self.cache_v[slot, :, start:end].transpose(0, 1).clone(memory_format=torch.contiguous_format)
+        return keys, values
+
+    def write(self, slot: int, start: int, keys: torch.Tensor, values: torch.Tensor):
+        # Stores (Seq_Len, H_KV, Head_Dim) entries into a slot from the position start
+        self.cache_k[slot, :, start : start + keys.shape[0]] = keys.transpose(0, 1)
+        self.cache_v[slot, :, start : start + values.shape[0]] = values.transpose(0, 1)
+
+
+class BlockAllocator:
+    # Hands out fixed-size blocks of cache positions to the slots. The block ids are shared by all the layers,
+    # each PagedKVCache keeps its own pool indexed by them
+
+    def __init__(self, block_size: int, device: str):
+        self.block_size = block_size
+        self.device = device
+        self.num_blocks = 0
+        self.free_blocks: list[int] = []
+        # slot -> ids of the blocks holding positions [0, block_size), [block_size, 2 * block_size), ...
+        self.block_tables: dict[int, list[int]] = {}
+
+        # Indices of the forward pass in progress, computed once by prepare() and used by every layer
+        # (B, N_Blocks)
+        self.block_table: Optional[torch.Tensor] = None
+        # (B, Seq_Len)
+        self.write_blocks: Optional[torch.Tensor] = None
+        # (B, Seq_Len)
+        self.write_offsets: Optional[torch.Tensor] = None
+
+    def _allocate(self) -> int:
+        if len(self.free_blocks) == 0:
+            # Grow the pools geometrically, so that the layers rarely have to reallocate them
+            new_num_blocks = max(16, 2 * self.num_blocks)
+            self.free_blocks.extend(range(new_num_blocks - 1, self.num_blocks - 1, -1))
+            self.num_blocks = new_num_blocks
+        return self.free_blocks.pop()
+
+    def reserve(self, slot: int, length: int):
+        # Make sure the slot owns enough blocks to hold the positions [0, length)
+        table = self.block_tables.setdefault(slot, [])
+        while len(table) * self.block_size < length:
+            table.append(self._allocate())
+
+    def free(self, slot: int):
+        self.free_blocks.extend(reversed(self.block_tables.pop(slot, [])))
+
+    def num_used_blocks(self) -> int:
+        return self.num_blocks - len(self.free_blocks)
+
+    def prepare(self, slots: list[int], start_pos: list[int], seq_len: int, kv_len: int):
+        for slot, pos in zip(slots, start_pos):
+            self.reserve(slot, pos + seq_len)
+        n_blocks = math.ceil(kv_len / self.block_size)
+        # Shorter rows are padded with block 0, the attention mask hides those positions anyway
+        table = [(self.block_tables[slot] + [0] * n_blocks)[:n_blocks] for slot in slots]
+        self.block_table = torch.tensor(table, dtype=torch.long, device=self.device)
+        # (B, Seq_Len)
+        positions = torch.tensor(start_pos, dtype=torch.long, device=self.device)[:, None] + torch.arange(seq_len, device=self.device)
+        self.write_blocks = self.block_table.gather(1, positions // self.block_size)
+        self.write_offsets = positions % self.block_size
+
+
+class PagedKVCache:
+    # Paged cache: the positions of a slot live in the blocks listed in its block table,
+    # so the memory grows with the tokens actually in use instead of max_batch_size * max_seq_len
+    deferred_rotary = False
+
+    def __init__(self, allocator: BlockAllocator, n_kv_heads: int, head_dim: int):
+        self.allocator = allocator
+        # (N_Blocks, Block_Size, H_KV, Head_Dim)
+        self.pool_k = torch.zeros((0, allocator.block_size, n_kv_heads, head_dim))
+        self.pool_v = torch.zeros((0, allocator.block_size, n_kv_heads, head_dim))
+
+    def _grow(self):
+        missing = self.allocator.num_blocks - self.pool_k.shape[0]
+        if missing > 0:
+            self.pool_k = torch.cat([self.pool_k, self.pool_k.new_zeros((missing, *self.pool_k.shape[1:]))])
+            self.pool_v = torch.cat([self.pool_v, self.pool_v.new_zeros((missing, *self.pool_v.shape[1:]))])
+
+    def update(self, xk: torch.Tensor, xv: torch.Tensor, start_pos: Union[int, torch.Tensor], slots: Optional[torch.Tensor], kv_len: int):
+        # Writes the new (B, Seq_Len, H_KV, Head_Dim) entries and returns the (B, H_KV, Seq_Len_KV, Head_Dim) keys and values
+        self._grow()
+        allocator = self.allocator
+        # (B, Seq_Len) block and offset of every new position
+        self.pool_k[allocator.write_blocks, allocator.write_offsets] = xk
+        self.pool_v[allocator.write_blocks, allocator.write_offsets] = xv
+        # (B, N_Blocks, Block_Size, H_KV, Head_Dim) -> (B, N_Blocks * Block_Size, H_KV, Head_Dim) -> (B, Seq_Len_KV, H_KV, Head_Dim)
+        keys = self.pool_k[allocator.block_table].flatten(1, 2)[:, :kv_len]
+        values = self.pool_v[allocator.block_table].flatten(1, 2)[:, :kv_len]
+        # The gather above already copies, the blocks keep the positions first and are only viewed with the heads first
+        # (B, Seq_Len_KV, H_KV, Head_Dim) -> (B, H_KV, Seq_Len_KV, Head_Dim)
+        return keys.transpose(1, 2), values.transpose(1, 2)
+
+    def _locate(self, slot: int, start: int, end: int):
+        # Block and offset of the positions [start, end) of a slot
+        positions = torch.arange(start, end, device=self.pool_k.device)
+        table = torch.tensor(self.allocator.block_tables[slot], dtype=torch.long, device=self.pool_k.device)
+        return table[positions // self.allocator.block_size], positions % self.allocator.block_size
+
+    def read(self, slot: int, start: int, end: int):
+        # (Seq_Len, H_KV, Head_Dim) copies of the entries of a slot at the positions [start, end)
+        blocks, offsets = self._locate(slot, start, end)
+        return self.pool_k[blocks, offsets], self.pool_v[blocks, offsets]
+
+    def write(self, slot: int, start: int, keys: torch.Tensor, values: torch.Tensor):
+        # Stores (Seq_Len, H_KV, Head_Dim) entries into a slot from the position start
+        self.allocator.reserve(slot, start + keys.shape[0])
+        self._grow()
+        blocks, offsets = self._locate(slot, start, start + keys.shape[0])
+        self.pool_k[blocks, offsets] = keys
+        self.pool_v[blocks, offsets] = values
+
+
+class RollingKVCache:
+    # Fixed-size cache for sequences longer than the cache itself: the first num_sinks positions (the attention sinks,
+    # which get a large share of the attention whatever they contain) are kept forever, followed by a ring buffer of the
+    # window most recent positions. The older ones are overwritten, so the memory never grows.
+    # The positions used by the rotary embeddings are the ones inside the cache and not in the sequence, so that they
+    # stay within the range seen in training: the keys are stored before the rotation and rotated when read
+    deferred_rotary = True
+
+    def __init__(self, max_batch_size: int, num_sinks: int, window: int, n_kv_heads: int, head_dim: int):
+        self.num_sinks = num_sinks
+        self.window = window
+        self.capacity = num_sinks + window
+        # (Max_B, H_KV, Num_Sinks + Window, Head_Dim)
+        self.cache_k = torch.zeros((max_batch_size, n_kv_heads, self.capacity, head_dim))
+        self.cache_v = torch.zeros((max_batch_size, n_kv_heads, self.capacity, head_dim))
+
+    def _index(self, positions: torch.Tensor) -> torch.Tensor:
+        # Sequence positions -> entries of the cache
+        return torch.where(positions < self.num_sinks, positions, self.num_sinks + (positions - self.num_sinks) % self.window)
+
+    def update(self, xk: torch.Tensor, xv: torch.Tensor, start_pos: Union[int, torch.Tensor], slots: Optional[torch.Tensor], kv_len: int):
+        # Returns the (B, H_KV, Num_Cached + Seq_Len, Head_Dim) unrotated keys and values visible to the new tokens: the cached
+        # ones in the order of the sequence, followed by the new ones, and then writes the new ones over the oldest entries
+        assert slots is None, "the rolling KV cache only supports rows at the same position"
+        batch_size, seq_len = xk.shape[:2]
+        device = xk.device
+        # (Num_Cached) The positions still in the cache: the sinks and the last window ones
+        sinks = torch.arange(min(start_pos, self.num_sinks), device=device)
+        recent = torch.arange(max(self.num_sinks, start_pos - self.window), start_pos, device=device)
+        index = self._index(torch.cat([sinks, recent]))
+        keys = torch.cat([self.cache_k[:batch_size, :, index], xk.transpose(1, 2)], dim=2)
+        values = torch.cat([self.cache_v[:batch_size, :, index], xv.transpose(1, 2)], dim=2)
+
+        # (Seq_Len) Of a chunk longer than the window, only the sinks and the last window positions are kept
+        positions = torch.arange(start_pos, start_pos + seq_len, device=device)
+        keep = (positions < self.num_sinks) | (positions >= start_pos + seq_len - self.window)
+        index = self._index(positions[keep])
+        self.cache_k[:batch_size, :, index] = xk[:, keep].transpose(1, 2)
+        self.cache_v[:batch_size, :, index] = xv[:, keep].transpose(1, 2)
+        return keys, values
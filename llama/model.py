@@ -1,9 +1,12 @@
 from dataclasses import dataclass
-from typing import Optional
+from typing import Optional, Union
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.distributed as dist
+
+from kv_cache import BlockAllocator, KVCache, PagedKVCache, RollingKVCache
 
 
 @dataclass
@@ -20,6 +23,16 @@ class ModelArgs:
     # Needed for KV cache
     max_batch_size: int = 32
     max_seq_len: int = 2048
+    # When set, the KV cache is allocated in blocks of this many positions as the sequences grow,
+    # instead of reserving max_batch_size * max_seq_len positions up front
+    kv_cache_block_size: Optional[int] = None
+    # When set, the KV cache only keeps the first kv_cache_sink_tokens positions and the kv_cache_window most recent ones,
+    # so the sequences can grow past max_seq_len with a constant memory. Their sum must not exceed max_seq_len,
+    # which then bounds the number of tokens of a single forward pass
+    kv_cache_window: Optional[int] = None
+    kv_cache_sink_tokens: int = 4
+    # Number of processes the attention heads and the feed forward hidden dimension are split across (see tensor_parallel.py)
+    model_parallel_size: int = 1
 
     device: str = None
 
@@ -41,14 +54,22 @@ class RMSNorm(nn.Module):
         return self.weight * self._norm(x.float()).type_as(x)
 
 
-def precompute_theta_pos_frequencies(head_dim: int, seq_len: int, device: str, theta: float = 10000.0):
+def all_reduce_model_parallel(x: torch.Tensor) -> torch.Tensor:
+    # Sums the partial outputs of wo and w2 over the tensor-parallel processes, each of which only has some of the
+    # heads / hidden units. The sum is done in float, so splitting the model doesn't lose precision in bfloat16
+    out = x.float()
+    dist.all_reduce(out)
+    return out.type_as(x)
+
+
+def precompute_theta_pos_frequencies(head_dim: int, seq_len: int, device: str, theta: float = 10000.0, dtype: Optional[torch.dtype] = None):
     # As written in the paragraph 3.2.2 of the paper
     # >> In order to generalize our results in 2D to any xi ∈ Rd where **d is even**, [...]
     assert head_dim % 2 == 0, "Dimension must be divisible by 2"
     # Build the theta parameter
     # According to the formula theta_i = 10000^(-2(i-1)/dim) for i = [1, 2, ... dim/2]
     # Shape: (Head_Dim / 2)
-    theta_numerator = torch.arange(0, head_dim, 2).float()
+    theta_numerator = torch.arange(0, head_dim, 2, device=device).float()
     # Shape: (Head_Dim / 2)
     theta = 1.0 / (theta ** (theta_numerator / head_dim)).to(device) # (Dim / 2)
     # Construct the positions (the "m" parameter)
@@ -57,126 +78,149 @@ def precompute_theta_pos_frequencies(head_dim: int, seq_len: int, device: str, t
     # Multiply each theta by each position using the outer product.
     # Shape: (Seq_Len) outer_product* (Head_Dim / 2) -> (Seq_Len, Head_Dim / 2)
     freqs = torch.outer(m, theta).float()
-    # We can compute complex numbers in the polar form c = R * exp(m * theta), where R = 1 as follows:
-    # (Seq_Len, Head_Dim / 2) -> (Seq_Len, Head_Dim / 2)
-    freqs_complex = torch.polar(torch.ones_like(freqs), freqs)
-    return freqs_complex
-
-def apply_rotary_embeddings(x: torch.Tensor, freqs_complex: torch.Tensor, device: str):
-    # Separate the last dimension pairs of two values, representing the real and imaginary parts of the complex number
-    # Two consecutive values will become a single complex number
-    # (B, Seq_Len, H, Head_Dim) -> (B, Seq_Len, H, Head_Dim/2)
-    x_complex = torch.view_as_complex(x.float().reshape(*x.shape[:-1], -1, 2))
-    # Reshape the freqs_complex tensor to match the shape of the x_complex tensor. So we need to add the batch dimension and the head dimension
-    # (Seq_Len, Head_Dim/2) --> (1, Seq_Len, 1, Head_Dim/2)
-    freqs_complex = freqs_complex.unsqueeze(0).unsqueeze(2)
-    # Multiply each complex number in the x_complex tensor by the corresponding complex number in the freqs_complex tensor
-    # Which results in the rotation of the complex number as shown in the Figure 1 of the paper
-    # (B, Seq_Len, H, Head_Dim/2) * (1, Seq_Len, 1, Head_Dim/2) = (B, Seq_Len, H, Head_Dim/2)
-    x_rotated = x_complex * freqs_complex
-    # Convert the complex number back to the real number
-    # (B, Seq_Len, H, Head_Dim/2) -> (B, Seq_Len, H, Head_Dim/2, 2)
-    x_out = torch.view_as_real(x_rotated)
-    # (B, Seq_Len, H, Head_Dim/2, 2) -> (B, Seq_Len, H, Head_Dim)
-    x_out = x_out.reshape(*x.shape)
-    return x_out.type_as(x).to(device)
-
-
-def repeat_kv(x: torch.Tensor, n_rep: int) -> torch.Tensor:
-    batch_size, seq_len, n_kv_heads, head_dim = x.shape
-    if n_rep == 1:
-        return x
-    return (
-        # (B, Seq_Len, N_KV_Heads, 1, Head_Dim)
-        x[:, :, :, None, :]
-        # (B, Seq_Len, N_KV_Heads, N_Rep, Head_Dim)
-        .expand(batch_size, seq_len, n_kv_heads, n_rep, head_dim)
-        # (B, Seq_Len, N_KV_Heads * N_Rep, Head_Dim)
-        .reshape(batch_size, seq_len, n_kv_heads * n_rep, head_dim)
-    )
+    # The rotation by m * theta is the multiplication by the complex number cos(m * theta) + i * sin(m * theta).
+    # Keeping its real and imaginary parts as two real tables (computed in float, stored in the model dtype)
+    # lets the rotation run on the activations as they are, without going through complex tensors
+    # (Seq_Len, Head_Dim / 2) -> (Seq_Len, Head_Dim / 2), (Seq_Len, Head_Dim / 2)
+    dtype = torch.get_default_dtype() if dtype is None else dtype
+    return torch.cos(freqs).to(dtype), torch.sin(freqs).to(dtype)
+
+def apply_rotary_embeddings(x: torch.Tensor, cos: torch.Tensor, sin: torch.Tensor):
+    # Rotates x in place and returns it.
+    # Two consecutive values of the last dimension are the real and imaginary parts of a complex number
+    # (B, Seq_Len, H, Head_Dim) -> (B, Seq_Len, H, Head_Dim/2, 2)
+    x_pairs = x.unflatten(-1, (-1, 2))
+    # (B, Seq_Len, H, Head_Dim/2), views into x
+    x_real, x_imag = x_pairs[..., 0], x_pairs[..., 1]
+    # Add the head dimension to the tables
+    # (the batch dimension is either broadcast or already there when every row has its own positions)
+    # (Seq_Len, Head_Dim/2) --> (Seq_Len, 1, Head_Dim/2) or (B, Seq_Len, Head_Dim/2) --> (B, Seq_Len, 1, Head_Dim/2)
+    cos, sin = cos.unsqueeze(-2), sin.unsqueeze(-2)
+    # (a + ib) * (cos + i sin) = (a cos - b sin) + i (a sin + b cos), as shown in the Figure 1 of the paper.
+    # Only a * sin needs to be kept aside before a is overwritten
+    real_sin = x_real * sin
+    x_real.mul_(cos).addcmul_(x_imag, sin, value=-1)
+    x_imag.mul_(cos).add_(real_sin)
+    return x
 
 
 class SelfAttention(nn.Module):
     def __init__(self, args: ModelArgs):
         super().__init__()
 
+        # With tensor parallelism, each process only has its share of the heads
+        self.model_parallel_size = args.model_parallel_size
         # Indicates the number of heads for the Keys and Values
-        self.n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
+        self.n_kv_heads = (args.n_heads if args.n_kv_heads is None else args.n_kv_heads) // args.model_parallel_size
         # Indicates the number of heads for the Queries
-        self.n_heads_q = args.n_heads
-        # Indicates how many times the Keys and Values should be repeated
+        self.n_heads_q = args.n_heads // args.model_parallel_size
+        # Indicates how many heads of the Queries share the same Keys and Values
         self.n_rep = self.n_heads_q // self.n_kv_heads
         # Indicates the dimension of each head, that is, the part of the embedding that each head will be responsible for
         self.head_dim = args.dim // args.n_heads
 
-        self.wq = nn.Linear(args.dim, args.n_heads * self.head_dim, bias=False)
-        self.wk = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
-        self.wv = nn.Linear(args.dim, self.n_kv_heads * self.head_dim, bias=False)
-        self.wo = nn.Linear(args.n_heads * self.head_dim, args.dim, bias=False)
-
-        self.cache_k = torch.zeros((args.max_batch_size, args.max_seq_len, self.n_kv_heads, self.head_dim))
-        self.cache_v = torch.zeros((args.max_batch_size, args.max_seq_len, self.n_kv_heads, self.head_dim))
+        # wq, wk and wv are applied to the same input: their weights are stacked into a single
+        # ((H_Q + 2 * H_KV) * Head_Dim, Dim) projection, so that Q, K and V are computed by one matmul
+        self.qkv_sizes = [self.n_heads_q * self.head_dim, self.n_kv_heads * self.head_dim, self.n_kv_heads * self.head_dim]
+        self.wqkv = nn.Linear(args.dim, sum(self.qkv_sizes), bias=False)
+        self.wo = nn.Linear(self.n_heads_q * self.head_dim, args.dim, bias=False)
+
+        self.max_batch_size = args.max_batch_size
+        self.max_seq_len = args.max_seq_len
+        # Allocated by Transformer.init_cache
+        self.cache = None
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # The original checkpoints (and their quantized versions) have separate wq, wk and wv, stack them into wqkv
+        for suffix in ("weight", "qweight", "scales"):
+            keys = [f"{prefix}{name}.{suffix}" for name in ("wq", "wk", "wv")]
+            if all(key in state_dict for key in keys):
+                state_dict[f"{prefix}wqkv.{suffix}"] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def init_cache(self, block_allocator: Optional[BlockAllocator] = None, window: Optional[int] = None, num_sinks: int = 4):
+        if window is not None:
+            self.cache = RollingKVCache(self.max_batch_size, num_sinks, window, self.n_kv_heads, self.head_dim)
+        elif block_allocator is None:
+            self.cache = KVCache(self.max_batch_size, self.max_seq_len, self.n_kv_heads, self.head_dim)
+        else:
+            self.cache = PagedKVCache(block_allocator, self.n_kv_heads, self.head_dim)
 
     def forward(
         self,
         x: torch.Tensor,
-        start_pos: int,
-        freqs_complex: torch.Tensor
+        start_pos: Union[int, torch.Tensor],
+        cos: torch.Tensor,
+        sin: torch.Tensor,
+        mask: Optional[torch.Tensor] = None,
+        slots: Optional[torch.Tensor] = None
     ):
-        batch_size, seq_len, _ = x.shape  # (B, 1, Dim)
+        batch_size, seq_len, _ = x.shape  # (B, Seq_Len, Dim)
 
-        # (B, 1, Dim) -> (B, 1, H_Q * Head_Dim)
-        xq = self.wq(x)
-        # (B, 1, Dim) -> (B, 1, H_KV * Head_Dim)
-        xk = self.wk(x)
-        # (B, 1, Dim) -> (B, 1, H_KV * Head_Dim)
-        xv = self.wv(x)
+        # (B, Seq_Len, Dim) -> (B, Seq_Len, (H_Q + 2 * H_KV) * Head_Dim)
+        xqkv = self.wqkv(x)
+        # -> (B, Seq_Len, H_Q * Head_Dim), (B, Seq_Len, H_KV * Head_Dim), (B, Seq_Len, H_KV * Head_Dim), views into xqkv
+        xq, xk, xv = xqkv.split(self.qkv_sizes, dim=-1)
 
-        # (B, 1, H_Q * Head_Dim) -> (B, 1, H_Q, Head_Dim)
+        # (B, Seq_Len, H_Q * Head_Dim) -> (B, Seq_Len, H_Q, Head_Dim)
         xq = xq.view(batch_size, seq_len, self.n_heads_q, self.head_dim)
-        # (B, 1, H_KV * Head_Dim) -> (B, 1, H_KV, Head_Dim)
+        # (B, Seq_Len, H_KV * Head_Dim) -> (B, Seq_Len, H_KV, Head_Dim)
         xk = xk.view(batch_size, seq_len, self.n_kv_heads, self.head_dim)
-        # (B, 1, H_KV * Head_Dim) -> (B, 1, H_KV, Head_Dim)
+        # (B, Seq_Len, H_KV * Head_Dim) -> (B, Seq_Len, H_KV, Head_Dim)
         xv = xv.view(batch_size, seq_len, self.n_kv_heads, self.head_dim)
 
-        # (B, 1, H_Q, Head_Dim) --> (B, 1, H_Q, Head_Dim)
-        xq = apply_rotary_embeddings(xq, freqs_complex, device=x.device)
-        # (B, 1, H_KV, Head_Dim) --> (B, 1, H_KV, Head_Dim)
-        xk = apply_rotary_embeddings(xk, freqs_complex, device=x.device)
-
-        # Replace the entry in the cache
-        self.cache_k[:batch_size, start_pos : start_pos + seq_len] = xk
-        self.cache_v[:batch_size, start_pos : start_pos + seq_len] = xv
-
-        # (B, Seq_Len_KV, H_KV, Head_Dim)
-        keys = self.cache_k[:batch_size, : start_pos + seq_len]
-        # (B, Seq_Len_KV, H_KV, Head_Dim)
-        values = self.cache_v[:batch_size, : start_pos + seq_len]
-
-        # Since every group of Q shares the same K and V heads, just repeat the K and V heads for every Q in the same group.
-
-        # (B, Seq_Len_KV, H_KV, Head_Dim) --> (B, Seq_Len_KV, H_Q, Head_Dim)
-        keys = repeat_kv(keys, self.n_rep)
-        # (B, Seq_Len_KV, H_KV, Head_Dim) --> (B, Seq_Len_KV, H_Q, Head_Dim)
-        values = repeat_kv(values, self.n_rep)
-
-        # (B, 1, H_Q, Head_Dim) -> (B, H_Q, 1, Head_Dim)
-        xq = xq.transpose(1, 2)
-        # (B, Seq_Len_KV, H_Q, Head_Dim) -> (B, H_Q, Seq_Len_KV, Head_Dim)
-        keys = keys.transpose(1, 2)
-        # (B, Seq_Len_KV, H_Q, Head_Dim) -> (B, H_Q, Seq_Len_KV, Head_Dim)
-        values = values.transpose(1, 2)
-
-        # (B, H_Q, 1, Head_Dim) @ (B, H_Q, Head_Dim, Seq_Len_KV) -> (B, H_Q, 1, Seq_Len_KV)
+        if not self.cache.deferred_rotary:
+            # (B, Seq_Len, H_Q, Head_Dim) --> (B, Seq_Len, H_Q, Head_Dim)
+            xq = apply_rotary_embeddings(xq, cos, sin)
+            # (B, Seq_Len, H_KV, Head_Dim) --> (B, Seq_Len, H_KV, Head_Dim)
+            xk = apply_rotary_embeddings(xk, cos, sin)
+        else:
+            # The tables cover all the keys that are read, the queries are the last Seq_Len of them
+            # (B, Seq_Len, H_Q, Head_Dim) --> (B, Seq_Len, H_Q, Head_Dim)
+            xq = apply_rotary_embeddings(xq, cos[-seq_len:], sin[-seq_len:])
+
+        # Positions up to which the keys and values are read
+        kv_len = start_pos + seq_len if isinstance(start_pos, int) else mask.shape[-1]
+        # The caches store the heads first, so the keys and values are read as they are multiplied
+        # (B, H_KV, Seq_Len_KV, Head_Dim)
+        keys, values = self.cache.update(xk, xv, start_pos, slots, kv_len)
+        # The rolling cache only returns what it holds, fewer positions once the sequence is longer than it
+        kv_len = keys.shape[2]
+        if self.cache.deferred_rotary:
+            # The keys were cached unrotated, they are rotated in place at their position in the cache
+            # (B, H_KV, Seq_Len_KV, Head_Dim) -> (B, Seq_Len_KV, H_KV, Head_Dim), a view
+            apply_rotary_embeddings(keys.transpose(1, 2), cos, sin)
+
+        # Every group of N_Rep query heads shares the same K and V head. Instead of repeating the K and V heads
+        # for every Q in the group, the queries of a group are stacked along the sequence dimension, so that
+        # the whole group is multiplied by its single K and V head in one batched matmul
+
+        # (B, Seq_Len, H_Q, Head_Dim) -> (B, Seq_Len, H_KV, N_Rep, Head_Dim) -> (B, H_KV, N_Rep, Seq_Len, Head_Dim)
+        xq = xq.view(batch_size, seq_len, self.n_kv_heads, self.n_rep, self.head_dim).permute(0, 2, 3, 1, 4)
+        # (B, H_KV, N_Rep, Seq_Len, Head_Dim) -> (B, H_KV, N_Rep * Seq_Len, Head_Dim)
+        xq = xq.reshape(batch_size, self.n_kv_heads, self.n_rep * seq_len, self.head_dim)
+
+        # (B, H_KV, N_Rep * Seq_Len, Head_Dim) @ (B, H_KV, Head_Dim, Seq_Len_KV) -> (B, H_KV, N_Rep * Seq_Len, Seq_Len_KV)
         scores = torch.matmul(xq, keys.transpose(2, 3)) / math.sqrt(self.head_dim)
-        # (B, H_Q, 1, Seq_Len_KV) -> (B, H_Q, 1, Seq_Len_KV)
-        scores = F.softmax(scores.float(), dim=-1).type_as(xq)
-
-        # (B, H_Q, 1, Seq_Len) @ (B, H_Q, Seq_Len_KV, Head_Dim) -> (B, H_Q, 1, Head_Dim)
+        # (B, H_KV, N_Rep * Seq_Len, Seq_Len_KV) -> (B, H_KV, N_Rep, Seq_Len, Seq_Len_KV)
+        scores = scores.float().view(batch_size, self.n_kv_heads, self.n_rep, seq_len, kv_len)
+        if mask is not None:
+            # When prefilling several tokens at once, every token must only see the ones before it
+            # (Seq_Len, Seq_Len_KV) or (B, 1, Seq_Len, Seq_Len_KV) -> (B, 1, 1, Seq_Len, Seq_Len_KV)
+            # broadcasts over (B, H_KV, N_Rep, Seq_Len, Seq_Len_KV)
+            scores = scores + mask.unsqueeze(-3)
+        # (B, H_KV, N_Rep, Seq_Len, Seq_Len_KV) -> (B, H_KV, N_Rep * Seq_Len, Seq_Len_KV)
+        scores = F.softmax(scores, dim=-1).type_as(xq).view(batch_size, self.n_kv_heads, self.n_rep * seq_len, kv_len)
+
+        # (B, H_KV, N_Rep * Seq_Len, Seq_Len_KV) @ (B, H_KV, Seq_Len_KV, Head_Dim) -> (B, H_KV, N_Rep * Seq_Len, Head_Dim)
         output = torch.matmul(scores, values)
-        # (B, H_Q, 1, Head_Dim) -> (B, 1, H_Q, Head_Dim) -> (B, 1, Dim)
-        output = (output.transpose(1, 2).contiguous().view(batch_size, seq_len, -1))
-        return self.wo(output) # (B, 1, Dim) -> (B, 1, Dim)
+        # (B, H_KV, N_Rep * Seq_Len, Head_Dim) -> (B, H_KV, N_Rep, Seq_Len, Head_Dim) -> (B, Seq_Len, H_KV, N_Rep, Head_Dim) -> (B, Seq_Len, Dim)
+        output = output.view(batch_size, self.n_kv_heads, self.n_rep, seq_len, self.head_dim).permute(0, 3, 1, 2, 4)
+        output = output.reshape(batch_size, seq_len, -1)
+        output = self.wo(output) # (B, Seq_Len, Dim) -> (B, Seq_Len, Dim)
+        if self.model_parallel_size > 1:
+            output = all_reduce_model_parallel(output)
+        return output
 
 
 class FeedForward(nn.Module):
@@ -192,20 +236,35 @@ class FeedForward(nn.Module):
             hidden_dim = int(args.ffn_dim_multiplier * hidden_dim)
         # Round the hidden_dim to the nearest multiple of the multiple_of parameter
         hidden_dim = args.multiple_of * ((hidden_dim + args.multiple_of - 1) // args.multiple_of)
-
-        self.w1 = nn.Linear(args.dim, hidden_dim, bias=False)
+        # With tensor parallelism, each process only has its share of the hidden units
+        self.model_parallel_size = args.model_parallel_size
+        hidden_dim = hidden_dim // args.model_parallel_size
+
+        self.hidden_dim = hidden_dim
+        # w1 (gate) and w3 (up) are applied to the same input: their weights are stacked into a single
+        # (2 * Hidden_Dim, Dim) projection, so that both are computed by one matmul
+        self.w13 = nn.Linear(args.dim, 2 * hidden_dim, bias=False)
         self.w2 = nn.Linear(hidden_dim, args.dim, bias=False)
-        self.w3 = nn.Linear(args.dim, hidden_dim, bias=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # The original checkpoints (and their quantized versions) have separate w1 and w3, stack them into w13
+        for suffix in ("weight", "qweight", "scales"):
+            w1_key, w3_key = f"{prefix}w1.{suffix}", f"{prefix}w3.{suffix}"
+            if w1_key in state_dict and w3_key in state_dict:
+                state_dict[f"{prefix}w13.{suffix}"] = torch.cat([state_dict.pop(w1_key), state_dict.pop(w3_key)], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x: torch.Tensor):
-        # (B, Seq_Len, Dim) --> (B, Seq_Len, Hidden_Dim)
-        swish = F.silu(self.w1(x))
-        # (B, Seq_Len, Dim) --> (B, Seq_Len, Hidden_Dim)
-        x_V = self.w3(x)
-        # (B, Seq_Len, Hidden_Dim) * (B, Seq_Len, Hidden_Dim) --> (B, Seq_Len, Hidden_Dim)
-        x = swish * x_V
+        # (B, Seq_Len, Dim) --> (B, Seq_Len, 2 * Hidden_Dim)
+        x_13 = self.w13(x)
+        # (B, Seq_Len, 2 * Hidden_Dim) --> (B, Seq_Len, Hidden_Dim), (B, Seq_Len, Hidden_Dim), views into x_13
+        swish, x_V = x_13.split(self.hidden_dim, dim=-1)
+        # (B, Seq_Len, Hidden_Dim) * (B, Seq_Len, Hidden_Dim) --> (B, Seq_Len, Hidden_Dim), in place in the first half of x_13
+        x = F.silu(swish, inplace=True).mul_(x_V)
         # (B, Seq_Len, Hidden_Dim) --> (B, Seq_Len, Dim)
         x = self.w2(x)
+        if self.model_parallel_size > 1:
+            x = all_reduce_model_parallel(x)
         return x
 
 
@@ -226,10 +285,10 @@ class EncoderBlock(nn.Module):
         # Normalization BEFORE the feed forward block
         self.ffn_norm = RMSNorm(args.dim, eps=args.norm_eps)
     
-    def forward(self, x: torch.Tensor, start_pos: int, freqs_complex: torch.Tensor):
+    def forward(self, x: torch.Tensor, start_pos: Union[int, torch.Tensor], cos: torch.Tensor, sin: torch.Tensor, mask: Optional[torch.Tensor] = None, slots: Optional[torch.Tensor] = None):
         # (B, Seq_Len, Dim) + (B, Seq_Len, Dim) --> (B, Seq_Len, Dim)
         h = x + self.attention.forward(
-            self.attention_norm(x), start_pos, freqs_complex
+            self.attention_norm(x), start_pos, cos, sin, mask, slots
         )
         # (B, Seq_Len, Dim) + (B, Seq_Len, Dim) --> (B, Seq_Len, Dim)
         out = h + self.feed_forward.forward(self.ffn_norm(h))
@@ -254,22 +313,120 @@ class Transformer(nn.Module):
         self.norm = RMSNorm(args.dim, eps=args.norm_eps)
         self.output = nn.Linear(args.dim, self.vocab_size, bias=False)
 
-        self.freqs_complex = precompute_theta_pos_frequencies(self.args.dim // self.args.n_heads, self.args.max_seq_len * 2, device=self.args.device)
+        self.init_cache()
+
+    def init_cache(self):
+        # The RoPE tables and the KV caches are not part of the state dict. When the model is created on the
+        # meta device to bind the checkpoint tensors directly, this is called again to allocate them for real.
+        # The tables are non persistent buffers, so they follow the model to its device and dtype
+        rope_cos, rope_sin = precompute_theta_pos_frequencies(self.args.dim // self.args.n_heads, self.args.max_seq_len * 2, device=self.args.device)
+        self.register_buffer("rope_cos", rope_cos, persistent=False)
+        self.register_buffer("rope_sin", rope_sin, persistent=False)
+
+        # The paged KV caches of all the layers share the same block tables
+        self.block_allocator = None
+        if self.args.kv_cache_block_size is not None:
+            assert self.args.kv_cache_window is None, "the KV cache is either paged or rolling"
+            self.block_allocator = BlockAllocator(self.args.kv_cache_block_size, device=self.args.device)
+        if self.args.kv_cache_window is not None:
+            assert self.args.kv_cache_sink_tokens + self.args.kv_cache_window <= self.args.max_seq_len, "the rolling KV cache must fit in max_seq_len"
+        for layer in self.layers:
+            layer.attention.init_cache(self.block_allocator, self.args.kv_cache_window, self.args.kv_cache_sink_tokens)
 
-    def forward(self, tokens: torch.Tensor, start_pos: int):
+    # Inference only: the activations are modified in place through split views, which autograd rejects
+    @torch.no_grad()
+    def forward(self, tokens: torch.Tensor, start_pos: Union[int, torch.Tensor], slots: Optional[torch.Tensor] = None):
         # (B, Seq_Len)
         batch_size, seq_len = tokens.shape
-        assert seq_len == 1, "Only one token at a time can be processed"
 
         # (B, Seq_Len) -> (B, Seq_Len, Dim)
         h = self.tok_embeddings(tokens)
 
-        # Retrieve the pairs (m, theta) corresponding to the positions [start_pos, start_pos + seq_len]
-        freqs_complex = self.freqs_complex[start_pos:start_pos + seq_len]
-        
+        if slots is None:
+            # Row i of the batch uses row i of the KV cache and all the rows are at the same position
+
+            if self.args.kv_cache_window is None:
+                # Retrieve the rotations corresponding to the positions [start_pos, start_pos + seq_len]
+                # (Seq_Len, Head_Dim / 2)
+                cos = self.rope_cos[start_pos:start_pos + seq_len]
+                sin = self.rope_sin[start_pos:start_pos + seq_len]
+                num_cached = start_pos
+            else:
+                # Rolling KV cache: the positions are counted inside the cache (sinks, then the most recent tokens,
+                # then the new ones) and the keys are rotated when read, so the rotations of all of them are needed
+                num_cached = min(start_pos, self.args.kv_cache_sink_tokens + self.args.kv_cache_window)
+                # The tables cover 2 * max_seq_len positions and num_cached <= max_seq_len
+                assert seq_len <= self.args.max_seq_len, f"with a rolling KV cache at most max_seq_len ({self.args.max_seq_len}) tokens can be passed at once"
+                # (Num_Cached + Seq_Len, Head_Dim / 2)
+                cos = self.rope_cos[:num_cached + seq_len]
+                sin = self.rope_sin[:num_cached + seq_len]
+
+            mask = None
+            if seq_len > 1:
+                # Prefill: the new tokens attend to everything already in the KV cache and causally among themselves
+                # (Seq_Len, Seq_Len)
+                mask = torch.full((seq_len, seq_len), float("-inf"), device=tokens.device)
+                mask = torch.triu(mask, diagonal=1)
+                # (Seq_Len, Num_Cached) | (Seq_Len, Seq_Len) -> (Seq_Len, Seq_Len_KV)
+                mask = torch.hstack([torch.zeros((seq_len, num_cached), device=tokens.device), mask]).float()
+        else:
+            # Row i of the batch uses the KV cache slot slots[i] and starts at its own position start_pos[i]
+            # (B)
+            start_pos = torch.as_tensor(start_pos, device=tokens.device).expand(batch_size)
+            # (B, Seq_Len)
+            positions = start_pos[:, None] + torch.arange(seq_len, device=tokens.device)
+            # (B, Seq_Len, Head_Dim / 2)
+            cos = self.rope_cos[positions]
+            sin = self.rope_sin[positions]
+
+            # A cached position is visible to a token only if it is not after the token itself.
+            # This also hides the stale entries left in a slot by the sequence that used it before
+            kv_len = int(positions.max()) + 1
+            # (B, 1, Seq_Len, Seq_Len_KV)
+            mask = torch.zeros((batch_size, 1, seq_len, kv_len), dtype=torch.float, device=tokens.device)
+            mask.masked_fill_(torch.arange(kv_len, device=tokens.device) > positions[:, None, :, None], float("-inf"))
+
+        if self.block_allocator is not None:
+            # Reserve the blocks for the new positions and compute the block indices shared by all the layers
+            if slots is None:
+                self.block_allocator.prepare(list(range(batch_size)), [start_pos] * batch_size, seq_len, start_pos + seq_len)
+            else:
+                self.block_allocator.prepare(slots.tolist(), start_pos.tolist(), seq_len, kv_len)
+
         # Consecutively apply all the encoder layers
         for layer in self.layers:
-            h = layer(h, start_pos, freqs_complex)
+            h = layer(h, start_pos, cos, sin, mask, slots)
+        h = self.norm(h)
+        output = self.output(h).float()
+        return output
+
+    @torch.no_grad()
+    def decode_step(self, tokens: torch.Tensor, start_pos: torch.Tensor):
+        # Static-shape decode: one new token for every row of the dense KV cache, row i in slot i at its own position
+        # start_pos[i]. The keys and values are always read up to max_seq_len and the positions past each row's own
+        # are masked, so the shapes are the same at every step and the step can be compiled (see static_decode.py)
+        # (Max_B, 1)
+        batch_size, seq_len = tokens.shape
+
+        # (Max_B, 1) -> (Max_B, 1, Dim)
+        h = self.tok_embeddings(tokens)
+        # (Max_B, 1)
+        positions = start_pos[:, None]
+        # (Max_B, 1, Head_Dim / 2)
+        cos = self.rope_cos[positions]
+        sin = self.rope_sin[positions]
+        # (Max_B, 1, 1, Max_Seq_Len)
+        mask = torch.zeros((batch_size, 1, seq_len, self.args.max_seq_len), dtype=torch.float, device=tokens.device)
+        mask.masked_fill_(torch.arange(self.args.max_seq_len, device=tokens.device) > positions[:, None, :, None], float("-inf"))
+
+        for layer in self.layers:
+            h = layer(h, start_pos, cos, sin, mask)
         h = self.norm(h)
         output = self.output(h).float()
-        return output
\ No newline at end of file
+        return output
+
+    def release(self, slots: list[int]):
+        # Give the KV cache blocks of finished sequences back to the pool (the dense cache keeps its rows)
+        if self.block_allocator is not None:
+            for slot in slots:
+                self.block_allocator.free(slot)
@@ -0,0 +1,95 @@
+from array import array
+from collections import OrderedDict
+import hashlib
+import torch
+
+from model import Transformer
+
+
+class PrefixCache:
+    """
+    Keeps the keys and values computed for prompt prefixes, so that a new sequence starting with an already
+    seen prefix (e.g. a long few-shot header) copies them into its KV cache slot and only prefills the rest.
+
+    Prompts are cut into blocks of block_size tokens and every block is keyed by a hash of all the tokens up to
+    its end, so a block is only reused after exactly the same prefix. Blocks are evicted in LRU order once they
+    take more than max_bytes.
+    """
+
+    def __init__(self, model: Transformer, block_size: int = 64, max_bytes: int = 1 << 30):
+        # Checked here so that every user of the cache (LLaMA, Scheduler) is covered
+        assert model.args.kv_cache_window is None, "the prefix cache needs the whole prompt in the KV cache"
+        # With tensor parallelism every process only caches its own heads, this process can't restore the others
+        assert model.args.model_parallel_size == 1, "the prefix cache needs all the heads in the KV cache"
+        self.model = model
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        # Hash of the prefix ending with the block -> keys and values of the block, each (N_Layers, Block_Size, H_KV, Head_Dim)
+        self.blocks: OrderedDict[bytes, tuple[torch.Tensor, torch.Tensor]] = OrderedDict()
+
+        self.num_lookup_tokens = 0
+        self.num_hit_tokens = 0
+
+    def _block_hashes(self, tokens: list[int]) -> list[bytes]:
+        hashes = []
+        prefix_hash = b""
+        for start in range(0, len(tokens) - self.block_size + 1, self.block_size):
+            block = array("l", tokens[start:start + self.block_size]).tobytes()
+            prefix_hash = hashlib.sha256(prefix_hash + block).digest()
+            hashes.append(prefix_hash)
+        return hashes
+
+    def _touch(self, hashes: list[bytes]):
+        # A prefix is marked as used after its extensions, so the eviction drops the longest prefixes first
+        # and never leaves a block whose parent is gone
+        for block_hash in reversed(hashes):
+            self.blocks.move_to_end(block_hash)
+
+    def load(self, slot: int, tokens: list[int]) -> int:
+        # Copies the cached prefix of the tokens into the slot and returns its length.
+        # The last token is always left out, its logits are needed to sample the next token
+        matched = []
+        for block_hash in self._block_hashes(tokens[:-1]):
+            if block_hash not in self.blocks:
+                break
+            matched.append(block_hash)
+        self.num_lookup_tokens += len(tokens)
+        if len(matched) == 0:
+            return 0
+
+        self._touch(matched)
+        # (N_Layers, Block_Size, H_KV, Head_Dim) -> (N_Layers, Prefix_Len, H_KV, Head_Dim)
+        keys = torch.cat([self.blocks[block_hash][0] for block_hash in matched], dim=1)
+        values = torch.cat([self.blocks[block_hash][1] for block_hash in matched], dim=1)
+        for layer_id, layer in enumerate(self.model.layers):
+            layer.attention.cache.write(slot, 0, keys[layer_id], values[layer_id])
+        num_cached = len(matched) * self.block_size
+        self.num_hit_tokens += num_cached
+        return num_cached
+
+    def store(self, slot: int, tokens: list[int]):
+        # Saves the full blocks of the tokens, whose keys and values must already be in the slot
+        hashes = self._block_hashes(tokens)
+        missing = [i for i, block_hash in enumerate(hashes) if block_hash not in self.blocks]
+        if len(missing) > 0:
+            start, end = missing[0] * self.block_size, len(hashes) * self.block_size
+            entries = [layer.attention.cache.read(slot, start, end) for layer in self.model.layers]
+            # (N_Layers, End - Start, H_KV, Head_Dim)
+            keys = torch.stack([layer_keys for layer_keys, _ in entries])
+            values = torch.stack([layer_values for _, layer_values in entries])
+            for i in missing:
+                offset = i * self.block_size - start
+                # Each block gets its own storage, so evicting it really frees the memory
+                block_keys = keys[:, offset:offset + self.block_size].clone()
+                block_values = values[:, offset:offset + self.block_size].clone()
+                self.blocks[hashes[i]] = (block_keys, block_values)
+                self.num_bytes += 2 * block_keys.numel() * block_keys.element_size()
+        self._touch(hashes)
+
+        while self.num_bytes > self.max_bytes and len(self.blocks) > 0:
+            _, (block_keys, block_values) = self.blocks.popitem(last=False)
+            self.num_bytes -= 2 * block_keys.numel() * block_keys.element_size()
+
+    def hit_rate(self) -> float:
+        return self.num_hit_tokens / self.num_lookup_tokens if self.num_lookup_tokens > 0 else 0.0
@@ -0,0 +1,298 @@
+from collections import defaultdict
+from typing import Callable, Optional
+import json
+import time
+import torch
+import torch.nn as nn
+
+import model as model_module
+from model import EncoderBlock, FeedForward, RMSNorm, SelfAttention, Transformer
+from quantize import QuantizedLinear
+
+
+def _nbytes(*tensors: torch.Tensor) -> int:
+    return sum(t.numel() * t.element_size() for t in tensors if isinstance(t, torch.Tensor))
+
+
+def _linear_cost(module: nn.Module, args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # 2 FLOPs per multiply-add, the whole weight is read once
+    x = args[0]
+    num_tokens = x.numel() // module.in_features
+    if isinstance(module, QuantizedLinear):
+        weight_bytes = _nbytes(module.qweight, module.scales)
+    else:
+        weight_bytes = _nbytes(module.weight)
+    return 2 * num_tokens * module.in_features * module.out_features, weight_bytes + _nbytes(x, output)
+
+
+def _rmsnorm_cost(module: nn.Module, args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # Square, mean, scale and gamma: about 4 FLOPs per element
+    x = args[0]
+    return 4 * x.numel(), _nbytes(x, output, module.weight)
+
+
+def _embedding_cost(module: nn.Module, args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # Only the looked up rows are read
+    return 0, 2 * _nbytes(output)
+
+
+def _attention_cost(module: nn.Module, args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # Own work of the attention, without the projections: Q @ K^T and scores @ V, and reading the cached keys and values
+    x, start_pos, cos = args[0], args[1], args[2]
+    mask = args[4] if len(args) > 4 else None
+    batch_size, seq_len, _ = x.shape
+    if mask is not None:
+        kv_len = mask.shape[-1]
+    elif module.cache.deferred_rotary:
+        kv_len = cos.shape[0]
+    else:
+        kv_len = start_pos + seq_len
+    flops = 4 * batch_size * module.n_heads_q * seq_len * kv_len * module.head_dim
+    kv_bytes = 2 * batch_size * kv_len * module.n_kv_heads * module.head_dim * x.element_size()
+    return flops, kv_bytes
+
+
+def _feed_forward_cost(module: nn.Module, args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # Own work of the feed forward, without the projections: SiLU and the gating product on the hidden activations
+    x = args[0]
+    hidden = x.numel() // x.shape[-1] * module.hidden_dim
+    return 6 * hidden, 3 * hidden * x.element_size()
+
+
+def _rope_cost(args: tuple, output: torch.Tensor) -> tuple[int, int]:
+    # 6 FLOPs per pair of values, read and written in place
+    x, cos, sin = args
+    return 3 * x.numel(), 2 * _nbytes(x) + _nbytes(cos, sin)
+
+
+class Profiler:
+    """
+    Opt-in timing breakdown of the Transformer: while attached (or inside a with block), the forward of the
+    Transformer, of every EncoderBlock, SelfAttention, FeedForward, RMSNorm and linear layer, and the rotary
+    embeddings are wrapped to record their wall time, along with an estimate of their FLOPs and bytes moved.
+    Detaching restores the original methods, so a model that is not being profiled pays nothing.
+
+    Calls are aggregated per module name and per phase (prefill or decode) across all the forward passes,
+    each with its total time and its self time (without the instrumented calls inside it). The self times of
+    all the modules add up to the time of the whole forward pass, so the breakdown by category shows where it goes.
+    """
+
+    def __init__(self, model: Transformer, record_events: bool = True, max_events: int = 1_000_000, synchronize: Optional[bool] = None):
+        self.model = model
+        self.record_events = record_events
+        self.max_events = max_events
+        # Without synchronizing, the GPU kernels would be timed when they are launched and not when they run
+        self.synchronize = torch.cuda.is_available() and str(model.args.device).startswith("cuda") if synchronize is None else synchronize
+
+        # (name, phase) -> calls, total time, self time (ns), FLOPs and bytes
+        self.stats: dict[tuple[str, str], dict] = defaultdict(lambda: {"calls": 0, "total_ns": 0, "self_ns": 0, "flops": 0, "bytes": 0})
+        self.categories: dict[str, str] = {}
+        self.events: list[dict] = []
+        self.num_forwards = defaultdict(int)
+
+        self._wrapped: list[nn.Module] = []
+        self._original_rope: Optional[Callable] = None
+        # Names and children time of the calls in progress
+        self._stack: list[list] = []
+        self._phase = "decode"
+        self._origin_ns = time.perf_counter_ns()
+
+    def __enter__(self):
+        self.attach()
+        return self
+
+    def __exit__(self, *exc):
+        self.detach()
+
+    def attach(self):
+        assert len(self._wrapped) == 0, "the profiler is already attached"
+        for name, module in self.model.named_modules():
+            category, cost = self._classify(name, module)
+            if category is None:
+                continue
+            self._wrap_module(name or "transformer", category, module, cost)
+        # The rotary embeddings are a function called by every SelfAttention, they are recorded under their caller
+        self._original_rope = model_module.apply_rotary_embeddings
+        model_module.apply_rotary_embeddings = self._timed(None, "rope", self._original_rope, lambda args, output: _rope_cost(args, output))
+
+    def detach(self):
+        for module in self._wrapped:
+            # The instance attribute was hiding the forward of the class
+            del module.forward
+        self._wrapped = []
+        if self._original_rope is not None:
+            model_module.apply_rotary_embeddings = self._original_rope
+            self._original_rope = None
+
+    def reset(self):
+        self.stats.clear()
+        self.events = []
+        self.num_forwards.clear()
+        self._origin_ns = time.perf_counter_ns()
+
+    def _classify(self, name: str, module: nn.Module):
+        # Category of the self time of the module, and the estimate of its own FLOPs and bytes
+        if isinstance(module, Transformer):
+            return "other", None
+        if isinstance(module, EncoderBlock):
+            # Residual connections
+            return "other", None
+        if isinstance(module, SelfAttention):
+            return "attention", _attention_cost
+        if isinstance(module, FeedForward):
+            return "feed_forward", _feed_forward_cost
+        if isinstance(module, RMSNorm):
+            return "rmsnorm", _rmsnorm_cost
+        if isinstance(module, nn.Embedding):
+            return "embedding", _embedding_cost
+        if isinstance(module, (nn.Linear, QuantizedLinear)):
+            if name == "output":
+                return "output", _linear_cost
+            # The projections count towards the block they belong to
+            return ("attention" if ".attention." in name else "feed_forward"), _linear_cost
+        return None, None
+
+    def _wrap_module(self, name: str, category: str, module: nn.Module, cost):
+        forward = module.forward
+        estimate = None if cost is None else (lambda args, output: cost(module, args, output))
+        if isinstance(module, Transformer):
+            def forward_with_phase(tokens, *args, **kwargs):
+                # The prefill passes and the decode steps are aggregated separately
+                self._phase = "prefill" if tokens.shape[1] > 1 else "decode"
+                self.num_forwards[self._phase] += 1
+                return forward(tokens, *args, **kwargs)
+            module.forward = self._timed(name, category, forward_with_phase, estimate)
+        else:
+            module.forward = self._timed(name, category, forward, estimate)
+        self._wrapped.append(module)
+
+    def _timed(self, name: Optional[str], category: str, fn: Callable, estimate):
+        def wrapper(*args, **kwargs):
+            # Functions are named after the module calling them
+            call_name = name if name is not None else f"{self._stack[-1][0] if len(self._stack) > 0 else 'transformer'}.{category}"
+            frame = [call_name, 0]
+            self._stack.append(frame)
+            if self.synchronize:
+                torch.cuda.synchronize()
+            start_ns = time.perf_counter_ns()
+            try:
+                output = fn(*args, **kwargs)
+                if self.synchronize:
+                    torch.cuda.synchronize()
+            finally:
+                end_ns = time.perf_counter_ns()
+                self._stack.pop()
+            duration = end_ns - start_ns
+            if len(self._stack) > 0:
+                self._stack[-1][1] += duration
+            flops, nbytes = estimate(args, output) if estimate is not None else (0, 0)
+            self._record(call_name, category, start_ns, duration, duration - frame[1], flops, nbytes)
+            return output
+        return wrapper
+
+    def _record(self, name: str, category: str, start_ns: int, duration: int, self_duration: int, flops: int, nbytes: int):
+        stats = self.stats[(name, self._phase)]
+        stats["calls"] += 1
+        stats["total_ns"] += duration
+        stats["self_ns"] += self_duration
+        stats["flops"] += flops
+        stats["bytes"] += nbytes
+        self.categories[name] = category
+        if self.record_events and len(self.events) < self.max_events:
+            self.events.append({
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                # Microseconds
+                "ts": (start_ns - self._origin_ns) / 1000,
+                "dur": duration / 1000,
+                "pid": 0,
+                "tid": 0,
+                "args": {"phase": self._phase, "flops": flops, "bytes": nbytes},
+            })
+
+    def summary(self) -> list[dict]:
+        # One entry per module name and phase, the slowest first
+        rows = []
+        for (name, phase), stats in self.stats.items():
+            seconds = stats["total_ns"] / 1e9
+            rows.append({
+                "name": name,
+                "category": self.categories[name],
+                "phase": phase,
+                "calls": stats["calls"],
+                "total_ms": stats["total_ns"] / 1e6,
+                "self_ms": stats["self_ns"] / 1e6,
+                "ms_per_forward": stats["total_ns"] / 1e6 / max(self.num_forwards[phase], 1),
+                "flops": stats["flops"],
+                "bytes": stats["bytes"],
+                "gflops_per_second": stats["flops"] / seconds / 1e9 if seconds > 0 else 0.0,
+                "gbytes_per_second": stats["bytes"] / seconds / 1e9 if seconds > 0 else 0.0,
+            })
+        return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+    def breakdown(self) -> dict[str, dict[str, float]]:
+        # phase -> category -> self time in ms per forward pass
+        result = defaultdict(lambda: defaultdict(float))
+        for row in self.summary():
+            result[row["phase"]][row["category"]] += row["self_ms"] / max(self.num_forwards[row["phase"]], 1)
+        return {phase: dict(categories) for phase, categories in result.items()}
+
+    def print_summary(self, top: int = 20):
+        for phase, categories in self.breakdown().items():
+            total = sum(categories.values())
+            print(f"{phase}: {self.num_forwards[phase]} forward passes, {total:.3f}ms each")
+            for category, ms in sorted(categories.items(), key=lambda item: item[1], reverse=True):
+                print(f"  {category:<14} {ms:9.3f}ms {ms / total if total > 0 else 0.0:7.1%}")
+        print(f"{'name':<32} {'phase':<8} {'calls':>7} {'total ms':>10} {'self ms':>10} {'GFLOP/s':>9} {'GB/s':>8}")
+        for row in self.summary()[:top]:
+            print(f"{row['name']:<32} {row['phase']:<8} {row['calls']:>7} {row['total_ms']:>10.3f} {row['self_ms']:>10.3f} "
+                  f"{row['gflops_per_second']:>9.2f} {row['gbytes_per_second']:>8.2f}")
+
+    def save_json(self, path: str):
+        with open(path, "w") as f:
+            f.write(json.dumps({
+                "num_forwards": dict(self.num_forwards),
+                "breakdown": self.breakdown(),
+                "summary": self.summary(),
+            }, indent=2))
+
+    def export_chrome_trace(self, path: str):
+        # Opens in chrome://tracing or https://ui.perfetto.dev
+        with open(path, "w") as f:
+            f.write(json.dumps({"traceEvents": self.events, "displayTimeUnit": "ms"}))
+
+
+if __name__ == '__main__':
+    import argparse
+    from benchmark import StubTokenizer
+    from LLaMA import LLaMA
+    from model import ModelArgs
+    from sampling import SamplingParams
+
+    parser = argparse.ArgumentParser(description="Profile generation with random weights on the CPU")
+    parser.add_argument("--dim", type=int, default=512)
+    parser.add_argument("--n-layers", type=int, default=4)
+    parser.add_argument("--n-heads", type=int, default=8)
+    parser.add_argument("--n-kv-heads", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--prompt-len", type=int, default=128)
+    parser.add_argument("--gen-len", type=int, default=64)
+    parser.add_argument("--json", default="profile.json")
+    parser.add_argument("--trace", default="trace.json")
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    model_args = ModelArgs(
+        dim=args.dim, n_layers=args.n_layers, n_heads=args.n_heads, n_kv_heads=args.n_kv_heads, vocab_size=32000,
+        max_batch_size=args.batch_size, max_seq_len=args.prompt_len + args.gen_len, device="cpu"
+    )
+    llama = LLaMA(Transformer(model_args), StubTokenizer(model_args.vocab_size), model_args)
+    prompt_tokens = torch.randint(3, model_args.vocab_size, (args.batch_size, args.prompt_len)).tolist()
+    with torch.no_grad(), Profiler(llama.model) as profiler:
+        for _ in llama._generate(prompt_tokens, [SamplingParams(max_tokens=args.gen_len)] * args.batch_size, args.gen_len, 512):
+            pass
+    profiler.print_summary()
+    profiler.save_json(args.json)
+    profiler.export_chrome_trace(args.trace)
+    print(f'Saved "{args.json}" and "{args.trace}"')
@@ -0,0 +1,212 @@
+from pathlib import Path
+from typing import Optional
+import argparse
+import json
+import shutil
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from model import ModelArgs, Transformer
+from checkpoint import load_state_dict
+
+# Recent PyTorch builds ship a CPU kernel multiplying bf16/fp32 activations by int8 weights with per-channel scales
+HAS_INT8_MM = hasattr(torch, "_weight_int8pack_mm")
+# and one for int4 weights with group scales, which needs the weights repacked in its own tiled layout
+HAS_INT4_MM = hasattr(torch, "_weight_int4pack_mm") or hasattr(torch, "_weight_int4pack_mm_for_cpu")
+INT4_INNER_K_TILES = 8
+# Without a kernel, the weight is dequantized this many output channels at a time, so only a tile of it
+# ever exists in the activation dtype
+DEQUANT_TILE_ROWS = 1024
+
+
+class QuantizedLinear(nn.Module):
+    # Weight-only quantized replacement of nn.Linear (bias=False), the activations stay in the model dtype.
+    #  bits=8: symmetric int8 weights with one scale per output channel
+    #  bits=4: symmetric int4 weights with one scale per group of group_size inputs, two weights packed per byte
+
+    def __init__(self, in_features: int, out_features: int, bits: int = 8, group_size: int = 128):
+        super().__init__()
+        assert bits in (4, 8), "Only 8 and 4 bits quantization are supported"
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            # (Out, In)
+            self.register_buffer("qweight", torch.empty((out_features, in_features), dtype=torch.int8))
+            # (Out)
+            self.register_buffer("scales", torch.empty((out_features,)))
+        else:
+            assert in_features % group_size == 0, "in_features must be divisible by group_size"
+            # (Out, In / 2)
+            self.register_buffer("qweight", torch.empty((out_features, in_features // 2), dtype=torch.uint8))
+            # (Out, In / Group_Size)
+            self.register_buffer("scales", torch.empty((out_features, in_features // group_size)))
+        # Weight repacked for the int4 kernel on the first forward: {"dtype", "packed", "scales_and_zeros", "mm"},
+        # or {"failed": True} without a kernel. Not part of the state dict, and shared with the modules bound to the
+        # same weights (see build_layer_skip_draft) so that it is computed and held only once
+        self._int4pack = {}
+
+    @staticmethod
+    def from_linear(linear: nn.Linear, bits: int = 8, group_size: int = 128) -> "QuantizedLinear":
+        out_features, in_features = linear.weight.shape
+        module = QuantizedLinear(in_features, out_features, bits, group_size)
+        weight = linear.weight.detach().float()
+        if bits == 8:
+            # (Out, In) -> (Out)
+            scales = weight.abs().amax(dim=1).clamp(min=1e-8) / 127
+            qweight = torch.round(weight / scales[:, None]).clamp(-127, 127).to(torch.int8)
+        else:
+            # (Out, In) -> (Out, In / Group_Size, Group_Size)
+            groups = weight.view(out_features, -1, group_size)
+            # (Out, In / Group_Size)
+            scales = groups.abs().amax(dim=-1).clamp(min=1e-8) / 7
+            # Shift [-8, 7] to [0, 15], so that each value fits in a nibble
+            qweight = (torch.round(groups / scales[..., None]).clamp(-8, 7) + 8).to(torch.uint8).view(out_features, in_features)
+            # (Out, In) -> (Out, In / 2): even inputs in the low nibble, odd inputs in the high one
+            qweight = qweight[:, 0::2] | (qweight[:, 1::2] << 4)
+        module.qweight = qweight
+        # The scales are kept in the dtype of the original weight
+        module.scales = scales.to(linear.weight.dtype)
+        return module
+
+    def dequantize(self, dtype: torch.dtype, start: int = 0, end: Optional[int] = None) -> torch.Tensor:
+        # (End - Start, In) rows [start, end) of the weight in the given dtype
+        end = self.out_features if end is None else end
+        if self.bits == 8:
+            return self.qweight[start:end].to(dtype) * self.scales[start:end].to(dtype)[:, None]
+        # (Rows, In / 2) -> (Rows, In / 2, 2) -> (Rows, In)
+        qweight = self._unpack_int4(self.qweight[start:end])
+        # (Rows, In) -> (Rows, In / Group_Size, Group_Size)
+        groups = (qweight.to(dtype) - 8).view(end - start, -1, self.group_size)
+        return (groups * self.scales[start:end].to(dtype)[..., None]).view(end - start, self.in_features)
+
+    def _unpack_int4(self, qweight: torch.Tensor) -> torch.Tensor:
+        # (Rows, In / 2) -> (Rows, In) values in [0, 15]
+        return torch.stack([qweight & 0x0F, qweight >> 4], dim=-1).view(qweight.shape[0], self.in_features)
+
+    def _int4_kernel(self, dtype: torch.dtype) -> Optional[dict]:
+        # Repacks the weight for the int4 kernel of this PyTorch build, in the activation dtype of the first call.
+        # The kernel and its packing function changed across versions, so every known variant is tried and kept
+        # only if it reproduces the dequantized matmul
+        pack = self._int4pack
+        if not pack:
+            pack["failed"] = True
+            if HAS_INT4_MM and self.out_features % 8 == 0 and self.in_features % (INT4_INNER_K_TILES * 16) == 0:
+                self._repack_int4(dtype)
+        if pack.get("failed"):
+            return None
+        if self.qweight.device.type != "meta":
+            # The packed weight replaces qweight, which is dropped so that the model holds its weights only once.
+            # A meta tensor keeps its place (and shape) in the state dict: save a quantized checkpoint before any forward
+            self.qweight = torch.empty_like(self.qweight, device="meta")
+        return pack
+
+    def _repack_int4(self, dtype: torch.dtype):
+        # (Out, In) values in [0, 15], the kernel computes (q - 8) * scale + zero
+        unpacked = self._unpack_int4(self.qweight)
+        # (In / Group_Size, Out, 2)
+        scales_and_zeros = torch.stack([self.scales.t(), torch.zeros_like(self.scales.t())], dim=-1).to(dtype).contiguous()
+        candidates = [
+            # PyTorch >= 2.6 on the CPU: (Out, In) int32
+            ("_convert_weight_to_int4pack_for_cpu", "_weight_int4pack_mm_for_cpu", lambda: unpacked.to(torch.int32)),
+            # PyTorch 2.5: (Out, In / 2) uint8, even inputs in the high nibble
+            ("_convert_weight_to_int4pack", "_weight_int4pack_mm", lambda: (unpacked[:, 0::2] << 4) | unpacked[:, 1::2]),
+            # Older versions: (Out, In) int32
+            ("_convert_weight_to_int4pack", "_weight_int4pack_mm", lambda: unpacked.to(torch.int32)),
+        ]
+        x = torch.randn((2, self.in_features), dtype=dtype, device=self.qweight.device)
+        expected = self._tiled_linear(x).float()
+        for convert_name, mm_name, weight in candidates:
+            if not (hasattr(torch, convert_name) and hasattr(torch, mm_name)):
+                continue
+            try:
+                packed = getattr(torch, convert_name)(weight().contiguous(), INT4_INNER_K_TILES)
+                mm = getattr(torch, mm_name)
+                out = mm(x, packed, self.group_size, scales_and_zeros).float()
+            except (RuntimeError, TypeError, NotImplementedError):
+                continue
+            if (out - expected).norm() <= 1e-2 * expected.norm():
+                self._int4pack.clear()
+                self._int4pack.update(dtype=dtype, packed=packed, scales_and_zeros=scales_and_zeros, mm=mm)
+                return
+
+    def _tiled_linear(self, x: torch.Tensor) -> torch.Tensor:
+        # (B, Seq_Len, In) -> (B, Seq_Len, Out), dequantizing DEQUANT_TILE_ROWS output channels at a time
+        out = x.new_empty((*x.shape[:-1], self.out_features))
+        for start in range(0, self.out_features, DEQUANT_TILE_ROWS):
+            end = min(start + DEQUANT_TILE_ROWS, self.out_features)
+            out[..., start:end] = F.linear(x, self.dequantize(x.dtype, start, end))
+        return out
+
+    def forward(self, x: torch.Tensor):
+        if x.device.type == "cpu":
+            if self.bits == 8 and HAS_INT8_MM:
+                # (B, Seq_Len, In) -> (B * Seq_Len, In) -> (B * Seq_Len, Out) -> (B, Seq_Len, Out)
+                out = torch._weight_int8pack_mm(x.reshape(-1, self.in_features), self.qweight, self.scales.to(x.dtype))
+                return out.view(*x.shape[:-1], self.out_features)
+            pack = self._int4_kernel(x.dtype) if self.bits == 4 else None
+            if pack is not None:
+                # (B, Seq_Len, In) -> (B * Seq_Len, In) -> (B * Seq_Len, Out) -> (B, Seq_Len, Out), in the dtype of the packing
+                out = pack["mm"](x.reshape(-1, self.in_features).to(pack["dtype"]).contiguous(), pack["packed"], self.group_size, pack["scales_and_zeros"])
+                return out.to(x.dtype).view(*x.shape[:-1], self.out_features)
+        # No kernel: the weight is never materialized whole in the activation dtype
+        return self._tiled_linear(x)
+
+
+def quantize_model(model: Transformer, bits: int = 8, group_size: int = 128, from_weights: bool = True) -> Transformer:
+    # Replaces every nn.Linear of the model (attention, feed forward and output head) in place.
+    # With from_weights=False only the structure is changed, to load an already quantized checkpoint
+    for module in list(model.modules()):
+        for child_name, child in list(module.named_children()):
+            if isinstance(child, nn.Linear):
+                if from_weights:
+                    quantized = QuantizedLinear.from_linear(child, bits, group_size)
+                else:
+                    quantized = QuantizedLinear(child.in_features, child.out_features, bits, group_size)
+                setattr(module, child_name, quantized)
+    return model
+
+
+def load_quantization_config(checkpoints_dir: str):
+    # The bits and group size of a checkpoint saved by quantize_checkpoint, None for a regular checkpoint
+    config_path = Path(checkpoints_dir) / "quantization.json"
+    if not config_path.exists():
+        return None
+    with open(config_path, "r") as f:
+        return json.loads(f.read())
+
+
+def quantize_checkpoint(checkpoints_dir: str, out_dir: str, bits: int, group_size: int):
+    prev_time = time.time()
+    with open(Path(checkpoints_dir) / "params.json", "r") as f:
+        params = json.loads(f.read())
+    state_dict = load_state_dict(checkpoints_dir)
+    model_args = ModelArgs(max_seq_len=1, max_batch_size=1, device="cpu", **params)
+    model_args.vocab_size = state_dict["output.weight"].shape[0]
+
+    with torch.device("meta"):
+        model = Transformer(model_args)
+    model.load_state_dict(state_dict, strict=True, assign=True)
+    quantize_model(model, bits, group_size)
+    print(f"Quantized to {bits} bits in {time.time() - prev_time:.2f}s")
+
+    out_path = Path(out_dir)
+    out_path.mkdir(parents=True, exist_ok=True)
+    shutil.copy(Path(checkpoints_dir) / "params.json", out_path / "params.json")
+    with open(out_path / "quantization.json", "w") as f:
+        f.write(json.dumps({"bits": bits, "group_size": group_size}))
+    torch.save(model.state_dict(), out_path / "consolidated.00.pth")
+    print(f'Saved quantized checkpoint to "{out_path}"')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a LLaMA checkpoint to weight-only int8/int4")
+    parser.add_argument("checkpoints_dir", help="directory with the checkpoint and params.json")
+    parser.add_argument("out_dir", help="directory where the quantized checkpoint is written")
+    parser.add_argument("--bits", type=int, default=8, choices=[4, 8])
+    parser.add_argument("--group-size", type=int, default=128, help="inputs sharing a scale with --bits 4")
+    args = parser.parse_args()
+    quantize_checkpoint(args.checkpoints_dir, args.out_dir, args.bits, args.group_size)
@@ -0,0 +1,151 @@
+import math
+from dataclasses import dataclass, field
+from typing import Optional
+import torch
+
+
+@dataclass
+class SamplingParams:
+    # 0 for greedy decoding
+    temperature: float = 0.6
+    # Smallest set of tokens whose probabilities add up to top_p, 1.0 to disable
+    top_p: float = 0.9
+    # Only the top_k most likely tokens, 0 to disable
+    top_k: int = 0
+    # Only the tokens at least min_p times as likely as the most likely one, 0.0 to disable
+    min_p: float = 0.0
+    # The logits of the tokens already in the prompt or the output are divided by it (multiplied when negative), 1.0 to disable
+    repetition_penalty: float = 1.0
+    # Subtracted from the logits once per occurrence of the token in the output, 0.0 to disable
+    frequency_penalty: float = 0.0
+
+    # The following ones are not used by the Sampler, they end the sequence
+    # Maximum number of generated tokens, None for the max_gen_len of the call
+    max_tokens: Optional[int] = None
+    # The completion is cut before the first of these strings
+    stop: list[str] = field(default_factory=list)
+    # The completion ends (without them) at the first of these tokens, like at EOS
+    stop_token_ids: list[int] = field(default_factory=list)
+
+    def __post_init__(self):
+        # Out of these ranges the Sampler would give multinomial NaN or all-zero rows, which fail the whole batch
+        if not (math.isfinite(self.temperature) and self.temperature >= 0):
+            raise ValueError(f"temperature must be a finite number >= 0, got {self.temperature}")
+        if not 0 < self.top_p <= 1:
+            raise ValueError(f"top_p must be in (0, 1], got {self.top_p}")
+        if self.top_k < 0:
+            raise ValueError(f"top_k must be >= 0, got {self.top_k}")
+        if not 0 <= self.min_p <= 1:
+            raise ValueError(f"min_p must be in [0, 1], got {self.min_p}")
+        if not (math.isfinite(self.repetition_penalty) and self.repetition_penalty > 0):
+            raise ValueError(f"repetition_penalty must be a finite number > 0, got {self.repetition_penalty}")
+        if not math.isfinite(self.frequency_penalty):
+            raise ValueError(f"frequency_penalty must be a finite number, got {self.frequency_penalty}")
+        # 0 would be ambiguous between "no tokens" and "the default": neither is accepted
+        if self.max_tokens is not None and self.max_tokens <= 0:
+            raise ValueError(f"max_tokens must be positive, got {self.max_tokens}")
+
+
+def _token_counts(tokens: list[list[int]], vocab_size: int, device) -> torch.Tensor:
+    # (B, vocab_size) number of occurrences of every token in each row
+    max_len = max((len(t) for t in tokens), default=0)
+    # Rows are padded with an extra token id, dropped at the end
+    padded = torch.full((len(tokens), max(max_len, 1)), vocab_size, dtype=torch.long, device=device)
+    for k, t in enumerate(tokens):
+        padded[k, : len(t)] = torch.tensor(t, dtype=torch.long, device=device)
+    counts = torch.zeros((len(tokens), vocab_size + 1), device=device)
+    counts.scatter_add_(1, padded, torch.ones_like(padded, dtype=counts.dtype))
+    return counts[:, :vocab_size]
+
+
+class Sampler:
+    """
+    Samples the next token of every row of a batch, each row with its own SamplingParams.
+
+    Instead of sorting the whole vocabulary, only the num_candidates most likely tokens (or more, for a larger top_k)
+    are selected with torch.topk and the top k / top p / min p filters are applied to them. Their probabilities are
+    normalized over the whole vocabulary, so the result is the same as with a full sort. Only when a row's nucleus
+    could extend past the candidates (a flat distribution with a large top p and no top k), the batch falls back
+    to the full sort.
+    """
+
+    def __init__(self, num_candidates: int = 64):
+        self.num_candidates = num_candidates
+
+    def __call__(
+        self,
+        logits: torch.Tensor,
+        params: list[SamplingParams],
+        prompt_tokens: Optional[list[list[int]]] = None,
+        output_tokens: Optional[list[list[int]]] = None,
+    ) -> torch.Tensor:
+        # (B, vocab_size) -> (B)
+        batch_size, vocab_size = logits.shape
+        device = logits.device
+        logits = logits.float()
+
+        if any(p.repetition_penalty != 1.0 or p.frequency_penalty != 0.0 for p in params):
+            prompt_tokens = prompt_tokens if prompt_tokens is not None else [[] for _ in params]
+            output_tokens = output_tokens if output_tokens is not None else [[] for _ in params]
+            logits = self._apply_penalties(logits, params, prompt_tokens, output_tokens)
+
+        # (B)
+        temperature = torch.tensor([p.temperature for p in params], device=device)
+        greedy = temperature == 0
+        if bool(greedy.all()):
+            return logits.argmax(dim=-1)
+
+        # (B, 1)
+        top_p = torch.tensor([p.top_p for p in params], device=device)[:, None]
+        min_p = torch.tensor([p.min_p for p in params], device=device)[:, None]
+        # (B, 1) A disabled top k keeps the whole vocabulary
+        top_k = torch.tensor([p.top_k if p.top_k > 0 else vocab_size for p in params], dtype=torch.long, device=device)[:, None]
+
+        # The temperature is applied before the softmax
+        logits = logits / torch.where(greedy, 1.0, temperature)[:, None]
+        # (B, 1)
+        log_norm = torch.logsumexp(logits, dim=-1, keepdim=True)
+
+        num_candidates = min(vocab_size, max([self.num_candidates] + [p.top_k for p in params]))
+        # (B, vocab_size) -> (B, Num_Candidates), sorted in descending order
+        candidate_logits, candidate_idx = torch.topk(logits, num_candidates, dim=-1)
+        candidate_probs = torch.exp(candidate_logits - log_norm)
+        if num_candidates < vocab_size:
+            # The candidates are enough if the row's top k is within them, if they already cover top p,
+            # or if the least likely of them is already below the min p threshold
+            complete = (
+                (top_k <= num_candidates)
+                | (candidate_probs.sum(dim=-1, keepdim=True) > top_p)
+                | (candidate_probs[:, -1:] < min_p * candidate_probs[:, :1])
+            )
+            if not bool(complete.all()):
+                candidate_probs, candidate_idx = torch.sort(torch.exp(logits - log_norm), dim=-1, descending=True)
+
+        # (B, Num_Candidates)
+        rank = torch.arange(candidate_probs.shape[-1], device=device)[None, :]
+        mask = rank >= top_k
+        # (Substracting "candidate_probs" shifts the cumulative sum by 1 position to the right before masking)
+        mask |= torch.cumsum(candidate_probs, dim=-1) - candidate_probs > top_p
+        mask |= candidate_probs < min_p * candidate_probs[:, :1]
+        # The most likely token is never masked (top_p > 0 and min_p <= 1, see SamplingParams), so every row keeps at least one token.
+        # multinomial does not need the probabilities to sum up to 1
+        candidate_probs = candidate_probs.masked_fill(mask, 0.0)
+        # (B, 1)
+        next_token = torch.multinomial(candidate_probs, num_samples=1)
+        # Get the token position in the vocabulary corresponding to the sampled candidate
+        next_token = torch.gather(candidate_idx, -1, next_token).squeeze(-1)
+        # Greedy rows take the most likely token
+        return torch.where(greedy, candidate_idx[:, 0], next_token)
+
+    def _apply_penalties(self, logits: torch.Tensor, params: list[SamplingParams], prompt_tokens: list[list[int]], output_tokens: list[list[int]]) -> torch.Tensor:
+        batch_size, vocab_size = logits.shape
+        device = logits.device
+        # (B, 1)
+        repetition_penalty = torch.tensor([p.repetition_penalty for p in params], device=device)[:, None]
+        frequency_penalty = torch.tensor([p.frequency_penalty for p in params], device=device)[:, None]
+        # (B, vocab_size)
+        output_counts = _token_counts(output_tokens, vocab_size, device)
+        seen = (output_counts + _token_counts(prompt_tokens, vocab_size, device)) > 0
+        penalized = torch.where(logits > 0, logits / repetition_penalty, logits * repetition_penalty)
+        logits = torch.where(seen, penalized, logits)
+        return logits - frequency_penalty * output_counts
@@ -0,0 +1,251 @@
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Iterator, Optional, Union
+import itertools
+import time
+import torch
+
+from LLaMA import LLaMA
+from streaming import CompletionStream
+from sampling import SamplingParams
+from static_decode import StaticDecoder
+
+
+@dataclass
+class Sequence:
+    request_id: int
+    prompt_tokens: list[int]
+    sampling_params: SamplingParams
+    max_gen_len: int
+    output_tokens: list[int] = field(default_factory=list)
+    # Row of the KV cache owned by the sequence while it is running
+    slot: Optional[int] = None
+    finished: bool = False
+    # Turns the output tokens into text as they are produced and detects the stop strings and tokens
+    stream: Optional[CompletionStream] = None
+
+    @property
+    def num_tokens(self) -> int:
+        return len(self.prompt_tokens) + len(self.output_tokens)
+
+
+@dataclass
+class SequenceOutput:
+    request_id: int
+    token: int
+    finished: bool
+    # Text added by the token, empty while it only holds part of a character
+    text_delta: str = ""
+    # The decoded completion, only set on the last output of a sequence
+    text: Optional[str] = None
+    # "stop" (EOS, a stop token or a stop string) or "length", only set on the last output of a sequence
+    finish_reason: Optional[str] = None
+
+
+class Scheduler:
+    """
+    Continuous batching on top of the KV cache of the Transformer.
+
+    Each of the max_batch_size cache slots holds one running sequence. At every step the running sequences
+    are decoded together, the ones that produced EOS (or ran out of tokens) give their slot back, and queued
+    requests are prefilled into the free slots, so the batch never waits for its slowest member.
+    """
+
+    def __init__(self, llama: LLaMA, prefill_chunk_size: int = 512, static_decode: bool = False, compile: bool = True):
+        self.model = llama.model
+        self.tokenizer = llama.tokenizer
+        self.args = llama.args
+        self.sampler = llama.sampler
+        self.prefix_cache = llama.prefix_cache
+        self.prefill_chunk_size = prefill_chunk_size
+        self.device = llama.args.device
+        # Decode steps with fixed shapes (the whole cache, masked), compiled with torch.compile when possible
+        self.static_decoder = StaticDecoder(self.model, compile) if static_decode else None
+
+        self.waiting: deque[Sequence] = deque()
+        self.running: list[Sequence] = []
+        self.free_slots = list(range(self.args.max_batch_size - 1, -1, -1))
+        self._request_ids = itertools.count()
+
+        # Throughput counters
+        self.num_generated_tokens = 0
+        self.busy_time = 0.0
+
+    def add_request(self, prompt: Union[str, list[int]], sampling_params: Optional[SamplingParams] = None, max_gen_len: Optional[int] = None) -> int:
+        # The prompt is either a text or already tokenized (e.g. a chat with its special tokens)
+        if isinstance(prompt, str):
+            prompt_tokens = self.tokenizer.encode(prompt, out_type=int, add_bos=True, add_eos=False)
+        else:
+            prompt_tokens = list(prompt)
+        # Make sure there is room for at least one generated token
+        assert len(prompt_tokens) < self.args.max_seq_len, f"prompt length must be less than {self.args.max_seq_len}"
+        if max_gen_len is None:
+            max_gen_len = self.args.max_seq_len - 1
+        if sampling_params is None:
+            sampling_params = SamplingParams()
+        if sampling_params.max_tokens is not None:
+            max_gen_len = sampling_params.max_tokens
+        seq = Sequence(next(self._request_ids), prompt_tokens, sampling_params, max_gen_len)
+        seq.stream = CompletionStream(self.tokenizer, prompt_tokens, sampling_params.stop, sampling_params.stop_token_ids)
+        self.waiting.append(seq)
+        return seq.request_id
+
+    def abort(self, request_id: int):
+        # Drops a request, e.g. when its client is gone, giving its slot back if it was running
+        for seq in self.waiting:
+            if seq.request_id == request_id:
+                self.waiting.remove(seq)
+                seq.finished = True
+                return
+        for seq in self.running:
+            if seq.request_id == request_id:
+                self._retire(seq)
+                seq.finished = True
+                return
+
+    def has_unfinished(self) -> bool:
+        return len(self.waiting) > 0 or len(self.running) > 0
+
+    def step(self) -> list[SequenceOutput]:
+        start_time = time.time()
+        outputs = []
+
+        # Decode one token for every running sequence in a single batched forward pass
+        if len(self.running) > 0:
+            running = list(self.running)
+            if self.static_decoder is not None:
+                # (B, vocab_size)
+                logits = self.static_decoder(
+                    [seq.output_tokens[-1] for seq in running], [seq.num_tokens - 1 for seq in running], [seq.slot for seq in running]
+                )
+            else:
+                logits = self._decode(running)
+            next_tokens = self._sample(logits, running)
+            for seq, next_token in zip(running, next_tokens):
+                outputs.append(self._append_token(seq, next_token))
+
+        # Admit queued requests into the slots that are free, including the ones just given back
+        while len(self.waiting) > 0 and len(self.free_slots) > 0:
+            seq = self.waiting.popleft()
+            seq.slot = self.free_slots.pop()
+            self.running.append(seq)
+            logits = self._prefill(seq)
+            outputs.append(self._append_token(seq, self._sample(logits, [seq])[0]))
+
+        self.busy_time += time.time() - start_time
+        return outputs
+
+    def stream(self) -> Iterator[SequenceOutput]:
+        # Yields the tokens of every request as soon as they are produced, until the queue is drained
+        while self.has_unfinished():
+            yield from self.step()
+
+    def tokens_per_second(self) -> float:
+        return self.num_generated_tokens / self.busy_time if self.busy_time > 0 else 0.0
+
+    def _decode(self, running: list[Sequence]) -> torch.Tensor:
+        # (B, 1)
+        tokens = torch.tensor([[seq.output_tokens[-1]] for seq in running], dtype=torch.long, device=self.device)
+        # (B) The last token of each sequence is not in the cache yet
+        start_pos = torch.tensor([seq.num_tokens - 1 for seq in running], dtype=torch.long, device=self.device)
+        # (B)
+        slots = torch.tensor([seq.slot for seq in running], dtype=torch.long, device=self.device)
+        with torch.no_grad():
+            logits = self.model.forward(tokens, start_pos, slots)
+        # (B, vocab_size)
+        return logits[:, -1]
+
+    def _prefill(self, seq: Sequence) -> torch.Tensor:
+        # (1, Seq_Len)
+        tokens = torch.tensor([seq.prompt_tokens], dtype=torch.long, device=self.device)
+        # (1)
+        slots = torch.tensor([seq.slot], dtype=torch.long, device=self.device)
+        # Only the part of the prompt that is not already in the prefix cache has to be computed
+        num_cached = 0
+        if self.prefix_cache is not None:
+            num_cached = self.prefix_cache.load(seq.slot, seq.prompt_tokens)
+        with torch.no_grad():
+            for chunk_start in range(num_cached, tokens.shape[1], self.prefill_chunk_size):
+                logits = self.model.forward(tokens[:, chunk_start:chunk_start + self.prefill_chunk_size], chunk_start, slots)
+        if self.prefix_cache is not None:
+            self.prefix_cache.store(seq.slot, seq.prompt_tokens)
+        # (1, vocab_size)
+        return logits[:, -1]
+
+    def _sample(self, logits: torch.Tensor, seqs: list[Sequence]) -> list[int]:
+        # (B, vocab_size) -> B tokens, each row with the sampling parameters of its own request
+        next_tokens = self.sampler(
+            logits,
+            [seq.sampling_params for seq in seqs],
+            [seq.prompt_tokens for seq in seqs],
+            [seq.output_tokens for seq in seqs],
+        )
+        return next_tokens.tolist()
+
+    def _append_token(self, seq: Sequence, token: int) -> SequenceOutput:
+        seq.output_tokens.append(token)
+        self.num_generated_tokens += 1
+        text_delta = seq.stream.step(token)
+        seq.finished = (
+            seq.stream.finished # EOS, a stop token or a stop string
+            or len(seq.output_tokens) >= seq.max_gen_len
+            or seq.num_tokens >= self.args.max_seq_len
+        )
+        if not seq.finished:
+            return SequenceOutput(seq.request_id, token, False, text_delta)
+
+        self._retire(seq)
+        # Whatever text the stream was still holding back
+        text_delta += seq.stream.finish()
+        finish_reason = "stop" if seq.stream.stopped else "length"
+        return SequenceOutput(seq.request_id, token, True, text_delta, seq.stream.text, finish_reason)
+
+    def _retire(self, seq: Sequence):
+        # Give the slot of the sequence back, stale dense cache entries are masked out for the next owner
+        self.running.remove(seq)
+        self.model.release([seq.slot])
+        self.free_slots.append(seq.slot)
+        seq.slot = None
+
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+
+    allow_cuda = False
+    device = 'cuda' if torch.cuda.is_available() and allow_cuda else 'cpu'
+
+    prompts = [
+        "Simply put, the theory of relativity states that ",
+        "If Google was an Italian company founded in Milan, it would",
+        """Translate English to French:
+
+        sea otter => loutre de mer
+        peppermint => menthe poivrée
+        plush girafe => girafe peluche
+        cheese =>""",
+        """Tell me if the following person is actually Doraemon disguised as human:
+        Name: Umar Jamil
+        Decision:
+        """
+    ]
+
+    model = LLaMA.build(
+        checkpoints_dir='llama-2-7b/',
+        tokenizer_path='tokenizer.model',
+        load_model=True,
+        max_seq_len=1024,
+        max_batch_size=2,
+        device=device
+    )
+
+    # More requests than slots: the later ones are admitted as soon as an earlier one finishes
+    scheduler = Scheduler(model)
+    for prompt in prompts:
+        scheduler.add_request(prompt, max_gen_len=64)
+    # Requests with different settings share the same batch
+    scheduler.add_request(prompts[2], SamplingParams(temperature=0, max_tokens=16, stop=["\n"]))
+    for output in scheduler.stream():
+        if output.finished:
+            print(f'[{output.request_id}] {output.text}')
+            print('-' * 50)
+    print(f'{scheduler.tokens_per_second():.2f} tokens/s')
@@ -0,0 +1,408 @@
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Optional
+import argparse
+import asyncio
+import json
+import time
+import uuid
+import torch
+
+from LLaMA import LLaMA
+from scheduler import Scheduler, SequenceOutput
+from sampling import SamplingParams
+
+B_INST, E_INST = "[INST]", "[/INST]"
+B_SYS, E_SYS = "<<SYS>>\n", "\n<</SYS>>\n\n"
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 429: "Too Many Requests", 500: "Internal Server Error", 504: "Gateway Timeout"}
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status: int, message: str, error_type: str = "invalid_request_error"):
+        super().__init__(message)
+        self.status = status
+        self.error_type = error_type
+
+
+@dataclass
+class Request:
+    prompt_tokens: list[int]
+    sampling_params: SamplingParams
+    max_gen_len: Optional[int]
+    # Receives the SequenceOutputs of the request (or the exception that ended the engine step)
+    outputs: asyncio.Queue = field(default_factory=asyncio.Queue)
+    # Assigned by the Scheduler once the engine picked the request up
+    request_id: Optional[int] = None
+    aborted: bool = False
+
+
+class Engine:
+    """
+    Runs a single Scheduler for all the HTTP requests.
+
+    New requests are queued here and handed over to the Scheduler between two steps, so every step decodes the
+    running sequences as one batch and admits the queued requests into the free slots (dynamic batching).
+    The steps run in a single worker thread, the only one that touches the model and the Scheduler, so the event
+    loop keeps serving the clients meanwhile.
+    """
+
+    def __init__(self, llama: LLaMA, max_queue: int, prefill_chunk_size: int = 512, static_decode: bool = False):
+        self.scheduler = Scheduler(llama, prefill_chunk_size, static_decode)
+        self.max_queue = max_queue
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._pending: list[Request] = []
+        self._aborted: list[int] = []
+        self._active: dict[int, Request] = {}
+        self._wakeup = asyncio.Event()
+        self.start_time = time.time()
+        # Request counters for the metrics endpoint
+        self.num_requests = 0
+        self.num_rejected = 0
+        self.num_timed_out = 0
+
+    def queue_depth(self) -> int:
+        # Requests waiting for a slot, in this queue or in the Scheduler's one
+        return len(self._pending) + len(self.scheduler.waiting)
+
+    def submit(self, request: Request):
+        # Backpressure: once max_queue requests are waiting, new ones are rejected instead of piling up
+        if self.queue_depth() >= self.max_queue:
+            self.num_rejected += 1
+            raise HTTPError(429, f"the queue is full ({self.max_queue} waiting requests), retry later", "rate_limit_error")
+        self.num_requests += 1
+        self._pending.append(request)
+        self._wakeup.set()
+
+    def abort(self, request: Request):
+        # The client is gone or its timeout expired: stop generating for it and free its slot
+        request.aborted = True
+        if request in self._pending:
+            self._pending.remove(request)
+        elif request.request_id is not None:
+            self._aborted.append(request.request_id)
+            self._wakeup.set()
+
+    def metrics(self) -> dict:
+        return {
+            "queue_depth": self.queue_depth(),
+            "running": len(self.scheduler.running),
+            "free_slots": len(self.scheduler.free_slots),
+            "tokens_per_second": self.scheduler.tokens_per_second(),
+            "generated_tokens": self.scheduler.num_generated_tokens,
+            "busy_seconds": self.scheduler.busy_time,
+            "uptime_seconds": time.time() - self.start_time,
+            "requests_total": self.num_requests,
+            "requests_rejected": self.num_rejected,
+            "requests_timed_out": self.num_timed_out,
+        }
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            if len(self._pending) == 0 and len(self._aborted) == 0 and not self.scheduler.has_unfinished():
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            # Take the requests and aborts that arrived during the last step, the event loop keeps filling new lists
+            pending, self._pending = self._pending, []
+            aborted, self._aborted = self._aborted, []
+            try:
+                outputs = await loop.run_in_executor(self._executor, self._step, pending, aborted)
+            except Exception as e:
+                # Fail the requests in flight rather than the whole server
+                for request in list(self._active.values()) + pending:
+                    request.outputs.put_nowait(e)
+                    if request.request_id is not None:
+                        self.scheduler.abort(request.request_id)
+                self._active.clear()
+                continue
+            # Requests aborted while the step that added them was running
+            self._aborted += [request.request_id for request in pending if request.aborted]
+            for output in outputs:
+                request = self._active.get(output.request_id)
+                if request is None:
+                    continue
+                if output.finished:
+                    del self._active[output.request_id]
+                if not request.aborted:
+                    request.outputs.put_nowait(output)
+
+    def _step(self, pending: list[Request], aborted: list[int]) -> list[SequenceOutput]:
+        # Runs in the worker thread
+        for request_id in aborted:
+            self.scheduler.abort(request_id)
+            self._active.pop(request_id, None)
+        for request in pending:
+            request.request_id = self.scheduler.add_request(request.prompt_tokens, request.sampling_params, request.max_gen_len)
+            self._active[request.request_id] = request
+        if not self.scheduler.has_unfinished():
+            return []
+        return self.scheduler.step()
+
+
+def encode_chat(tokenizer, messages: list[dict]) -> list[int]:
+    # Llama 2 chat format: every exchange is "<s>[INST] user [/INST] assistant </s>", the system prompt goes into the
+    # first user message and the dialog ends with the user message to answer
+    messages = list(messages)
+    if len(messages) > 0 and messages[0].get("role") == "system":
+        if len(messages) < 2:
+            raise HTTPError(400, "a system message must be followed by a user message")
+        messages = [{"role": messages[1].get("role"), "content": B_SYS + messages[0]["content"] + E_SYS + messages[1]["content"]}] + messages[2:]
+    roles = [message.get("role") for message in messages]
+    if len(messages) % 2 == 0 or any(role != ("user" if k % 2 == 0 else "assistant") for k, role in enumerate(roles)):
+        raise HTTPError(400, "messages must alternate user and assistant (after an optional system message) and end with a user message")
+
+    tokens = []
+    for prompt, answer in zip(messages[::2], messages[1::2]):
+        text = f"{B_INST} {prompt['content'].strip()} {E_INST} {answer['content'].strip()} "
+        tokens += [tokenizer.bos_id()] + tokenizer.encode(text, out_type=int, add_bos=False, add_eos=False) + [tokenizer.eos_id()]
+    text = f"{B_INST} {messages[-1]['content'].strip()} {E_INST}"
+    tokens += [tokenizer.bos_id()] + tokenizer.encode(text, out_type=int, add_bos=False, add_eos=False)
+    return tokens
+
+
+def sampling_params_from_body(body: dict) -> SamplingParams:
+    # OpenAI fields, plus the ones of SamplingParams that OpenAI does not have (top_k, min_p, repetition_penalty)
+    stop = body.get("stop") or []
+    if isinstance(stop, str):
+        stop = [stop]
+    if not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise HTTPError(400, "stop must be a string or a list of strings")
+    defaults = SamplingParams()
+    try:
+        return SamplingParams(
+            temperature=float(body.get("temperature", defaults.temperature)),
+            top_p=float(body.get("top_p", defaults.top_p)),
+            top_k=int(body.get("top_k", defaults.top_k)),
+            min_p=float(body.get("min_p", defaults.min_p)),
+            repetition_penalty=float(body.get("repetition_penalty", defaults.repetition_penalty)),
+            frequency_penalty=float(body.get("frequency_penalty", defaults.frequency_penalty)),
+            max_tokens=None if body.get("max_tokens") is None else int(body["max_tokens"]),
+            stop=list(stop),
+        )
+    except (TypeError, ValueError) as e:
+        raise HTTPError(400, f"invalid sampling parameter: {e}")
+
+
+class Server:
+
+    def __init__(self, llama: LLaMA, model_name: str, max_queue: int, timeout: float, prefill_chunk_size: int = 512, static_decode: bool = False):
+        self.llama = llama
+        self.model_name = model_name
+        self.timeout = timeout
+        self.engine = Engine(llama, max_queue, prefill_chunk_size, static_decode)
+
+    async def serve(self, host: str, port: int):
+        engine_task = asyncio.create_task(self.engine.run())
+        server = await asyncio.start_server(self.handle_connection, host, port)
+        print(f"Serving {self.model_name} on http://{host}:{port}")
+        async with server:
+            await asyncio.gather(server.serve_forever(), engine_task)
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        # One request per connection (Connection: close)
+        try:
+            method, path, body = await self._read_request(reader)
+            await self._route(method, path, body, writer)
+        except HTTPError as e:
+            await self._send_json(writer, e.status, {"error": {"message": str(e), "type": e.error_type}})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        except Exception as e:
+            # Never close a connection without an answer
+            await self._send_json(writer, 500, {"error": {"message": f"internal error: {e}", "type": "server_error"}})
+        finally:
+            writer.close()
+
+    async def _route(self, method: str, path: str, body: dict, writer: asyncio.StreamWriter):
+        path = path.split("?", 1)[0]
+        if path == "/metrics" and method == "GET":
+            await self._send_json(writer, 200, self.engine.metrics())
+        elif path == "/v1/models" and method == "GET":
+            await self._send_json(writer, 200, {"object": "list", "data": [{"id": self.model_name, "object": "model", "owned_by": "local"}]})
+        elif path == "/v1/completions" and method == "POST":
+            prompt = body.get("prompt")
+            if isinstance(prompt, list) and len(prompt) == 1:
+                prompt = prompt[0]
+            if not isinstance(prompt, str):
+                raise HTTPError(400, "prompt must be a string (or a list with a single string)")
+            prompt_tokens = self.llama.tokenizer.encode(prompt, out_type=int, add_bos=True, add_eos=False)
+            await self._complete(body, prompt_tokens, writer, chat=False)
+        elif path == "/v1/chat/completions" and method == "POST":
+            messages = body.get("messages")
+            if not isinstance(messages, list) or not all(isinstance(m, dict) and isinstance(m.get("content"), str) for m in messages):
+                raise HTTPError(400, "messages must be a list of {role, content}")
+            await self._complete(body, encode_chat(self.llama.tokenizer, messages), writer, chat=True)
+        elif path in ("/metrics", "/v1/models", "/v1/completions", "/v1/chat/completions"):
+            raise HTTPError(405, f"{method} is not allowed on {path}")
+        else:
+            raise HTTPError(404, f"unknown path {path}", "not_found_error")
+
+    async def _complete(self, body: dict, prompt_tokens: list[int], writer: asyncio.StreamWriter, chat: bool):
+        if len(prompt_tokens) >= self.llama.args.max_seq_len:
+            raise HTTPError(400, f"the prompt has {len(prompt_tokens)} tokens, it must be less than {self.llama.args.max_seq_len}")
+        # Every field is validated before the request is queued, so a bad one never leaves a request generating
+        sampling_params = sampling_params_from_body(body)
+        stream = body.get("stream", False)
+        if not isinstance(stream, bool):
+            raise HTTPError(400, "stream must be a boolean")
+        timeout = body.get("timeout", self.timeout)
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or not 0 < timeout < float("inf"):
+            raise HTTPError(400, "timeout must be a positive number of seconds")
+        request = Request(prompt_tokens, sampling_params, None)
+        self.engine.submit(request)
+
+        try:
+            completion_id = f"{'chatcmpl' if chat else 'cmpl'}-{uuid.uuid4().hex}"
+            created = int(time.time())
+            deadline = time.monotonic() + timeout
+            if stream:
+                await self._send_headers(writer, 200, "text/event-stream", extra="Cache-Control: no-cache\r\n")
+                if chat:
+                    await self._send_event(writer, self._chunk(completion_id, created, chat, {"role": "assistant"}, None))
+
+            num_tokens = 0
+            while True:
+                try:
+                    output = await asyncio.wait_for(request.outputs.get(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    self.engine.num_timed_out += 1
+                    self.engine.abort(request)
+                    error = {"error": {"message": "the request timed out", "type": "timeout_error"}}
+                    if not stream:
+                        raise HTTPError(504, error["error"]["message"], "timeout_error")
+                    await self._send_event(writer, error)
+                    await self._send_event(writer, "[DONE]")
+                    return
+                if isinstance(output, Exception):
+                    if not stream:
+                        raise HTTPError(500, f"generation failed: {output}", "server_error")
+                    await self._send_event(writer, {"error": {"message": f"generation failed: {output}", "type": "server_error"}})
+                    await self._send_event(writer, "[DONE]")
+                    return
+                num_tokens += 1
+                if stream and (len(output.text_delta) > 0 or output.finished):
+                    # Waits for slow clients, so a stream never buffers more than the socket can take
+                    delta = {"content": output.text_delta} if chat else output.text_delta
+                    await self._send_event(writer, self._chunk(completion_id, created, chat, delta, output.finish_reason))
+                if output.finished:
+                    break
+        except BaseException:
+            # The client went away (or anything else went wrong): its slot goes to the next request
+            self.engine.abort(request)
+            raise
+
+        if stream:
+            await self._send_event(writer, "[DONE]")
+            return
+        choice = {"index": 0, "finish_reason": output.finish_reason}
+        if chat:
+            choice["message"] = {"role": "assistant", "content": output.text}
+        else:
+            choice.update(text=output.text, logprobs=None)
+        await self._send_json(writer, 200, {
+            "id": completion_id,
+            "object": "chat.completion" if chat else "text_completion",
+            "created": created,
+            "model": self.model_name,
+            "choices": [choice],
+            "usage": {"prompt_tokens": len(prompt_tokens), "completion_tokens": num_tokens, "total_tokens": len(prompt_tokens) + num_tokens},
+        })
+
+    def _chunk(self, completion_id: str, created: int, chat: bool, delta, finish_reason: Optional[str]) -> dict:
+        choice = {"index": 0, "finish_reason": finish_reason}
+        if chat:
+            choice["delta"] = delta
+        else:
+            choice.update(text=delta, logprobs=None)
+        return {
+            "id": completion_id,
+            "object": "chat.completion.chunk" if chat else "text_completion",
+            "created": created,
+            "model": self.model_name,
+            "choices": [choice],
+        }
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> tuple[str, str, dict]:
+        request_line = (await reader.readline()).decode("latin-1").strip()
+        parts = request_line.split()
+        if len(parts) != 3:
+            raise HTTPError(400, "malformed request line")
+        method, path, _ = parts
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if line == "":
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        body = {}
+        try:
+            content_length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "invalid Content-Length")
+        if content_length < 0:
+            raise HTTPError(400, "invalid Content-Length")
+        if content_length > 0:
+            try:
+                body = json.loads(await reader.readexactly(content_length))
+            except ValueError as e:
+                # Also an invalid UTF-8 body
+                raise HTTPError(400, f"invalid JSON body: {e}")
+            if not isinstance(body, dict):
+                raise HTTPError(400, "the body must be a JSON object")
+        return method, path, body
+
+    async def _send_headers(self, writer: asyncio.StreamWriter, status: int, content_type: str, content_length: Optional[int] = None, extra: str = ""):
+        head = f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\nContent-Type: {content_type}\r\nConnection: close\r\n{extra}"
+        if content_length is not None:
+            head += f"Content-Length: {content_length}\r\n"
+        writer.write((head + "\r\n").encode("latin-1"))
+        await writer.drain()
+
+    async def _send_json(self, writer: asyncio.StreamWriter, status: int, payload: dict):
+        data = json.dumps(payload).encode("utf-8")
+        await self._send_headers(writer, status, "application/json", len(data))
+        writer.write(data)
+        await writer.drain()
+
+    async def _send_event(self, writer: asyncio.StreamWriter, payload):
+        data = payload if isinstance(payload, str) else json.dumps(payload)
+        writer.write(f"data: {data}\n\n".encode("utf-8"))
+        await writer.drain()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="OpenAI-compatible HTTP server (/v1/completions, /v1/chat/completions) around a single LLaMA")
+    parser.add_argument("--checkpoints-dir", default="llama-2-7b-chat/")
+    parser.add_argument("--tokenizer", default="tokenizer.model")
+    parser.add_argument("--model-name", default=None, help="the name of the checkpoints directory by default")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-batch-size", type=int, default=4, help="number of sequences decoded together")
+    parser.add_argument("--max-seq-len", type=int, default=2048)
+    parser.add_argument("--max-queue", type=int, default=64, help="waiting requests above which new ones get a 429")
+    parser.add_argument("--timeout", type=float, default=300.0, help="seconds before a request is aborted, overridden by a \"timeout\" field")
+    parser.add_argument("--prefill-chunk-size", type=int, default=512)
+    parser.add_argument("--kv-cache-block-size", type=int, default=None)
+    parser.add_argument("--model-parallel-size", type=int, default=1)
+    parser.add_argument("--static-decode", action="store_true", help="fixed-shape decode steps compiled with torch.compile (dense KV cache only)")
+    parser.add_argument("--cuda", action="store_true")
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() and args.cuda else 'cpu'
+    llama = LLaMA.build(
+        checkpoints_dir=args.checkpoints_dir,
+        tokenizer_path=args.tokenizer,
+        load_model=True,
+        max_seq_len=args.max_seq_len,
+        max_batch_size=args.max_batch_size,
+        device=device,
+        kv_cache_block_size=args.kv_cache_block_size,
+        model_parallel_size=args.model_parallel_size,
+    )
+    model_name = args.model_name or Path(args.checkpoints_dir).name
+    server = Server(llama, model_name, args.max_queue, args.timeout, args.prefill_chunk_size, args.static_decode)
+    asyncio.run(server.serve(args.host, args.port))
@@ -0,0 +1,175 @@
+from dataclasses import dataclass, replace
+import torch
+import torch.nn.functional as F
+
+from model import Transformer
+from quantize import QuantizedLinear, quantize_model
+
+
+@dataclass
+class SpeculativeStats:
+    num_proposed: int = 0
+    num_accepted: int = 0
+    num_generated: int = 0
+    num_target_forwards: int = 0
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.num_accepted / self.num_proposed if self.num_proposed > 0 else 0.0
+
+    @property
+    def tokens_per_target_forward(self) -> float:
+        return self.num_generated / self.num_target_forwards if self.num_target_forwards > 0 else 0.0
+
+
+def build_layer_skip_draft(model: Transformer, n_layers: int) -> Transformer:
+    # A draft model made of the first n_layers of the target, sharing their weights (and the embeddings, the final
+    # norm and the output head) without copying them. Only its KV cache is its own
+    assert model.args.model_parallel_size == 1, "the draft must run in a single process"
+    draft_args = replace(model.args, n_layers=n_layers)
+    with torch.device("meta"):
+        draft = Transformer(draft_args)
+        quantized = next((module for module in model.modules() if isinstance(module, QuantizedLinear)), None)
+        if quantized is not None:
+            quantize_model(draft, quantized.bits, quantized.group_size, from_weights=False)
+    state_dict = {
+        name: tensor for name, tensor in model.state_dict().items()
+        if not name.startswith("layers.") or int(name.split(".")[1]) < n_layers
+    }
+    draft.load_state_dict(state_dict, strict=True, assign=True)
+    # The int4 weights are repacked once for both models
+    target_modules = dict(model.named_modules())
+    for name, module in draft.named_modules():
+        if isinstance(module, QuantizedLinear):
+            module._int4pack = target_modules[name]._int4pack
+    draft.init_cache()
+    return draft
+
+
+def _probs(logits: torch.Tensor, temperature: float, top_p: float) -> torch.Tensor:
+    # (..., vocab_size) -> (..., vocab_size) distribution the next token is sampled from, after temperature and top p.
+    # Greedy decoding is the one-hot distribution of the argmax, so the acceptance test below covers it as well
+    if temperature == 0:
+        return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+    probs = torch.softmax(logits.float() / temperature, dim=-1)
+    probs_sort, probs_idx = torch.sort(probs, dim=-1, descending=True)
+    mask = torch.cumsum(probs_sort, dim=-1) - probs_sort > top_p
+    probs_sort[mask] = 0.0
+    probs_sort.div_(probs_sort.sum(dim=-1, keepdim=True))
+    return torch.zeros_like(probs).scatter_(-1, probs_idx, probs_sort)
+
+
+@torch.no_grad()
+def speculative_generate(
+    model: Transformer,
+    draft: Transformer,
+    prompt_tokens: list[list[int]],
+    eos_id: int,
+    temperature: float,
+    top_p: float,
+    max_gen_len: int,
+    num_draft_tokens: int = 4,
+    prefill_chunk_size: int = 512,
+):
+    """
+    Speculative decoding: at every step the draft proposes num_draft_tokens tokens one by one, the target model
+    scores all of them in a single forward pass and keeps the longest prefix passing the acceptance test
+    min(1, p(x) / q(x)), followed by one token sampled from the target. The output follows the same distribution
+    as sampling from the target alone.
+
+    Returns the tokens of every row (prompt included, cut before EOS) and the SpeculativeStats.
+    """
+    device = model.args.device
+    max_seq_len = model.args.max_seq_len
+    batch_size = len(prompt_tokens)
+    seqs = [list(t) for t in prompt_tokens]
+    max_total = [min(max_seq_len, len(t) + max_gen_len) for t in prompt_tokens]
+    slots = torch.arange(batch_size, device=device)
+    stats = SpeculativeStats()
+
+    # Both caches always hold every token of a row except the last one, which is fed at the next step.
+    # The rows are prefilled together: padding past the end of a shorter prompt writes entries that are overwritten
+    # before any token can attend to them
+    prefill_len = max(len(t) for t in seqs) - 1
+    tokens = torch.zeros((batch_size, max(prefill_len, 1)), dtype=torch.long, device=device)
+    for k, t in enumerate(seqs):
+        tokens[k, : len(t) - 1] = torch.tensor(t[:-1], dtype=torch.long, device=device)
+    for transformer in (model, draft):
+        for chunk_start in range(0, prefill_len, prefill_chunk_size):
+            transformer.forward(tokens[:, chunk_start:chunk_start + prefill_chunk_size], chunk_start, slots)
+
+    done = [len(t) >= limit for t, limit in zip(seqs, max_total)]
+    while not all(done):
+        # The finished rows keep running at position 0, their slot is not used anymore
+        lengths = torch.tensor([1 if done[k] else len(t) for k, t in enumerate(seqs)], dtype=torch.long, device=device)
+        # Never write past the end of the KV cache
+        k_draft = min(num_draft_tokens, min(max_seq_len - len(t) for k, t in enumerate(seqs) if not done[k]))
+        # (B, 1)
+        last = torch.tensor([[t[-1]] for t in seqs], dtype=torch.long, device=device)
+        # (B)
+        start_pos = lengths - 1
+
+        # 1. The draft proposes k_draft tokens autoregressively
+        x = last
+        draft_tokens, draft_probs = [], []
+        for i in range(k_draft):
+            q = _probs(draft.forward(x, start_pos + i, slots)[:, -1], temperature, top_p)
+            x = torch.multinomial(q, num_samples=1)
+            draft_tokens.append(x)
+            draft_probs.append(q)
+        # (B, K)
+        d = torch.cat(draft_tokens, dim=1)
+        # (B, K, vocab_size)
+        q = torch.stack(draft_probs, dim=1)
+
+        # 2. The target scores the last token and the K proposals in one pass: (B, K + 1, vocab_size)
+        p = _probs(model.forward(torch.cat([last, d], dim=1), start_pos, slots), temperature, top_p)
+        stats.num_target_forwards += 1
+
+        # 3. Accept each proposal with probability min(1, p / q), up to the first rejection
+        # (B, K)
+        p_d = p[:, :k_draft].gather(-1, d[..., None]).squeeze(-1)
+        q_d = q.gather(-1, d[..., None]).squeeze(-1)
+        accepted = torch.rand_like(p_d) < (p_d / q_d).clamp(max=1.0)
+        # (B) number of leading accepted proposals
+        num_accepted = accepted.long().cumprod(dim=1).sum(dim=1)
+
+        # 4. After a rejection, sample from the residual max(0, p - q). When everything was accepted,
+        #    q is zero at the extra position and the residual is the target distribution itself
+        rows = torch.arange(batch_size, device=device)
+        p_next = p[rows, num_accepted]
+        q_next = torch.cat([q, torch.zeros_like(q[:, :1])], dim=1)[rows, num_accepted]
+        residual = (p_next - q_next).clamp(min=0.0)
+        residual_sum = residual.sum(dim=-1, keepdim=True)
+        residual = torch.where(residual_sum > 0, residual / residual_sum.clamp(min=1e-12), p_next)
+        next_token = torch.multinomial(residual, num_samples=1).squeeze(-1)
+
+        # Rolling back the rejected proposals needs no work: the cache entries past the new length are
+        # overwritten by the next step before they can be attended to
+        d_list, num_accepted_list, next_list = d.tolist(), num_accepted.tolist(), next_token.tolist()
+        for k in range(batch_size):
+            if done[k]:
+                continue
+            stats.num_proposed += k_draft
+            stats.num_accepted += num_accepted_list[k]
+            for token in d_list[k][:num_accepted_list[k]] + [next_list[k]]:
+                seqs[k].append(token)
+                stats.num_generated += 1
+                if token == eos_id or len(seqs[k]) >= max_total[k]:
+                    done[k] = True
+                    break
+
+        # The last proposal is in the target cache but was never fed to the draft: catch up on the rows that accepted everything
+        caught_up = [k for k in range(batch_size) if not done[k] and num_accepted_list[k] == k_draft]
+        if len(caught_up) > 0:
+            index = torch.tensor(caught_up, dtype=torch.long, device=device)
+            draft.forward(d[index, -1:], start_pos[index] + k_draft, slots[index])
+
+    model.release(list(range(batch_size)))
+    draft.release(list(range(batch_size)))
+    out_tokens = []
+    for t in seqs:
+        if eos_id in t:
+            t = t[:t.index(eos_id)]
+        out_tokens.append(t)
+    return out_tokens, stats
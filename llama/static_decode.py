@@ -0,0 +1,73 @@
+from typing import Callable
+import time
+import torch
+
+from model import Transformer
+from kv_cache import KVCache
+
+
+class StaticDecoder:
+    """
+    Decode steps with the same shapes every time, so that they can go through torch.compile.
+
+    The regular decode reads the KV cache up to the longest running sequence, a length that grows at every step and
+    forces a recompilation (or a dynamic-shape graph). Here every step runs the whole (Max_B, 1) batch against the
+    whole (Max_B, H_KV, Max_Seq_Len, Head_Dim) cache, with the positions past each row's own masked: the inputs are
+    copied into preallocated buffers and the logits out of one. Rows without a running sequence decode a dummy
+    token at position 0 of their slot, which the next sequence in that slot overwrites before reading it.
+
+    The attention always covers max_seq_len positions, so this pays off when the per-step overhead (Python,
+    dispatch, allocations) dominates, i.e. for small models, small batches or short max_seq_len.
+    If torch.compile is not available or fails during the warm-up, the same step runs eagerly.
+    """
+
+    def __init__(self, model: Transformer, compile: bool = True, num_warmup_steps: int = 2):
+        assert model.args.model_parallel_size == 1, "the static decode does not support tensor parallelism"
+        assert all(type(layer.attention.cache) is KVCache for layer in model.layers), "the static decode needs the dense KV cache"
+        self.model = model
+        max_batch_size = model.args.max_batch_size
+        device = model.args.device
+        # (Max_B, 1)
+        self.tokens = torch.zeros((max_batch_size, 1), dtype=torch.long, device=device)
+        # (Max_B)
+        self.start_pos = torch.zeros(max_batch_size, dtype=torch.long, device=device)
+        # (Max_B, vocab_size)
+        self.logits = torch.empty((max_batch_size, model.args.vocab_size), dtype=torch.float, device=device)
+
+        self.step_fn: Callable[[torch.Tensor, torch.Tensor], torch.Tensor] = model.decode_step
+        self.compiled = False
+        self.compile_time = 0.0
+        if compile and hasattr(torch, "compile"):
+            start_time = time.time()
+            try:
+                self.step_fn = torch.compile(model.decode_step, dynamic=False)
+                # The compilation happens on the first calls, so this is where it fails if it does
+                self.warmup(num_warmup_steps)
+                self.compiled = True
+            except Exception as e:
+                print(f"torch.compile failed, decoding eagerly: {e}")
+                self.step_fn = model.decode_step
+            self.compile_time = time.time() - start_time
+            if self.compiled:
+                print(f"Compiled the decode step in {self.compile_time:.2f}s")
+
+    def warmup(self, num_steps: int):
+        # Only writes dummy entries at position 0 of every slot: call it before any sequence is running
+        self.tokens.zero_()
+        self.start_pos.zero_()
+        with torch.no_grad():
+            for _ in range(num_steps):
+                self.step_fn(self.tokens, self.start_pos)
+
+    def __call__(self, tokens: list[int], start_pos: list[int], slots: list[int]) -> torch.Tensor:
+        # Decodes tokens[i] at position start_pos[i] of slot slots[i] and returns their (B, vocab_size) logits
+        self.tokens.zero_()
+        self.start_pos.zero_()
+        # (B)
+        index = torch.tensor(slots, dtype=torch.long, device=self.tokens.device)
+        self.tokens[index, 0] = torch.tensor(tokens, dtype=torch.long, device=self.tokens.device)
+        self.start_pos[index] = torch.tensor(start_pos, dtype=torch.long, device=self.tokens.device)
+        with torch.no_grad():
+            # (Max_B, 1, vocab_size) -> (Max_B, vocab_size)
+            self.logits.copy_(self.step_fn(self.tokens, self.start_pos)[:, -1])
+        return self.logits[index]
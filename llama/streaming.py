@@ -0,0 +1,129 @@
+from sentencepiece import SentencePieceProcessor
+
+
+class IncrementalDecoder:
+    # SentencePiece pieces can't be decoded one by one: a piece decoded on its own loses its leading space ("▁"),
+    # and a multibyte character split across byte-fallback pieces decodes to U+FFFD until its last byte arrives.
+    # So the new tokens are always decoded together with the few tokens before them, and only the text past
+    # those is emitted, once it doesn't end with an incomplete character
+
+    def __init__(self, tokenizer: SentencePieceProcessor, prompt_tokens: list[int], context_tokens: int = 5):
+        self.tokenizer = tokenizer
+        self.tokens = list(prompt_tokens)
+        # Tokens [prefix_offset, read_offset) were already emitted and only give context to the following ones
+        self.prefix_offset = max(len(self.tokens) - context_tokens, 0)
+        self.read_offset = len(self.tokens)
+        # Everything emitted so far
+        self.text = ""
+
+    def step(self, token: int) -> str:
+        # Returns the text added by the token, possibly empty while a character is incomplete
+        self.tokens.append(token)
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset
+        self.read_offset = len(self.tokens)
+        self.text += delta
+        return delta
+
+    def flush(self) -> str:
+        # Emits whatever is still pending at the end of the sequence, even an incomplete character
+        prefix_text = self.tokenizer.decode(self.tokens[self.prefix_offset:self.read_offset])
+        new_text = self.tokenizer.decode(self.tokens[self.prefix_offset:])
+        delta = new_text[len(prefix_text):]
+        self.prefix_offset = self.read_offset = len(self.tokens)
+        self.text += delta
+        return delta
+
+
+class StopStringMatcher:
+    # Finds the stop strings in the text of a sequence as it arrives in pieces. The end of the text that could be
+    # the beginning of a stop string is held back until the next pieces tell, so that no part of a stop string
+    # is ever emitted
+
+    def __init__(self, stop: list[str]):
+        self.stop = [s for s in stop if len(s) > 0]
+        self.pending = ""
+
+    def step(self, text: str) -> tuple[str, bool]:
+        # Returns the text that can be emitted and whether a stop string was found (the text is then cut before it)
+        text = self.pending + text
+        self.pending = ""
+        stop_positions = [text.find(s) for s in self.stop if s in text]
+        if len(stop_positions) > 0:
+            return text[:min(stop_positions)], True
+        hold = 0
+        for s in self.stop:
+            for n in range(min(len(s) - 1, len(text)), hold, -1):
+                if text.endswith(s[:n]):
+                    hold = n
+                    break
+        self.pending = text[len(text) - hold:]
+        return text[:len(text) - hold], False
+
+    def flush(self) -> str:
+        pending, self.pending = self.pending, ""
+        return pending
+
+
+class CompletionStream:
+    # The text of a generated sequence, token by token: incremental decoding followed by the stop strings.
+    # The sequence is stopped by EOS, one of the stop tokens (neither adds any text) or a stop string
+
+    def __init__(self, tokenizer: SentencePieceProcessor, prompt_tokens: list[int], stop: list[str] = (), stop_token_ids: list[int] = ()):
+        self.decoder = IncrementalDecoder(tokenizer, prompt_tokens)
+        self.matcher = StopStringMatcher(list(stop))
+        self.stop_token_ids = set(stop_token_ids) | {tokenizer.eos_id()}
+        # The completion emitted so far
+        self.text = ""
+        self.stopped = False
+        self.finished = False
+
+    def step(self, token: int) -> str:
+        # Returns the text added by the token
+        if self.finished:
+            return ""
+        if token in self.stop_token_ids:
+            self.stopped = True
+            return self.finish()
+        text, self.stopped = self.matcher.step(self.decoder.step(token))
+        self.text += text
+        if self.stopped:
+            self.finished = True
+        return text
+
+    def finish(self) -> str:
+        # Ends the sequence (e.g. when it runs out of tokens) and returns the text still held back
+        if self.finished:
+            return ""
+        self.finished = True
+        text, found = self.matcher.step(self.decoder.flush())
+        if not found:
+            text += self.matcher.flush()
+        self.stopped |= found
+        self.text += text
+        return text
+
+
+def trim_to_text(tokenizer: SentencePieceProcessor, prompt_tokens: list[int], output_tokens: list[int], text: str, context_tokens: int = 5) -> list[int]:
+    # The longest prefix of output_tokens whose text (decoded after the end of the prompt, like IncrementalDecoder)
+    # does not go past text, e.g. the tokens of a completion cut before a stop string. A token that straddles
+    # the cut is dropped
+    context = list(prompt_tokens[-context_tokens:])
+    context_len = len(tokenizer.decode(context))
+
+    def decoded_len(n: int) -> int:
+        return len(tokenizer.decode(context + output_tokens[:n])) - context_len
+
+    # The decoded length only grows with the number of tokens: binary search for the last prefix that fits
+    low, high = 0, len(output_tokens)
+    while low < high:
+        mid = (low + high + 1) // 2
+        if decoded_len(mid) <= len(text):
+            low = mid
+        else:
+            high = mid - 1
+    return output_tokens[:low]
@@ -0,0 +1,165 @@
+from typing import Optional, Union
+import multiprocessing
+import os
+import socket
+import torch
+import torch.distributed as dist
+
+from model import ModelArgs, Transformer
+
+# Commands sent by rank 0 to the other processes before each call they have to take part in
+FORWARD, RELEASE, SHUTDOWN = 0, 1, 2
+
+# Sharded along the output features (dim 0): each process computes its own heads / hidden units
+COLUMN_PARALLEL = ("attention.wq.", "attention.wk.", "attention.wv.", "feed_forward.w1.", "feed_forward.w3.")
+# wq/wk/wv and w1/w3 stacked (checkpoints saved from the model, e.g. quantized): each part is sharded on its own
+STACKED_COLUMN_PARALLEL = ("attention.wqkv.", "feed_forward.w13.")
+# Sharded along the input features (dim 1): each process computes a partial sum, reduced by all_reduce_model_parallel
+ROW_PARALLEL = ("attention.wo.", "feed_forward.w2.")
+
+
+def shard_state_dict(state_dict: dict[str, torch.Tensor], model_args: ModelArgs, rank: int) -> dict[str, torch.Tensor]:
+    # The slices of the full (or quantized) checkpoint that belong to a process. The embeddings, the norms and the
+    # output head are replicated. The slices are views, a memory-mapped checkpoint is only paged in where needed
+    world_size = model_args.model_parallel_size
+    head_dim = model_args.dim // model_args.n_heads
+    n_kv_heads = model_args.n_heads if model_args.n_kv_heads is None else model_args.n_kv_heads
+    sharded = {}
+    for name, tensor in state_dict.items():
+        if any(part in name for part in STACKED_COLUMN_PARALLEL):
+            if "wqkv" in name:
+                # Rows of wq, then wk, then wv
+                parts = tensor.split([model_args.n_heads * head_dim, n_kv_heads * head_dim, n_kv_heads * head_dim], dim=0)
+            else:
+                # Rows of w1, then w3
+                parts = tensor.chunk(2, dim=0)
+            tensor = torch.cat([part.chunk(world_size, dim=0)[rank] for part in parts], dim=0)
+        elif any(part in name for part in COLUMN_PARALLEL):
+            # weight / qweight (Out, In), int8 scales (Out) and int4 scales (Out, In / Group_Size) are all split by rows
+            tensor = tensor.chunk(world_size, dim=0)[rank]
+        elif any(part in name for part in ROW_PARALLEL) and not (name.endswith(".scales") and tensor.dim() == 1):
+            # weight / qweight (Out, In) and int4 scales (Out, In / Group_Size) are split by columns,
+            # int8 scales are per output channel, so every process needs all of them
+            tensor = tensor.chunk(world_size, dim=1)[rank]
+        sharded[name] = tensor
+    return sharded
+
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _init_process(rank: int, world_size: int, port: int):
+    # Every process gets its own contiguous range of cores (on a multi-socket host, ideally one socket each),
+    # so the processes don't compete for the same cores and each one streams its shard from its own memory
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        per_rank = max(1, len(cores) // world_size)
+        os.sched_setaffinity(0, cores[rank * per_rank:(rank + 1) * per_rank] or cores)
+        torch.set_num_threads(per_rank)
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=world_size)
+
+
+def _worker(rank: int, world_size: int, port: int, checkpoints_dir: str, model_args: ModelArgs, dtype: torch.dtype):
+    from LLaMA import LLaMA
+    _init_process(rank, world_size, port)
+    torch.set_default_dtype(dtype)
+    model = LLaMA.load_model(checkpoints_dir, model_args)
+    model.serve()
+    dist.destroy_process_group()
+
+
+def launch_workers(checkpoints_dir: str, model_args: ModelArgs):
+    # Starts the processes of ranks 1 to model_parallel_size - 1, each loading its own shard and waiting for the
+    # commands of rank 0, which is the calling process
+    world_size = model_args.model_parallel_size
+    assert model_args.device == "cpu", "tensor parallelism is only supported on the CPU"
+    port = _free_port()
+    context = multiprocessing.get_context("spawn")
+    workers = []
+    for rank in range(1, world_size):
+        worker = context.Process(
+            target=_worker,
+            args=(rank, world_size, port, checkpoints_dir, model_args, torch.get_default_dtype()),
+            daemon=True,
+        )
+        worker.start()
+        workers.append(worker)
+    _init_process(0, world_size, port)
+    return workers
+
+
+class TensorParallelTransformer(Transformer):
+    """
+    Transformer sharded across model_parallel_size processes, following Megatron: wq/wk/wv and w1/w3 are split by
+    heads / hidden units, wo and w2 by their inputs, and their partial outputs are summed with an all-reduce.
+
+    Rank 0 is used like a regular Transformer: every forward (and release) is first broadcast to the other ranks,
+    which run the same call on their shard inside serve(). All the ranks end up with the same logits.
+    """
+
+    def __init__(self, args: ModelArgs):
+        world_size = args.model_parallel_size
+        n_kv_heads = args.n_heads if args.n_kv_heads is None else args.n_kv_heads
+        assert args.n_heads % world_size == 0 and n_kv_heads % world_size == 0, "the heads must be divisible by model_parallel_size"
+        super().__init__(args)
+        self.workers: list[multiprocessing.Process] = []
+
+    def forward(self, tokens: torch.Tensor, start_pos: Union[int, torch.Tensor], slots: Optional[torch.Tensor] = None):
+        if dist.get_rank() == 0:
+            batch_size, seq_len = tokens.shape
+            start_pos_is_tensor = isinstance(start_pos, torch.Tensor)
+            header = torch.tensor([
+                FORWARD, batch_size, seq_len, int(start_pos_is_tensor), int(slots is not None),
+                0 if start_pos_is_tensor else start_pos
+            ], dtype=torch.long)
+            dist.broadcast(header, src=0)
+            dist.broadcast(tokens.contiguous(), src=0)
+            if start_pos_is_tensor:
+                dist.broadcast(start_pos.expand(batch_size).contiguous(), src=0)
+            if slots is not None:
+                dist.broadcast(slots.contiguous(), src=0)
+        return super().forward(tokens, start_pos, slots)
+
+    def release(self, slots: list[int]):
+        if dist.get_rank() == 0 and len(slots) > 0:
+            dist.broadcast(torch.tensor([RELEASE, len(slots), 0, 0, 0, 0], dtype=torch.long), src=0)
+            dist.broadcast(torch.tensor(slots, dtype=torch.long), src=0)
+        super().release(slots)
+
+    def serve(self):
+        # Loop of the ranks other than 0: receive the calls made on rank 0 and run them on the local shard
+        while True:
+            header = torch.empty(6, dtype=torch.long)
+            dist.broadcast(header, src=0)
+            command, batch_size, seq_len, start_pos_is_tensor, has_slots, start_pos = header.tolist()
+            if command == SHUTDOWN:
+                return
+            if command == RELEASE:
+                slots = torch.empty(batch_size, dtype=torch.long)
+                dist.broadcast(slots, src=0)
+                super().release(slots.tolist())
+                continue
+            tokens = torch.empty((batch_size, seq_len), dtype=torch.long)
+            dist.broadcast(tokens, src=0)
+            if start_pos_is_tensor:
+                start_pos = torch.empty(batch_size, dtype=torch.long)
+                dist.broadcast(start_pos, src=0)
+            slots = None
+            if has_slots:
+                slots = torch.empty(batch_size, dtype=torch.long)
+                dist.broadcast(slots, src=0)
+            with torch.no_grad():
+                super().forward(tokens, start_pos, slots)
+
+    def shutdown(self):
+        # Called on rank 0 at exit: stops the other ranks
+        if not dist.is_initialized():
+            return
+        dist.broadcast(torch.tensor([SHUTDOWN, 0, 0, 0, 0, 0], dtype=torch.long), src=0)
+        for worker in self.workers:
+            worker.join()
+        dist.destroy_process_group()
+